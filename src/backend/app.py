@@ -3,27 +3,101 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 from datetime import datetime
 import os
-from db import init_db, get_db_connection
+import psycopg2
+import db
+import migrations
+import rollups
+import partitions
+import archive
+import ingest
+import fastjson
+import shards
+import versions
+import passwords
+import metrics
+import slowlog
+from catalog import catalog
+from db import get_db_connection
+from pool import PoolTimeout
 import auth
 import expenses
 import categories
+import imports
+import exports
+import batch
+import dashboard
+import trends
+
+# Frontend origins allowed to call the API
+CORS_ORIGINS = ["http://localhost:8080"]
 
 app = Flask(__name__)
+# orjson-backed jsonify when orjson is installed
+app.json = fastjson.FastJSONProvider(app)
 # Update CORS configuration to explicitly allow frontend origin
-CORS(app, resources={r"/api/*": {"origins": ["http://localhost:8080"]}})
+CORS(app, resources={r"/api/*": {"origins": CORS_ORIGINS}})
 
 # Register blueprints
 app.register_blueprint(auth.bp)
 app.register_blueprint(expenses.bp)
 app.register_blueprint(categories.bp)
+app.register_blueprint(imports.bp)
+app.register_blueprint(exports.bp)
+app.register_blueprint(batch.bp)
+app.register_blueprint(dashboard.bp)
+app.register_blueprint(trends.bp)
+
+# Return pooled connections on teardown and register CLI commands
+db.init_app(app)
+migrations.init_app(app)
+rollups.init_app(app)
+partitions.init_app(app)
+archive.init_app(app)
+shards.init_app(app)
+metrics.init_app(app)
+slowlog.init_app(app)
+
+metrics.register(metrics.Gauge(
+    'db_pool_connections', 'Pooled connections in this worker by state.', ('state',),
+    lambda: {(state,): (db.pool_stats() or {}).get(state, 0) for state in ('idle', 'in_use')}))
+metrics.register(metrics.Gauge(
+    'password_hash_queue', 'Password hashes waiting for or running on a hashing worker.', ('state',),
+    lambda: {(state,): passwords.stats()[state] for state in ('queued', 'running')}))
+
+metrics.register(metrics.Gauge(
+    'ingest_queue_pending', 'Queued expense creates not yet written to the database.', (),
+    lambda: {(): ingest.queue.stats()['pending']}))
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(e):
+    return jsonify({'message': 'Database is busy, please retry'}), 503
+
+@app.errorhandler(passwords.HashPoolBusy)
+def handle_hash_pool_busy(e):
+    return jsonify({'message': 'Too many sign-in attempts in progress, please retry'}), 503, \
+        {'Retry-After': '1'}
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat()})
+    return jsonify({
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "pool": db.pool_stats(),
+        "replicas": db.replica_stats(),
+        "shards": db.shard_count(),
+        "hashing": passwords.stats(),
+        "ingest": ingest.queue.stats(),
+        "caches": dict(auth.cache_stats(), responses=versions.response_cache.stats(),
+                       categories=catalog.stats())
+    })
 
-# Initialize the database within the application context
+# Check the schema version once per worker; migrations run via "flask migrate"
 with app.app_context():
-    init_db()
+    try:
+        migrations.check_schema(app)
+        partitions.maintain(app)
+    except psycopg2.OperationalError as e:
+        app.logger.warning('Could not check database schema version: %s', e)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))  # Changed default port to 5001
@@ -0,0 +1,212 @@
+import click
+import os
+from datetime import date, datetime
+from flask.cli import with_appcontext
+from db import each_shard
+from versions import bump_user_version
+
+# Expenses dated before the first day of the month ARCHIVE_AFTER_MONTHS ago
+# are moved out of the hot table into expenses_archive, one row per user and
+# month with each column stored as an array. The arrays are TOASTed and
+# compressed, and the hot table and its indexes only hold recent history.
+# Rollups are left untouched, so day-aligned summaries never read the archive.
+ARCHIVE_AFTER_MONTHS = int(os.environ.get('ARCHIVE_AFTER_MONTHS', 24))
+
+# (hot column, archive array column) in unnest order
+ARCHIVE_COLUMNS = [
+    ('id', 'ids'),
+    ('title', 'titles'),
+    ('amount', 'amounts'),
+    ('date', 'dates'),
+    ('category_id', 'category_ids'),
+    ('notes', 'notes'),
+    ('receipt_url', 'receipt_urls'),
+    ('created_at', 'created_ats'),
+    ('updated_at', 'updated_ats'),
+]
+
+# Every expense, hot or archived, with the columns the rollups aggregate
+ALL_EXPENSES = """(
+    SELECT user_id, date, category_id, amount FROM expenses
+    UNION ALL
+    SELECT a.user_id, u.date, u.category_id, u.amount
+    FROM expenses_archive a
+    CROSS JOIN LATERAL unnest(a.dates, a.category_ids, a.amounts) AS u(date, category_id, amount)
+) all_expenses"""
+
+# Archived rows show up in listings with their ids but are read-only until restored
+ARCHIVED_MESSAGE = 'Expense is archived; run "flask archive restore" to edit it'
+
+def cutoff(today=None):
+    """First instant that is still kept in the hot table"""
+    today = today or date.today()
+    month = today.year * 12 + today.month - 1 - ARCHIVE_AFTER_MONTHS
+    return datetime(month // 12, month % 12 + 1, 1)
+
+def source(user_id, start, end, alias='e'):
+    """FROM item for a user's expenses in [start, end); returns (sql, params).
+
+    Windows that stay after the archive cutoff read the hot table directly.
+    Older windows read a UNION ALL of the hot table and the unnested archive
+    months overlapping the window, exposing the same columns (including
+    search_vector), so every filter in filters.py applies unchanged. Both
+    forms add an `archived` flag column.
+    """
+    boundary = cutoff()
+    if start is not None and start >= boundary:
+        return f'(SELECT expenses.*, false AS archived FROM expenses) {alias}', []
+
+    hot = ', '.join(column for column, _ in ARCHIVE_COLUMNS)
+    unnest = ', '.join(f'a.{array}' for _, array in ARCHIVE_COLUMNS)
+    month_filter = ''
+    params = [user_id, user_id]
+    if start is not None:
+        month_filter += " AND a.month >= date_trunc('month', %s::timestamp)"
+        params.append(start)
+    if end is not None:
+        month_filter += ' AND a.month < %s'
+        params.append(end)
+
+    sql = f"""(
+        SELECT user_id, {hot}, search_vector, false AS archived
+        FROM expenses
+        WHERE user_id = %s
+        UNION ALL
+        SELECT a.user_id, {', '.join(f'u.{column}' for column, _ in ARCHIVE_COLUMNS)},
+               to_tsvector('simple', COALESCE(u.title, '') || ' ' || COALESCE(u.notes, '')), true
+        FROM expenses_archive a
+        CROSS JOIN LATERAL unnest({unnest}) AS u({hot})
+        WHERE a.user_id = %s {month_filter}
+    ) {alias}"""
+    return sql, params
+
+def archived_ids(cur, user_id, expense_ids):
+    """The subset of expense_ids that sit in the user's archive"""
+    cur.execute("""
+        SELECT DISTINCT u.id
+        FROM expenses_archive a
+        CROSS JOIN LATERAL unnest(a.ids) AS u(id)
+        WHERE a.user_id = %s AND u.id = ANY(%s)
+    """, (user_id, list(expense_ids)))
+    return {row['id'] for row in cur.fetchall()}
+
+def archive_user(conn, user_id, before):
+    """Move one user's expenses dated before `before` into the archive; returns rows moved"""
+    hot = ', '.join(column for column, _ in ARCHIVE_COLUMNS)
+    arrays = ', '.join(array for _, array in ARCHIVE_COLUMNS)
+    aggregates = ', '.join(f'array_agg({column} ORDER BY date, id)' for column, _ in ARCHIVE_COLUMNS)
+    appends = ', '.join(f'{array} = expenses_archive.{array} || EXCLUDED.{array}'
+                        for _, array in ARCHIVE_COLUMNS)
+    cur = conn.cursor()
+    try:
+        cur.execute(f"""
+            WITH moved AS (
+                DELETE FROM expenses WHERE user_id = %s AND date < %s
+                RETURNING user_id, {hot}
+            ),
+            archived AS (
+                INSERT INTO expenses_archive (user_id, month, {arrays})
+                SELECT user_id, date_trunc('month', date)::date, {aggregates}
+                FROM moved
+                GROUP BY user_id, date_trunc('month', date)
+                ON CONFLICT (user_id, month) DO UPDATE SET {appends}
+            )
+            SELECT COUNT(*) AS rows FROM moved
+        """, (user_id, before))
+        moved = cur.fetchone()['rows']
+        if moved:
+            # Cached list bodies still show these rows as editable
+            bump_user_version(cur, user_id)
+        conn.commit()
+        return moved
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def restore_user(conn, user_id, since=None):
+    """Move archived months starting on or after `since` (default: all) back to expenses"""
+    hot = ', '.join(column for column, _ in ARCHIVE_COLUMNS)
+    unnest = ', '.join(f'a.{array}' for _, array in ARCHIVE_COLUMNS)
+    month_filter = ' AND month >= %s' if since is not None else ''
+    params = [user_id] + ([since] if since is not None else [])
+    cur = conn.cursor()
+    try:
+        cur.execute(f"""
+            WITH restored AS (
+                DELETE FROM expenses_archive WHERE user_id = %s {month_filter}
+                RETURNING *
+            )
+            INSERT INTO expenses (user_id, {hot})
+            SELECT a.user_id, u.*
+            FROM restored a
+            CROSS JOIN LATERAL unnest({unnest}) AS u({hot})
+        """, params)
+        rows = cur.rowcount
+        if rows:
+            bump_user_version(cur, user_id)
+        conn.commit()
+        return rows
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def _users(conn, user_id):
+    if user_id is not None:
+        return [user_id]
+    cur = conn.cursor()
+    cur.execute('SELECT id FROM users ORDER BY id')
+    ids = [row['id'] for row in cur.fetchall()]
+    cur.close()
+    conn.rollback()
+    return ids
+
+@click.group('archive')
+def archive_cli():
+    """Move old expenses to and from the compact archive."""
+
+@archive_cli.command('run')
+@click.option('--user-id', type=int, default=None, help='Only archive this user.')
+@click.option('--vacuum', is_flag=True, help='VACUUM expenses afterwards to reuse the freed space.')
+@with_appcontext
+def run_command(user_id, vacuum):
+    """Archive expenses older than ARCHIVE_AFTER_MONTHS, one user per transaction."""
+    before = cutoff()
+    total = 0
+    for _, pool in each_shard():
+        with pool.connection() as conn:
+            archived = 0
+            for uid in _users(conn, user_id):
+                moved = archive_user(conn, uid, before)
+                if moved:
+                    click.echo(f'user {uid}: archived {moved} expenses')
+                archived += moved
+            if vacuum and archived:
+                conn.autocommit = True
+                try:
+                    conn.cursor().execute('VACUUM (ANALYZE) expenses')
+                finally:
+                    conn.autocommit = False
+            total += archived
+    click.echo(f'Archived {total} expenses dated before {before:%Y-%m-%d}.')
+
+@archive_cli.command('restore')
+@click.option('--user-id', type=int, default=None, help='Only restore this user.')
+@click.option('--since', type=click.DateTime(['%Y-%m-%d']), default=None,
+              help='Only restore months starting on or after this date.')
+@with_appcontext
+def restore_command(user_id, since):
+    """Move archived expenses back into the hot table, e.g. after raising ARCHIVE_AFTER_MONTHS."""
+    total = 0
+    for _, pool in each_shard():
+        with pool.connection() as conn:
+            for uid in _users(conn, user_id):
+                total += restore_user(conn, uid, since.date() if since else None)
+    click.echo(f'Restored {total} expenses.')
+
+def init_app(app):
+    """Register archive commands with the Flask app."""
+    app.cli.add_command(archive_cli)
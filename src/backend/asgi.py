@@ -0,0 +1,302 @@
+"""Async serving mode.
+
+The hot read routes (expense list and summary, categories, profile) are served
+natively on Starlette with an asyncpg pool; every other route is handed to the
+Flask app unchanged. Response bodies are rendered exactly like Flask's
+jsonify, so clients cannot tell the two modes apart.
+
+    uvicorn asgi:app --workers 4
+"""
+import asyncio
+import os
+import re
+from contextlib import asynccontextmanager
+from decimal import Decimal
+from functools import wraps
+import asyncpg
+import jwt
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_etags
+import archive
+import fastjson
+import rollups
+import shards
+from app import app as flask_app, CORS_ORIGINS
+from auth import USER_QUERY, cached_user, decode_token, remember_user
+from catalog import catalog
+from db import _connect_kwargs
+from expenses import (BY_RELEVANCE, LISTED_COLUMNS, NEWEST_FIRST, decode_cursor, expenses_body,
+                      expenses_json_query, expenses_query, format_expense, next_cursor, page_args,
+                      summarize_categories)
+from filters import FilterError, date_clause, expense_window, parse_expense_filters, search_clause, search_rank
+from versions import VERSIONS_QUERY, make_etag, response_cache
+
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5))
+
+_PLACEHOLDER = re.compile(r'%s|%%')
+
+def to_asyncpg(query, params):
+    """Rewrite a psycopg2-style query (%s placeholders) for asyncpg ($1, $2, ...)"""
+    positions = iter(range(1, len(params) + 1))
+    query = _PLACEHOLDER.sub(lambda m: f'${next(positions)}' if m.group() == '%s' else '%', query)
+    # NUMERIC parameters must be Decimal; amount filters arrive as floats
+    return query, [Decimal(repr(value)) if isinstance(value, float) else value for value in params]
+
+async def fetch(conn, query, params=()):
+    query, params = to_asyncpg(query, list(params))
+    return [dict(row) for row in await conn.fetch(query, *params)]
+
+async def fetchrow(conn, query, params=()):
+    rows = await fetch(conn, query, params)
+    return rows[0] if rows else None
+
+def render(data, status=200):
+    """Serialize like flask.jsonify: sorted keys, compact separators, trailing newline"""
+    return Response(fastjson.dumps(data) + b'\n', status_code=status, media_type='application/json')
+
+async def ensure_catalog():
+    """Reload the category catalog off the event loop when it is stale"""
+    if not catalog.is_fresh():
+        await run_in_threadpool(catalog.snapshot)
+
+def _authenticate(token):
+    """Return (user_id, error response)"""
+    try:
+        return decode_token(token)['sub'], None
+    except jwt.ExpiredSignatureError:
+        return None, render({'message': 'Token has expired!'}, 401)
+    except jwt.InvalidTokenError:
+        return None, render({'message': 'Invalid token!'}, 401)
+
+def token_required(f):
+    """Async counterpart of auth.token_required.
+
+    Checks out one connection for the whole request and passes it to the
+    handler together with the current user.
+    """
+    @wraps(f)
+    async def decorated(request):
+        parts = request.headers.get('Authorization', '').split(' ')
+        if len(parts) < 2 or not parts[1]:
+            return render({'message': 'Token is missing!'}, 401)
+
+        user_id, error = _authenticate(parts[1])
+        if error is not None:
+            return error
+
+        try:
+            async with request.app.state.pool.acquire(timeout=POOL_TIMEOUT) as conn:
+                current_user = cached_user(user_id)
+                if current_user is None:
+                    row = await fetchrow(conn, USER_QUERY, (user_id,))
+                    if row is None:
+                        return render({'message': 'User not found!'}, 401)
+                    current_user = remember_user(user_id, row)
+                return await f(request, conn, current_user)
+        except asyncio.TimeoutError:
+            return render({'message': 'Database is busy, please retry'}, 503)
+    return decorated
+
+def conditional(f=None, *, window=None):
+    """Async counterpart of versions.conditional, sharing its ETags and response cache"""
+    if f is None:
+        return lambda f: conditional(f, window=window)
+
+    @wraps(f)
+    async def decorated(request, conn, current_user):
+        user_id = current_user['id']
+        row = await fetchrow(conn, VERSIONS_QUERY, (user_id,))
+        versions = (row['data_version'], row['catalog_version']) if row else (0, 0)
+        args = request.query_params.multi_items()
+        etag = make_etag(user_id, *versions, request.url.path, args,
+                         window(MultiDict(args)) if window else None)
+
+        if parse_etags(request.headers.get('If-None-Match')).contains(etag):
+            response = Response(status_code=304)
+        else:
+            cached = response_cache.get(etag)
+            if cached is not None:
+                body, mimetype = cached
+                response = Response(body, media_type=mimetype)
+            else:
+                response = await f(request, conn, current_user)
+                if response.status_code != 200:
+                    return response
+                response_cache.set(etag, (response.body, response.media_type))
+
+        response.headers['ETag'] = f'"{etag}"'
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.headers.append('Vary', 'Authorization')
+        return response
+    return decorated
+
+def with_cors(f):
+    """Add the CORS headers Flask-CORS would set for an allowed origin"""
+    @wraps(f)
+    async def decorated(request):
+        response = await f(request)
+        origin = request.headers.get('Origin')
+        if origin in CORS_ORIGINS:
+            response.headers['Access-Control-Allow-Origin'] = origin
+            response.headers.append('Vary', 'Origin')
+        return response
+    return decorated
+
+@with_cors
+@token_required
+async def get_profile(request, conn, current_user):
+    return render({'user': current_user})
+
+@with_cors
+@token_required
+@conditional
+async def get_categories(request, conn, current_user):
+    await ensure_catalog()
+    return render({'categories': catalog.all()})
+
+@with_cors
+@token_required
+@conditional(window=expense_window)
+async def get_expenses(request, conn, current_user):
+    args = MultiDict(request.query_params.multi_items())
+    await ensure_catalog()
+    try:
+        filters = parse_expense_filters(args)
+        page, page_size = page_args(args)
+    except FilterError as e:
+        return render({'message': str(e)}, 400)
+
+    query, params = expenses_query(current_user['id'], filters)
+
+    cursor = args.get('cursor')
+    if cursor is not None or args.get('pagination') == 'cursor':
+        return await _get_expenses_page_by_cursor(conn, args, query, params, cursor, page_size)
+
+    total_count = (await fetchrow(conn, f"SELECT COUNT(*) FROM ({query}) AS filtered_expenses",
+                                  params))['count']
+
+    _, _, tsquery = search_clause(filters)
+    order = NEWEST_FIRST
+    if tsquery and args.get('sort') == 'relevance':
+        query, params = expenses_query(current_user['id'], filters, rank=search_rank(tsquery))
+        order = BY_RELEVANCE
+    query += f" ORDER BY {order} LIMIT %s OFFSET %s"
+    page_json = (await fetchrow(conn, *expenses_json_query(
+        query, params + [page_size, (page - 1) * page_size], page_size, order)))['expenses']
+
+    return Response(expenses_body(page_json, {
+        'total': total_count,
+        'page': page,
+        'pageSize': page_size,
+        'pages': (total_count + page_size - 1) // page_size
+    }), media_type='application/json')
+
+async def _get_expenses_page_by_cursor(conn, args, query, params, cursor, page_size):
+    total_count = None
+    if args.get('includeTotal', 'false').lower() == 'true':
+        total_count = (await fetchrow(conn, f"SELECT COUNT(*) FROM ({query}) AS filtered_expenses",
+                                      params))['count']
+
+    if cursor:
+        position = decode_cursor(cursor)
+        if position is None:
+            return render({'message': 'Invalid cursor'}, 400)
+        # The redundant date bound lets a partitioned expenses table prune partitions
+        query += " AND e.date <= %s AND (e.date, e.id) < (%s, %s)"
+        params = params + [position[0]] + list(position)
+
+    query += f" ORDER BY {NEWEST_FIRST} LIMIT %s"
+    rendered = await fetchrow(conn, *expenses_json_query(query, params + [page_size + 1], page_size,
+                                                         keyset=True))
+
+    pagination = next_cursor(rendered, page_size)
+    if total_count is not None:
+        pagination['total'] = total_count
+
+    return Response(expenses_body(rendered['expenses'], pagination), media_type='application/json')
+
+@with_cors
+@token_required
+@conditional(window=expense_window)
+async def get_expense_summary(request, conn, current_user):
+    user_id = current_user['id']
+    await ensure_catalog()
+    try:
+        filters = parse_expense_filters(MultiDict(request.query_params.multi_items()))
+    except FilterError as e:
+        return render({'message': str(e)}, 400)
+
+    date_filter, date_params = date_clause(filters['start'], filters['end'])
+    source, source_params = archive.source(user_id, filters['start'], filters['end'])
+    params = source_params + [user_id] + date_params
+
+    if rollups.is_day_aligned(filters['start'], filters['end']):
+        where, range_params = rollups.range_clause(filters['start'], filters['end'])
+        rows = await fetch(conn, f"""
+            SELECT r.category_id, SUM(r.total) AS amount, SUM(r.count) AS count
+            FROM expense_daily_rollups r
+            WHERE r.user_id = %s {where}
+            GROUP BY r.category_id
+        """, [user_id] + range_params)
+    else:
+        rows = await fetch(conn, f"""
+            SELECT e.category_id, SUM(e.amount) as amount, COUNT(*) as count
+            FROM {source}
+            WHERE e.user_id = %s {date_filter}
+            GROUP BY e.category_id
+        """, params)
+    totals = {row['category_id']: (row['amount'], row['count']) for row in rows}
+
+    total_amount, categories = summarize_categories(totals)
+
+    recent = await fetch(conn, f"""
+        SELECT {LISTED_COLUMNS}
+        FROM {source}
+        WHERE e.user_id = %s {date_filter}
+        ORDER BY e.date DESC, e.id DESC
+        LIMIT 5
+    """, params)
+
+    return render({
+        'total': float(total_amount),
+        'byCategory': categories,
+        'recentExpenses': [format_expense(catalog.attach(row)) for row in recent]
+    })
+
+@asynccontextmanager
+async def lifespan(app):
+    # Same database and pool sizing as the psycopg2 pool in db.py
+    kwargs = _connect_kwargs()
+    kwargs.pop('cursor_factory')
+    kwargs['port'] = int(kwargs['port'])
+    app.state.pool = await asyncpg.create_pool(
+        min_size=int(os.environ.get('DB_POOL_MIN', 1)),
+        max_size=int(os.environ.get('DB_POOL_MAX', 10)),
+        **kwargs
+    )
+    try:
+        yield
+    finally:
+        await app.state.pool.close()
+
+# The asyncpg pool only reaches the primary, so with shards configured every
+# route is served by Flask, which routes each user to their shard
+native_routes = [] if shards.enabled() else [
+    Route('/api/auth/profile', get_profile, methods=['GET']),
+    Route('/api/categories', get_categories, methods=['GET']),
+    Route('/api/expenses', get_expenses, methods=['GET']),
+    Route('/api/expenses/summary', get_expense_summary, methods=['GET']),
+]
+
+app = Starlette(
+    routes=native_routes + [
+        # Everything else, including writes and CORS preflights, is served by Flask
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan
+)
@@ -1,17 +1,43 @@
 
 from flask import Blueprint, request, jsonify, g
-import bcrypt
 import jwt
+import psycopg2
 import datetime
+import logging
 import os
+import select
+import threading
+import time
 import uuid
 from functools import wraps
-from db import get_db_connection
+from db import get_db_connection, get_global_connection, route_reads, use_shard, wrote_user, _connect_kwargs
+from cache import TTLCache
+from metrics import AUTH_DURATION
+from passwords import HashPoolBusy, hash_password, check_password, needs_rehash
+from shards import create_user, lookup_email, route_user
+
+logger = logging.getLogger(__name__)
 
 bp = Blueprint('auth', __name__, url_prefix='/api/auth')
 
 SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key')
 
+# Authenticated users keyed by user id (the token's 'sub' claim)
+_user_cache = TTLCache(
+    maxsize=int(os.environ.get('AUTH_USER_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('AUTH_USER_CACHE_TTL', 60))
+)
+# NOTIFY channel that drops a changed user from every worker's cache
+USER_CHANNEL = 'auth_user_changed'
+USER_CACHE_LISTEN = os.environ.get('AUTH_USER_CACHE_LISTEN', 'true').lower() == 'true'
+_listener_pid = None
+_listener_lock = threading.Lock()
+# Decoded payloads of tokens whose signature has already been verified
+_token_cache = TTLCache(
+    maxsize=int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('AUTH_TOKEN_CACHE_TTL', 300))
+)
+
 def generate_token(user_id, email):
     """Generate a JWT token for the user"""
     payload = {
@@ -22,6 +48,111 @@ def generate_token(user_id, email):
     }
     return jwt.encode(payload, SECRET_KEY, algorithm='HS256')
 
+def decode_token(token):
+    """Verify a JWT, skipping the signature check for recently verified tokens"""
+    payload = _token_cache.get(token)
+    if payload is not None:
+        if payload['exp'] > time.time():
+            return payload
+        _token_cache.pop(token)
+        raise jwt.ExpiredSignatureError('Signature has expired')
+
+    payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+    # Never keep a token cached past its own expiry
+    _token_cache.set(token, payload, ttl=min(_token_cache.ttl, payload['exp'] - time.time()))
+    return payload
+
+USER_QUERY = 'SELECT id, email, display_name, photo_url, created_at FROM users WHERE id = %s'
+
+def cached_user(user_id):
+    """Return a copy of the cached user row, or None on a miss"""
+    _ensure_listener()
+    user = _user_cache.get(user_id)
+    # Hand out a copy so request handlers cannot mutate the cached entry
+    return dict(user) if user is not None else None
+
+def remember_user(user_id, row):
+    """Cache a freshly loaded user row and return a copy of it"""
+    _user_cache.set(user_id, dict(row))
+    return dict(row)
+
+def load_user(user_id):
+    """Return the public user row for user_id, served from cache when possible"""
+    user = cached_user(user_id)
+    if user is None:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(USER_QUERY, (user_id,))
+        row = cur.fetchone()
+        cur.close()
+        if row is None:
+            return None
+        user = remember_user(user_id, row)
+    return user
+
+def invalidate_user(user_id):
+    """Drop a user from the cache after their row has been committed, on every worker"""
+    _user_cache.pop(user_id)
+    if not USER_CACHE_LISTEN:
+        return
+    # User rows live on shards; every listener is on the primary
+    conn = get_global_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT pg_notify(%s, %s)', (USER_CHANNEL, str(user_id)))
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.warning('Could not publish cache invalidation for user %s: %s', user_id, e)
+    finally:
+        cur.close()
+
+def _ensure_listener():
+    """Start the LISTEN thread for other workers' invalidations once per process"""
+    global _listener_pid
+    if not USER_CACHE_LISTEN or _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+    threading.Thread(target=_listen_for_invalidations, name='auth-user-cache-listener', daemon=True).start()
+
+def _listen_for_invalidations():
+    """Drop notified users from the cache; reconnect with backoff if the connection drops"""
+    backoff = 1
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**_connect_kwargs())
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(f'LISTEN {USER_CHANNEL}')
+            # Changes made while we were not listening are unknown
+            _user_cache.clear()
+            backoff = 1
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    _user_cache.pop(int(conn.notifies.pop(0).payload))
+        except Exception as e:
+            logger.warning('User cache listener failed: %s', e)
+            _user_cache.clear()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+        finally:
+            if conn is not None:
+                conn.close()
+
+def cache_stats():
+    """Hit/miss counters for the authentication caches"""
+    return {
+        'users': _user_cache.stats(),
+        'tokens': _token_cache.stats()
+    }
+
 def token_required(f):
     """Decorator to protect routes that require authentication"""
     @wraps(f)
@@ -39,17 +170,18 @@ def token_required(f):
         if not token:
             return jsonify({'message': 'Token is missing!'}), 401
         
+        started = time.perf_counter()
         try:
             # Verify the token
-            data = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+            data = decode_token(token)
+            
+            # Queries go to the user's shard; reads may be served by a replica
+            # unless this user just wrote
+            route_user(data['sub'])
+            route_reads(data['sub'])
             
             # Get current user
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute('SELECT id, email, display_name, photo_url, created_at FROM users WHERE id = %s', 
-                       (data['sub'],))
-            current_user = cur.fetchone()
-            cur.close()
+            current_user = load_user(data['sub'])
             
             if current_user is None:
                 return jsonify({'message': 'User not found!'}), 401
@@ -61,6 +193,8 @@ def token_required(f):
             return jsonify({'message': 'Token has expired!'}), 401
         except jwt.InvalidTokenError:
             return jsonify({'message': 'Invalid token!'}), 401
+        finally:
+            AUTH_DURATION.observe(time.perf_counter() - started, request.endpoint)
             
         return f(*args, **kwargs)
     return decorated
@@ -76,27 +210,18 @@ def register():
     password = data['password']
     display_name = data.get('displayName')
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Check if user already exists
-    cur.execute('SELECT * FROM users WHERE email = %s', (email,))
-    if cur.fetchone():
-        cur.close()
-        conn.close()
+    # Check if user already exists, on any shard
+    if lookup_email(email):
         return jsonify({'message': 'User already exists!'}), 409
     
-    # Hash the password
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    # Hash the password on the bounded hashing pool
+    hashed_password = hash_password(password)
     
-    # Insert the new user
+    # Insert the new user into the directory and their home shard
     try:
-        cur.execute(
-            'INSERT INTO users (email, password_hash, display_name) VALUES (%s, %s, %s) RETURNING id, email, display_name, photo_url, created_at',
-            (email, hashed_password.decode('utf-8'), display_name)
-        )
-        user = cur.fetchone()
-        conn.commit()
+        user = create_user(email, hashed_password, display_name)
+        # The token is used right away; keep the new user's reads off lagging replicas
+        wrote_user(user['id'])
         
         # Generate token
         token = generate_token(user['id'], user['email'])
@@ -106,11 +231,19 @@ def register():
             'user': user
         }), 201
     except Exception as e:
-        conn.rollback()
         return jsonify({'message': f'Database error: {str(e)}'}), 500
+
+def _rehash(conn, user_id, password):
+    """Store a hash at the current cost; best effort, login succeeds either way"""
+    cur = conn.cursor()
+    try:
+        cur.execute('UPDATE users SET password_hash = %s WHERE id = %s',
+                    (hash_password(password), user_id))
+        conn.commit()
+    except (HashPoolBusy, psycopg2.Error):
+        conn.rollback()
     finally:
         cur.close()
-        conn.close()
 
 @bp.route('/login', methods=['POST'])
 def login():
@@ -122,20 +255,27 @@ def login():
     email = data['email']
     password = data['password']
     
+    # Find user by email in the global directory, then load them from their shard
+    entry = lookup_email(email)
+    if not entry:
+        return jsonify({'message': 'Invalid credentials'}), 401
+    use_shard(entry['shard'])
+    
     conn = get_db_connection()
     cur = conn.cursor()
-    
-    # Find user by email
-    cur.execute('SELECT id, email, password_hash, display_name, photo_url, created_at FROM users WHERE email = %s', (email,))
+    cur.execute('SELECT id, email, password_hash, display_name, photo_url, created_at FROM users WHERE id = %s', (entry['user_id'],))
     user = cur.fetchone()
     cur.close()
-    conn.close()
     
     if not user:
         return jsonify({'message': 'Invalid credentials'}), 401
     
     # Check password
-    if bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8')):
+    if check_password(password, user['password_hash']):
+        # Upgrade hashes made with an older cost factor while we have the password
+        if needs_rehash(user['password_hash']):
+            _rehash(conn, user['id'], password)
+        
         # Generate token
         token = generate_token(user['id'], user['email'])
         
@@ -186,6 +326,7 @@ def update_profile():
         )
         updated_user = cur.fetchone()
         conn.commit()
+        invalidate_user(user_id)
         
         return jsonify({'user': updated_user})
     except Exception as e:
@@ -193,7 +334,6 @@ def update_profile():
         return jsonify({'message': f'Database error: {str(e)}'}), 500
     finally:
         cur.close()
-        conn.close()
 
 @bp.route('/change-password', methods=['POST'])
 @token_required
@@ -219,23 +359,26 @@ def change_password():
             return jsonify({'message': 'User not found'}), 404
         
         # Verify current password
-        if not bcrypt.checkpw(current_password.encode('utf-8'), user['password_hash'].encode('utf-8')):
+        if not check_password(current_password, user['password_hash']):
             return jsonify({'message': 'Current password is incorrect'}), 401
         
         # Hash the new password
-        new_password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+        new_password_hash = hash_password(new_password)
         
         # Update the password
         cur.execute(
             'UPDATE users SET password_hash = %s WHERE id = %s',
-            (new_password_hash.decode('utf-8'), user_id)
+            (new_password_hash, user_id)
         )
         
         conn.commit()
+        invalidate_user(user_id)
         return jsonify({'message': 'Password changed successfully'})
+    except HashPoolBusy:
+        conn.rollback()
+        raise
     except Exception as e:
         conn.rollback()
         return jsonify({'message': f'Database error: {str(e)}'}), 500
     finally:
         cur.close()
-        conn.close()
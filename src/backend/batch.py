@@ -0,0 +1,188 @@
+from flask import Blueprint, request, jsonify, g
+from psycopg2.extras import execute_values
+from db import get_db_connection
+from auth import token_required
+from versions import bump_user_version
+from expenses import format_expense
+from catalog import catalog
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+import rollups
+import archive
+
+bp = Blueprint('batch', __name__, url_prefix='/api/expenses')
+
+MAX_OPERATIONS = 500
+
+# Request field -> column for update operations, in the VALUES column order
+UPDATE_FIELDS = [
+    ('title', 'title', 'varchar'),
+    ('amount', 'amount', 'numeric'),
+    ('date', 'date', 'timestamp'),
+    ('categoryId', 'category_id', 'integer'),
+    ('notes', 'notes', 'text'),
+    ('receiptUrl', 'receipt_url', 'text'),
+]
+CATEGORY_POSITION = [key for key, _, _ in UPDATE_FIELDS].index('categoryId')
+
+RETURNING_COLUMNS = """e.id, e.user_id, e.title, e.amount, e.date, e.category_id,
+    e.notes, e.receipt_url, e.created_at, e.updated_at"""
+
+class OperationError(ValueError):
+    """Raised when a batch operation is malformed"""
+
+def parse_operation(op):
+    """Validate one operation; returns (kind, id, fields) with fields in UPDATE_FIELDS order"""
+    if not isinstance(op, dict):
+        raise OperationError('Operation must be an object')
+
+    kind = op.get('op')
+    try:
+        expense_id = int(op.get('id'))
+    except (TypeError, ValueError):
+        raise OperationError('Missing or invalid id')
+
+    if kind == 'delete':
+        return kind, expense_id, None
+    if kind == 'recategorize':
+        data = {'categoryId': op.get('categoryId')}
+        if data['categoryId'] is None:
+            raise OperationError('Missing required field: categoryId')
+    elif kind == 'update':
+        data = op.get('fields') or {}
+        if not isinstance(data, dict):
+            raise OperationError('fields must be an object')
+    else:
+        raise OperationError('op must be one of update, recategorize, delete')
+
+    fields = []
+    for key, _, _ in UPDATE_FIELDS:
+        value = data.get(key)
+        if value is not None:
+            try:
+                if key == 'amount':
+                    value = Decimal(str(value))
+                elif key == 'date':
+                    value = datetime.fromisoformat(str(value).replace('Z', '+00:00')).replace(tzinfo=None)
+                elif key == 'categoryId':
+                    value = int(value)
+            except (InvalidOperation, TypeError, ValueError):
+                raise OperationError(f'Invalid {key}: {value}')
+        fields.append(value)
+
+    if all(value is None for value in fields):
+        raise OperationError('No valid fields to update')
+    return kind, expense_id, fields
+
+@bp.route('/batch', methods=['POST'])
+@token_required
+def batch_expenses():
+    """Apply update/recategorize/delete operations in one transaction.
+
+    Ownership of every id is checked with one set-based query, so the number
+    of round trips does not depend on the number of operations.
+    """
+    user_id = g.current_user['id']
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'message': 'operations must be a non-empty list'}), 400
+    if len(operations) > MAX_OPERATIONS:
+        return jsonify({'message': f'At most {MAX_OPERATIONS} operations per batch'}), 400
+
+    results = [None] * len(operations)
+    parsed = {}   # index -> (kind, id, fields)
+    seen_ids = set()
+    for index, op in enumerate(operations):
+        try:
+            kind, expense_id, fields = parse_operation(op)
+        except OperationError as e:
+            results[index] = {'index': index, 'status': 'error', 'message': str(e)}
+            continue
+        if expense_id in seen_ids:
+            results[index] = {'index': index, 'id': expense_id, 'status': 'error',
+                              'message': 'Duplicate id in batch'}
+            continue
+        seen_ids.add(expense_id)
+        parsed[index] = (kind, expense_id, fields)
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+
+    try:
+        # Ownership check for every id at once; lock rows for exact rollup deltas
+        cur.execute(
+            "SELECT id, user_id, amount, date, category_id FROM expenses "
+            "WHERE user_id = %s AND id = ANY(%s) FOR UPDATE",
+            (user_id, list(seen_ids))
+        )
+        owned = {row['id']: row for row in cur.fetchall()}
+
+        known_categories = catalog.snapshot()['by_id']
+        missing = seen_ids - owned.keys()
+        archived = archive.archived_ids(cur, user_id, missing) if missing else set()
+
+        deletes = []
+        updates = []
+        for index, (kind, expense_id, fields) in parsed.items():
+            if expense_id in archived:
+                results[index] = {'index': index, 'id': expense_id, 'status': 'error',
+                                  'message': archive.ARCHIVED_MESSAGE}
+            elif expense_id not in owned:
+                results[index] = {'index': index, 'id': expense_id, 'status': 'error',
+                                  'message': 'Expense not found or access denied'}
+            elif fields and fields[CATEGORY_POSITION] is not None and fields[CATEGORY_POSITION] not in known_categories:
+                results[index] = {'index': index, 'id': expense_id, 'status': 'error',
+                                  'message': f'Unknown categoryId: {fields[CATEGORY_POSITION]}'}
+            elif kind == 'delete':
+                deletes.append((index, expense_id))
+            else:
+                updates.append((index, expense_id, fields))
+
+        removed = []
+        added = []
+
+        if deletes:
+            cur.execute(
+                "DELETE FROM expenses WHERE user_id = %s AND id = ANY(%s) "
+                "RETURNING id, user_id, amount, date, category_id",
+                (user_id, [expense_id for _, expense_id in deletes])
+            )
+            removed.extend(cur.fetchall())
+            for index, expense_id in deletes:
+                results[index] = {'index': index, 'id': expense_id, 'status': 'deleted'}
+
+        if updates:
+            columns = ', '.join(column for _, column, _ in UPDATE_FIELDS)
+            assignments = ', '.join(f'{column} = COALESCE(v.{column}, e.{column})'
+                                    for _, column, _ in UPDATE_FIELDS)
+            template = '(%s::integer, ' + ', '.join(f'%s::{sql_type}' for _, _, sql_type in UPDATE_FIELDS) + ')'
+            updated_rows = execute_values(cur, f"""
+                UPDATE expenses e SET {assignments}, updated_at = NOW()
+                FROM (VALUES %s) AS v(id, {columns})
+                WHERE e.id = v.id AND e.user_id = {int(user_id)}
+                RETURNING {RETURNING_COLUMNS}
+            """, [(expense_id, *fields) for _, expense_id, fields in updates],
+                template=template, page_size=len(updates), fetch=True)
+
+            removed.extend(owned[expense_id] for _, expense_id, _ in updates)
+            added.extend(updated_rows)
+
+            by_id = {row['id']: row for row in updated_rows}
+            for index, expense_id, _ in updates:
+                expense = catalog.attach(by_id[expense_id])
+                results[index] = {'index': index, 'id': expense_id, 'status': 'updated',
+                                  'expense': format_expense(expense)}
+
+        if removed or added:
+            rollups.record(cur, added=added, removed=removed)
+            bump_user_version(cur, user_id)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'message': f'Database error: {str(e)}'}), 500
+    finally:
+        cur.close()
+
+    return jsonify({'results': results})
@@ -0,0 +1,114 @@
+"""Compare the WSGI (Flask) and ASGI (asgi.py) serving modes under the same load.
+
+Start both servers against the same database, e.g.
+
+    gunicorn -w 4 --threads 8 -b :5001 app:app
+    uvicorn asgi:app --workers 4 --port 5002
+
+then drive the hot read routes through each at a fixed concurrency:
+
+    python -m bench.compare_modes --email me@example.com --password secret \\
+        --concurrency 64 --requests 5000 --output compare.json
+
+Before measuring, every path is fetched from both servers and the bodies are
+compared, so a shape difference fails the run instead of skewing it.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import httpx
+
+PATHS = [
+    '/api/expenses?timeFilter=this-year',
+    '/api/expenses?timeFilter=this-year&pagination=cursor&pageSize=20',
+    '/api/expenses?timeFilter=custom&startDate=2024-01-01&endDate=2024-12-31&minAmount=20',
+    '/api/expenses/summary?timeFilter=current-month',
+    '/api/expenses/summary?timeFilter=custom&startDate=2024-01-01T12:00:00',
+    '/api/categories',
+    '/api/auth/profile',
+]
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+async def login(client, email, password):
+    response = await client.post('/api/auth/login', json={'email': email, 'password': password})
+    response.raise_for_status()
+    return response.json()['token']
+
+async def check_shapes(wsgi, asgi):
+    """Return the paths whose bodies differ between the two modes"""
+    mismatched = []
+    for path in PATHS:
+        left, right = await asyncio.gather(wsgi.get(path), asgi.get(path))
+        if left.status_code != right.status_code or left.json() != right.json():
+            mismatched.append(path)
+    return mismatched
+
+async def run(client, total, concurrency):
+    """Issue `total` GETs round-robin over PATHS with `concurrency` in flight"""
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for n in counter:
+            started = time.perf_counter()
+            response = await client.get(PATHS[n % len(PATHS)])
+            latencies.append((time.perf_counter() - started) * 1000)
+            errors += response.status_code >= 400
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        'requests': total,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'throughput': round(total / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+    }
+
+async def main_async(args):
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.wsgi_url, limits=limits) as wsgi, \
+               httpx.AsyncClient(base_url=args.asgi_url, limits=limits) as asgi:
+        token = await login(wsgi, args.email, args.password)
+        for client in (wsgi, asgi):
+            client.headers['Authorization'] = f'Bearer {token}'
+
+        mismatched = await check_shapes(wsgi, asgi)
+        if mismatched:
+            print(json.dumps({'mismatched': mismatched}))
+            return 1
+
+        results = {'concurrency': args.concurrency}
+        for name, client in (('wsgi', wsgi), ('asgi', asgi)):
+            await run(client, min(args.requests, args.concurrency * 4), args.concurrency)  # warm up
+            results[name] = await run(client, args.requests, args.concurrency)
+            print(json.dumps({name: results[name]}))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--wsgi-url', default='http://localhost:5001')
+    parser.add_argument('--asgi-url', default='http://localhost:5002')
+    parser.add_argument('--email', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--output', default='compare_modes.json')
+    sys.exit(asyncio.run(main_async(parser.parse_args())))
+
+if __name__ == '__main__':
+    main()
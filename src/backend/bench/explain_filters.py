@@ -0,0 +1,108 @@
+"""Check that the compiled expense filters are answered with index scans.
+
+Seeds a synthetic user with a few million expenses (once), then runs
+EXPLAIN (ANALYZE, FORMAT JSON) on the list and summary queries for every
+time filter and fails if any plan falls back to a sequential scan.
+
+    python -m bench.explain_filters --rows 3000000
+"""
+import argparse
+import json
+import sys
+from werkzeug.datastructures import MultiDict
+import psycopg2
+from db import _connect_kwargs
+from filters import parse_expense_filters, build_expense_where, date_clause
+
+BENCH_EMAIL = 'bench-filters@example.com'
+
+SCENARIOS = [
+    {'timeFilter': 'current-month'},
+    {'timeFilter': 'last-month'},
+    {'timeFilter': 'this-year'},
+    {'timeFilter': 'custom', 'startDate': '2021-03-01', 'endDate': '2021-03-31'},
+    {'timeFilter': 'current-month', 'minAmount': '50'},
+]
+
+def seed(conn, rows):
+    """Create the benchmark user and its expenses if they are not there yet"""
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO users (email, password_hash) VALUES (%s, 'x') "
+        "ON CONFLICT (email) DO UPDATE SET email = EXCLUDED.email RETURNING id",
+        (BENCH_EMAIL,)
+    )
+    user_id = cur.fetchone()['id']
+    cur.execute('SELECT COUNT(*) FROM expenses WHERE user_id = %s', (user_id,))
+    existing = cur.fetchone()['count']
+    if existing < rows:
+        print(f'Seeding {rows - existing} expenses for user {user_id}...')
+        # Spread rows evenly over the last ten years
+        cur.execute("""
+            WITH cats AS (SELECT array_agg(id) AS ids FROM categories)
+            INSERT INTO expenses (user_id, title, amount, date, category_id)
+            SELECT %s, 'Expense ' || n, (random() * 200)::numeric(10, 2),
+                   CURRENT_DATE - (random() * 3650)::int * INTERVAL '1 day',
+                   cats.ids[1 + n %% array_length(cats.ids, 1)]
+            FROM generate_series(1, %s) AS n, cats
+        """, (user_id, rows - existing))
+    conn.commit()
+    cur.execute('ANALYZE expenses')
+    conn.commit()
+    cur.close()
+    return user_id
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+def explain(cur, query, params):
+    cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query, params)
+    return cur.fetchone()['QUERY PLAN'][0]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=3_000_000)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**_connect_kwargs())
+    user_id = seed(conn, args.rows)
+    cur = conn.cursor()
+    failures = 0
+
+    for scenario in SCENARIOS:
+        filters = parse_expense_filters(MultiDict(scenario))
+        where, where_params = build_expense_where(filters)
+        date_filter, date_params = date_clause(filters['start'], filters['end'])
+        queries = {
+            'list': (
+                'SELECT e.* FROM expenses e WHERE e.user_id = %s' + where +
+                ' ORDER BY e.date DESC, e.id DESC LIMIT 10',
+                [user_id] + where_params
+            ),
+            'summary': (
+                'SELECT e.category_id, SUM(e.amount) FROM expenses e WHERE e.user_id = %s' +
+                date_filter + ' GROUP BY e.category_id',
+                [user_id] + date_params
+            ),
+        }
+        for name, (query, params) in queries.items():
+            plan = explain(cur, query, params)
+            node_types = {node['Node Type'] for node in plan_nodes(plan['Plan'])}
+            ok = 'Seq Scan' not in node_types
+            failures += not ok
+            print(json.dumps({
+                'scenario': scenario,
+                'query': name,
+                'ok': ok,
+                'execution_ms': plan['Execution Time'],
+                'nodes': sorted(node_types),
+            }))
+
+    cur.close()
+    conn.close()
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""Seed a synthetic population and drive a realistic request mix against a running server.
+
+    python -m bench.load_test seed --users 200 --years 5 --per-day 3
+    python -m bench.load_test run --url http://localhost:5001 --concurrency 32 \\
+        --duration 60 --output load.json
+
+Seeding is idempotent and deterministic for a given --seed: users that already
+exist are left alone. Category popularity is skewed so a few categories hold
+most of the spend. The run writes throughput and p50/p95/p99 latency per
+scenario to --output so results can be diffed between commits.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import subprocess
+import sys
+import time
+from datetime import date, timedelta
+import bcrypt
+import httpx
+import psycopg2
+import passwords
+import rollups
+from bench.compare_modes import percentile
+from db import _connect_kwargs
+
+EMAIL_TEMPLATE = 'load-{}@example.com'
+PASSWORD = 'load-test-password'
+
+TITLE_WORDS = ['Coffee', 'Groceries', 'Lunch', 'Dinner', 'Taxi', 'Train', 'Books', 'Cinema',
+               'Pharmacy', 'Rent', 'Electricity', 'Internet', 'Gym', 'Fuel', 'Parking']
+
+# (scenario, weight); weights are relative
+MIX = [
+    ('login', 2),
+    ('list', 30),
+    ('list_filtered', 12),
+    ('list_search', 10),
+    ('list_deep_page', 5),
+    ('list_cursor', 6),
+    ('summary', 20),
+    ('create', 7),
+    ('update', 5),
+    ('delete', 3),
+]
+
+def seed(args):
+    conn = psycopg2.connect(**_connect_kwargs())
+    cur = conn.cursor()
+    cur.execute('SELECT setseed(%s)', (args.seed / 2 ** 31,))
+    # One hash shared by every synthetic user, at the configured cost so logins do not rehash
+    password_hash = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(passwords.ROUNDS)).decode('utf-8')
+    days = args.years * 365
+
+    for n in range(args.users):
+        email = EMAIL_TEMPLATE.format(n)
+        cur.execute('SELECT id FROM users WHERE email = %s', (email,))
+        if cur.fetchone():
+            continue
+        cur.execute(
+            'INSERT INTO users (email, password_hash, display_name) VALUES (%s, %s, %s) RETURNING id',
+            (email, password_hash, f'Load {n}')
+        )
+        user_id = cur.fetchone()['id']
+        # Logins resolve users through the directory; "flask shards rebalance" spreads them later
+        cur.execute('INSERT INTO user_directory (user_id, email, shard) VALUES (%s, %s, 0)',
+                    (user_id, email))
+        # power(random(), 3) skews category picks towards the first categories
+        cur.execute("""
+            WITH cats AS (SELECT array_agg(id ORDER BY id) AS ids FROM categories)
+            INSERT INTO expenses (user_id, title, amount, date, category_id, notes)
+            SELECT %s,
+                   (%s::text[])[1 + floor(random() * %s)::int] || ' ' || n,
+                   round((1 + power(random(), 2) * 250)::numeric, 2),
+                   CURRENT_DATE - floor(random() * %s)::int * INTERVAL '1 day'
+                       + floor(random() * 86400)::int * INTERVAL '1 second',
+                   cats.ids[1 + floor(power(random(), 3) * array_length(cats.ids, 1))::int],
+                   CASE WHEN random() < 0.2 THEN 'seeded note ' || n END
+            FROM generate_series(1, %s) AS n, cats
+        """, (user_id, TITLE_WORDS, len(TITLE_WORDS), days, days * args.per_day))
+        rollups.rebuild(conn, user_id)
+        conn.commit()
+        print(f'Seeded {email}')
+
+    cur.execute('ANALYZE expenses')
+    conn.commit()
+    cur.close()
+    conn.close()
+
+class VirtualUser:
+    """One logged-in client issuing weighted random requests"""
+
+    def __init__(self, client, email, rng, stats):
+        self.client = client
+        self.email = email
+        self.rng = rng
+        self.stats = stats
+        self.headers = {}
+        self.created = []
+
+    async def call(self, scenario, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, headers=self.headers, **kwargs)
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            response, ok = None, False
+        elapsed = (time.perf_counter() - started) * 1000
+        entry = self.stats.setdefault(scenario, {'latencies': [], 'errors': 0})
+        entry['latencies'].append(elapsed)
+        entry['errors'] += not ok
+        return response if ok else None
+
+    async def login(self):
+        response = await self.call('login', 'POST', '/api/auth/login',
+                                   json={'email': self.email, 'password': PASSWORD})
+        if response is not None:
+            self.headers = {'Authorization': f"Bearer {response.json()['token']}"}
+
+    def random_day(self, years):
+        return date.today() - timedelta(days=self.rng.randrange(years * 365))
+
+    async def step(self, scenario, years):
+        rng = self.rng
+        if scenario == 'login':
+            await self.login()
+        elif scenario == 'list':
+            await self.call(scenario, 'GET', '/api/expenses',
+                            params={'timeFilter': rng.choice(['current-month', 'last-month', 'this-year'])})
+        elif scenario == 'list_filtered':
+            await self.call(scenario, 'GET', '/api/expenses', params={
+                'timeFilter': 'this-year',
+                'minAmount': rng.choice(['10', '50', '100']),
+                'categories': rng.sample(self.categories, min(2, len(self.categories))),
+            })
+        elif scenario == 'list_search':
+            await self.call(scenario, 'GET', '/api/expenses', params={
+                'timeFilter': 'custom',
+                'startDate': self.random_day(years).isoformat(),
+                'searchQuery': rng.choice(TITLE_WORDS)[:rng.randint(3, 6)].lower(),
+            })
+        elif scenario == 'list_deep_page':
+            await self.call(scenario, 'GET', '/api/expenses', params={
+                'timeFilter': 'custom',
+                'startDate': (date.today() - timedelta(days=years * 365)).isoformat(),
+                'page': rng.randint(20, 200),
+                'pageSize': 20,
+            })
+        elif scenario == 'list_cursor':
+            params = {'timeFilter': 'this-year', 'pagination': 'cursor', 'pageSize': 20}
+            for _ in range(rng.randint(1, 5)):
+                response = await self.call(scenario, 'GET', '/api/expenses', params=params)
+                cursor = response and response.json()['pagination']['nextCursor']
+                if not cursor:
+                    break
+                params['cursor'] = cursor
+        elif scenario == 'summary':
+            await self.call(scenario, 'GET', '/api/expenses/summary',
+                            params={'timeFilter': rng.choice(['current-month', 'last-month', 'this-year'])})
+        elif scenario == 'create':
+            response = await self.call(scenario, 'POST', '/api/expenses', json={
+                'title': f'{rng.choice(TITLE_WORDS)} load',
+                'amount': round(rng.uniform(1, 200), 2),
+                'date': self.random_day(1).isoformat(),
+                'categoryId': rng.choice(self.category_ids),
+            })
+            if response is not None:
+                self.created.append(response.json()['id'])
+        elif scenario == 'update' and self.created:
+            await self.call(scenario, 'PUT', f'/api/expenses/{rng.choice(self.created)}',
+                            json={'amount': round(rng.uniform(1, 200), 2)})
+        elif scenario == 'delete' and self.created:
+            expense_id = self.created.pop(rng.randrange(len(self.created)))
+            await self.call(scenario, 'DELETE', f'/api/expenses/{expense_id}')
+
+    async def run(self, deadline, budget, years):
+        await self.login()
+        response = await self.call('categories', 'GET', '/api/categories')
+        categories = response.json()['categories'] if response is not None else []
+        self.categories = [row['name'] for row in categories]
+        self.category_ids = [row['id'] for row in categories]
+
+        names = [name for name, _ in MIX]
+        weights = [weight for _, weight in MIX]
+        while time.monotonic() < deadline and next(budget, None) is not None:
+            await self.step(self.rng.choices(names, weights)[0], years)
+
+def summarize(stats, elapsed):
+    endpoints = {}
+    for scenario, entry in sorted(stats.items()):
+        latencies = entry['latencies']
+        endpoints[scenario] = {
+            'requests': len(latencies),
+            'errors': entry['errors'],
+            'throughput': round(len(latencies) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+        }
+    total = sum(entry['requests'] for entry in endpoints.values())
+    return endpoints, {'requests': total, 'throughput': round(total / elapsed, 2)}
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run_async(args):
+    stats = {}
+    budget = iter(range(args.requests)) if args.requests else itertools.count()
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=30) as client:
+        users = [
+            VirtualUser(client, EMAIL_TEMPLATE.format(n % args.users), random.Random(args.seed + n), stats)
+            for n in range(args.concurrency)
+        ]
+        started = time.perf_counter()
+        deadline = time.monotonic() + args.duration
+        await asyncio.gather(*(user.run(deadline, budget, args.years) for user in users))
+        elapsed = time.perf_counter() - started
+
+    endpoints, total = summarize(stats, elapsed)
+    return {
+        'revision': git_revision(),
+        'url': args.url,
+        'concurrency': args.concurrency,
+        'seconds': round(elapsed, 3),
+        'seed': args.seed,
+        'total': total,
+        'endpoints': endpoints,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--years', type=int, default=3)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help='create synthetic users and expenses')
+    seed_parser.add_argument('--per-day', type=int, default=3, help='expenses per user per day')
+
+    run_parser = commands.add_parser('run', help='drive the request mix against a server')
+    run_parser.add_argument('--url', default='http://localhost:5001')
+    run_parser.add_argument('--concurrency', type=int, default=16)
+    run_parser.add_argument('--duration', type=float, default=30, help='seconds')
+    run_parser.add_argument('--requests', type=int, default=0, help='stop after N scenarios (0 = no limit)')
+    run_parser.add_argument('--output', default='load_test.json')
+
+    args = parser.parse_args()
+    if args.command == 'seed':
+        seed(args)
+        return
+
+    results = asyncio.run(run_async(args))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results['total']))
+    sys.exit(1 if any(entry['errors'] for entry in results['endpoints'].values()) else 0)
+
+if __name__ == '__main__':
+    main()
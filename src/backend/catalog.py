@@ -0,0 +1,148 @@
+import logging
+import os
+import select
+import threading
+import time
+import psycopg2
+from flask import has_app_context
+from db import get_db_connection, get_pool, on_primary, _connect_kwargs
+
+logger = logging.getLogger(__name__)
+
+# NOTIFY channel the category write routes signal on
+CHANNEL = 'category_catalog'
+# Upper bound on staleness if a notification is ever missed
+TTL = float(os.environ.get('CATEGORY_CACHE_TTL', 300))
+LISTEN_ENABLED = os.environ.get('CATEGORY_CACHE_LISTEN', 'true').lower() == 'true'
+
+class CategoryCatalog:
+    """In-process copy of the categories table.
+
+    Every invalidation bumps ``generation``; a snapshot loaded under an older
+    generation is reloaded on next use. Category writes invalidate the local
+    copy directly and other worker processes through LISTEN/NOTIFY.
+    """
+
+    def __init__(self, ttl=TTL):
+        self.ttl = ttl
+        self.generation = 0
+        self.reloads = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._listener_pid = None
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+
+    def _load(self):
+        def fetch(conn):
+            cur = conn.cursor()
+            cur.execute('SELECT id, name, color FROM categories ORDER BY name')
+            rows = [dict(row) for row in cur.fetchall()]
+            cur.close()
+            return rows
+
+        # Reuse the request's connection rather than checking out a second one,
+        # unless it is a replica (a reload triggered by NOTIFY must see the
+        # write) or a shard, which only holds a copy
+        if has_app_context() and on_primary():
+            rows = fetch(get_db_connection())
+        else:
+            with get_pool().connection() as conn:
+                rows = fetch(conn)
+        return {
+            'ordered': rows,
+            'by_id': {row['id']: row for row in rows},
+            'by_name': {row['name']: row for row in rows},
+        }
+
+    def is_fresh(self):
+        """True when snapshot() can answer without querying the database"""
+        snapshot = self._snapshot
+        return (snapshot is not None and snapshot['generation'] == self.generation
+                and time.monotonic() - snapshot['loaded_at'] < self.ttl)
+
+    def snapshot(self):
+        """Return the current catalog, reloading it if invalidated or expired"""
+        self._ensure_listener()
+        if self.is_fresh():
+            return self._snapshot
+
+        with self._lock:
+            generation = self.generation
+        data = self._load()
+        data['generation'] = generation
+        data['loaded_at'] = time.monotonic()
+        with self._lock:
+            self.reloads += 1
+            # Keep the snapshot only if nothing invalidated it while loading
+            if generation == self.generation:
+                self._snapshot = data
+        return data
+
+    def all(self):
+        return self.snapshot()['ordered']
+
+    def get(self, category_id):
+        return self.snapshot()['by_id'].get(category_id)
+
+    def ids_for_names(self, names):
+        by_name = self.snapshot()['by_name']
+        return [by_name[name]['id'] for name in names if name in by_name]
+
+    def attach(self, row):
+        """Set category_name/category_color on an expense row from the catalog"""
+        category = self.get(row.get('category_id')) if row.get('category_id') else None
+        row['category_name'] = category['name'] if category else None
+        row['category_color'] = category['color'] if category else None
+        return row
+
+    def stats(self):
+        return {'generation': self.generation, 'reloads': self.reloads}
+
+    def _ensure_listener(self):
+        """Start the LISTEN thread once per process"""
+        if not LISTEN_ENABLED or self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+        thread = threading.Thread(target=self._listen, name='category-catalog-listener', daemon=True)
+        thread.start()
+
+    def _listen(self):
+        """Invalidate on every NOTIFY; reconnect with backoff if the connection drops"""
+        backoff = 1
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**_connect_kwargs())
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f'LISTEN {CHANNEL}')
+                # Changes made while we were not listening are unknown
+                self.invalidate()
+                backoff = 1
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        self.invalidate()
+            except Exception as e:
+                logger.warning('Category catalog listener failed: %s', e)
+                self.invalidate()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+catalog = CategoryCatalog()
+
+def notify_changed(cur):
+    """Tell every worker to reload the catalog once the current transaction commits"""
+    cur.execute(f'NOTIFY {CHANNEL}')
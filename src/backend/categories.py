@@ -1,23 +1,18 @@
 
 from flask import Blueprint, request, jsonify, g
-from db import get_db_connection
+from db import get_global_connection
 from auth import token_required
+from versions import conditional, bump_catalog_version
+from catalog import catalog, notify_changed
+from shards import category_in_use_on_shards, replicate_categories
 
 bp = Blueprint('categories', __name__, url_prefix='/api/categories')
 
 @bp.route('', methods=['GET'])
 @token_required
+@conditional
 def get_categories():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute('SELECT id, name, color FROM categories ORDER BY name')
-    categories = cur.fetchall()
-    
-    cur.close()
-    conn.close()
-    
-    return jsonify({'categories': categories})
+    return jsonify({'categories': catalog.all()})
 
 @bp.route('', methods=['POST'])
 @token_required
@@ -30,7 +25,7 @@ def create_category():
     name = data['name']
     color = data['color']
     
-    conn = get_db_connection()
+    conn = get_global_connection()
     cur = conn.cursor()
     
     try:
@@ -46,7 +41,11 @@ def create_category():
         )
         
         new_category = cur.fetchone()
+        bump_catalog_version(cur)
+        notify_changed(cur)
         conn.commit()
+        catalog.invalidate()
+        replicate_categories()
         
         return jsonify(new_category), 201
     except Exception as e:
@@ -54,7 +53,6 @@ def create_category():
         return jsonify({'message': f'Database error: {str(e)}'}), 500
     finally:
         cur.close()
-        conn.close()
 
 @bp.route('/<int:category_id>', methods=['PUT'])
 @token_required
@@ -64,7 +62,7 @@ def update_category(category_id):
     if not data or (not data.get('name') and not data.get('color')):
         return jsonify({'message': 'Missing fields to update'}), 400
     
-    conn = get_db_connection()
+    conn = get_global_connection()
     cur = conn.cursor()
     
     try:
@@ -102,7 +100,11 @@ def update_category(category_id):
         )
         
         updated_category = cur.fetchone()
+        bump_catalog_version(cur)
+        notify_changed(cur)
         conn.commit()
+        catalog.invalidate()
+        replicate_categories()
         
         return jsonify(updated_category)
     except Exception as e:
@@ -110,12 +112,11 @@ def update_category(category_id):
         return jsonify({'message': f'Database error: {str(e)}'}), 500
     finally:
         cur.close()
-        conn.close()
 
 @bp.route('/<int:category_id>', methods=['DELETE'])
 @token_required
 def delete_category(category_id):
-    conn = get_db_connection()
+    conn = get_global_connection()
     cur = conn.cursor()
     
     try:
@@ -124,14 +125,21 @@ def delete_category(category_id):
         if not cur.fetchone():
             return jsonify({'message': 'Category not found'}), 404
         
-        # Check if category is being used
-        cur.execute('SELECT COUNT(*) FROM expenses WHERE category_id = %s', (category_id,))
-        if cur.fetchone()['count'] > 0:
+        # Check if category is being used, including by archived expenses
+        cur.execute("""
+            SELECT EXISTS (SELECT 1 FROM expenses WHERE category_id = %s)
+                OR EXISTS (SELECT 1 FROM expenses_archive WHERE category_ids @> ARRAY[%s]) AS used
+        """, (category_id, category_id))
+        if cur.fetchone()['used'] or category_in_use_on_shards(category_id):
             return jsonify({'message': 'Cannot delete category that is being used by expenses'}), 400
         
         # Delete category
         cur.execute('DELETE FROM categories WHERE id = %s', (category_id,))
+        bump_catalog_version(cur)
+        notify_changed(cur)
         conn.commit()
+        catalog.invalidate()
+        replicate_categories()
         
         return jsonify({'message': 'Category deleted successfully'})
     except Exception as e:
@@ -139,4 +147,3 @@ def delete_category(category_id):
         return jsonify({'message': f'Database error: {str(e)}'}), 500
     finally:
         cur.close()
-        conn.close()
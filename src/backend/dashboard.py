@@ -0,0 +1,103 @@
+from flask import Blueprint, request, jsonify, g
+from db import get_db_connection
+from auth import token_required
+from versions import conditional
+from filters import FilterError, parse_expense_filters, expense_window, date_clause
+from expenses import LISTED_COLUMNS, format_expense, page_args, summarize_categories
+from catalog import catalog
+from decimal import Decimal
+import archive
+
+bp = Blueprint('dashboard', __name__, url_prefix='/api/dashboard')
+
+RECENT_COUNT = 5
+
+@bp.route('', methods=['GET'])
+@token_required
+@conditional(window=expense_window)
+def get_dashboard():
+    """Categories, summary totals, breakdown and first page of expenses in one response.
+
+    Everything comes from a single statement: the user's rows in range are
+    scanned once into a CTE that feeds both the GROUPING SETS aggregate (per
+    category plus grand total) and the first page.
+    """
+    user_id = g.current_user['id']
+
+    try:
+        filters = parse_expense_filters(request.args)
+        _, page_size = page_args(request.args)
+    except FilterError as e:
+        return jsonify({'message': str(e)}), 400
+
+    date_filter, date_params = date_clause(filters['start'], filters['end'])
+    source, source_params = archive.source(user_id, filters['start'], filters['end'])
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+
+    cur.execute(
+        f"""
+        WITH filtered AS MATERIALIZED (
+            SELECT {LISTED_COLUMNS}
+            FROM {source}
+            WHERE e.user_id = %s {date_filter}
+        ),
+        totals AS (
+            SELECT json_agg(t) AS data
+            FROM (
+                SELECT category_id,
+                       GROUPING(category_id) = 1 AS is_total,
+                       COALESCE(SUM(amount), 0)::text AS amount,
+                       COUNT(*) AS count
+                FROM filtered
+                GROUP BY GROUPING SETS ((category_id), ())
+            ) t
+        ),
+        page AS (
+            SELECT * FROM filtered
+            ORDER BY date DESC, id DESC
+            LIMIT %s
+        )
+        SELECT page.*, totals.data AS totals
+        FROM totals
+        LEFT JOIN page ON TRUE
+        ORDER BY page.date DESC, page.id DESC
+        """,
+        source_params + [user_id] + date_params + [max(page_size, RECENT_COUNT)]
+    )
+    rows = cur.fetchall()
+    cur.close()
+
+    totals = {}
+    total_count = 0
+    for bucket in rows[0]['totals']:
+        if bucket['is_total']:
+            total_count = bucket['count']
+        else:
+            totals[bucket['category_id']] = (Decimal(bucket['amount']), bucket['count'])
+
+    # The LEFT JOIN yields a single all-NULL page row when nothing matched
+    expenses = []
+    for row in rows:
+        if row['id'] is None:
+            continue
+        row = dict(row)
+        row.pop('totals')
+        expenses.append(format_expense(catalog.attach(row)))
+
+    total_amount, by_category = summarize_categories(totals)
+
+    return jsonify({
+        'categories': catalog.all(),
+        'total': float(total_amount),
+        'byCategory': by_category,
+        'recentExpenses': expenses[:RECENT_COUNT],
+        'expenses': expenses[:page_size],
+        'pagination': {
+            'total': total_count,
+            'page': 1,
+            'pageSize': page_size,
+            'pages': (total_count + page_size - 1) // page_size
+        }
+    })
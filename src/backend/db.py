@@ -1,132 +1,381 @@
+import itertools
+import logging
 import os
+import select
+import threading
+import time
 import psycopg2
-from psycopg2.extras import RealDictCursor
-import click
-from flask import g, current_app
-from flask.cli import with_appcontext
+from flask import g, current_app, request
+from pool import ConnectionPool, PoolTimeout
+from metrics import InstrumentedCursor, POOL_WAIT
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+# Further databases holding users' data, as "host[:port][/dbname]". Shard 0
+# is the primary above, which also keeps the user directory and the master
+# copy of categories (see shards.py).
+SHARD_ADDRESSES = [entry.strip() for entry in os.environ.get('DB_SHARDS', '').split(',') if entry.strip()]
+_shard_pools = {}
+
+# Streaming replicas that serve GET requests, as "host[:port]" pairs sharing
+# the primary's database, user and password
+REPLICA_HOSTS = [entry.strip() for entry in os.environ.get('DB_REPLICAS', '').split(',') if entry.strip()]
+# Replicas further behind than this many seconds are skipped
+REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 2))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 5))
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get('DB_REPLICA_CONNECT_TIMEOUT', 2))
+# A user's reads stay on the primary this long after one of their writes
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('DB_READ_YOUR_WRITES_SECONDS', 5))
+# NOTIFY channel that spreads read-your-writes windows to every worker
+WRITES_CHANNEL = 'user_writes'
+
+def _connect_kwargs():
+    """Build psycopg2 connection parameters from environment variables"""
+    return {
+        'host': os.environ.get('DB_HOST', 'localhost'),
+        'database': os.environ.get('DB_NAME', 'expense_tracker'),
+        'user': os.environ.get('DB_USER', 'postgres'),
+        'password': os.environ.get('DB_PASSWORD', 'admin123'),
+        'port': os.environ.get('DB_PORT', '5432'),
+        # RealDictCursor that also records query timings for /api/metrics
+        'cursor_factory': InstrumentedCursor
+    }
+
+def _new_pool(minconn, **connect_kwargs):
+    return ConnectionPool(
+        minconn=minconn,
+        maxconn=int(os.environ.get('DB_POOL_MAX', 10)),
+        timeout=float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+        check_interval=float(os.environ.get('DB_POOL_CHECK_INTERVAL', 30)),
+        on_checkout=POOL_WAIT.observe,
+        **connect_kwargs
+    )
+
+def get_pool():
+    """Return the connection pool for this process, creating it on first use"""
+    global _pool, _pool_pid
+    # A pool inherited across fork() shares sockets with the parent; build a new one
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = _new_pool(int(os.environ.get('DB_POOL_MIN', 1)), **_connect_kwargs())
+                _pool_pid = os.getpid()
+    return _pool
+
+def shard_count():
+    return 1 + len(SHARD_ADDRESSES)
+
+def get_shard_pool(shard):
+    """Return this process's pool for a shard; shard 0 is the primary pool"""
+    if shard == 0:
+        return get_pool()
+    entry = _shard_pools.get(shard)
+    if entry is None or entry[1] != os.getpid():
+        with _pool_lock:
+            entry = _shard_pools.get(shard)
+            if entry is None or entry[1] != os.getpid():
+                address, _, database = SHARD_ADDRESSES[shard - 1].partition('/')
+                host, _, port = address.partition(':')
+                kwargs = dict(_connect_kwargs(), host=host, port=port or '5432')
+                if database:
+                    kwargs['database'] = database
+                entry = (_new_pool(int(os.environ.get('DB_POOL_MIN', 1)), **kwargs), os.getpid())
+                _shard_pools[shard] = entry
+    return entry[0]
+
+def each_shard():
+    """Yield (shard, pool) for every database holding user data, primary first"""
+    for shard in range(shard_count()):
+        yield shard, get_shard_pool(shard)
+
+def pool_stats():
+    """Return statistics for this process's pool, or None if it was never created"""
+    if _pool is None or _pool_pid != os.getpid():
+        return None
+    return _pool.stats()
+
+class Replica:
+    """One streaming replica with its own pool and a periodically refreshed health check.
+
+    The check runs on the request thread that finds it due; other threads keep
+    using the last result meanwhile. A replica is usable while it is in
+    recovery and has replayed everything it received, or lags by no more than
+    REPLICA_MAX_LAG seconds.
+    """
+
+    def __init__(self, address):
+        host, _, port = address.partition(':')
+        self.name = address
+        self._connect_kwargs = dict(_connect_kwargs(), host=host, port=port or '5432',
+                                    connect_timeout=REPLICA_CONNECT_TIMEOUT)
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        self._checking = False
+        self.healthy = False
+        self.lag = None
+        self.error = None
+        self.checked_at = None
+        self.reads = 0
+        self.failures = 0
+
+    def pool(self):
+        if self._pool is None or self._pool_pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pool_pid != os.getpid():
+                    # No connections up front, so a replica that is down cannot stop a worker starting
+                    self._pool = _new_pool(0, **self._connect_kwargs)
+                    self._pool_pid = os.getpid()
+        return self._pool
+
+    def available(self):
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= REPLICA_CHECK_INTERVAL:
+            with self._lock:
+                due = not self._checking
+                self._checking = True
+            if due:
+                try:
+                    self.check()
+                finally:
+                    self._checking = False
+        return self.healthy
+
+    def check(self):
+        try:
+            with self.pool().connection(timeout=REPLICA_CONNECT_TIMEOUT) as conn:
+                cur = conn.cursor()
+                cur.execute("""
+                    SELECT pg_is_in_recovery() AS standby,
+                           CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                           END AS lag
+                """)
+                row = cur.fetchone()
+                cur.close()
+                conn.rollback()
+            self.lag = float(row['lag']) if row['lag'] is not None else None
+            if not row['standby']:
+                self.healthy, self.error = False, 'not in recovery'
+            elif self.lag is None or self.lag > REPLICA_MAX_LAG:
+                self.healthy, self.error = False, 'lagging'
+            else:
+                self.healthy, self.error = True, None
+        except (psycopg2.Error, PoolTimeout) as e:
+            self.mark_down(e)
+        self.checked_at = time.monotonic()
+
+    def mark_down(self, error):
+        if self.healthy:
+            logger.warning('Replica %s unavailable: %s', self.name, error)
+        self.healthy = False
+        self.error = str(error).strip()
+        self.failures += 1
+        self.checked_at = time.monotonic()
+
+    def stats(self):
+        return {
+            'replica': self.name,
+            'healthy': self.healthy,
+            'lagSeconds': self.lag,
+            'error': self.error,
+            'reads': self.reads,
+            'failures': self.failures,
+            'pool': self._pool.stats() if self._pool is not None and self._pool_pid == os.getpid() else None,
+        }
+
+replicas = [Replica(address) for address in REPLICA_HOSTS]
+_next_replica = itertools.count()
+_routing = {'replica': 0, 'sticky': 0, 'fallback': 0}
+
+# user_id -> monotonic time until which that user's reads go to the primary
+_recent_writes = {}
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+def note_write(user_id):
+    """Keep this worker's reads for user_id on the primary for READ_YOUR_WRITES_SECONDS"""
+    if len(_recent_writes) > 10000:
+        now = time.monotonic()
+        for stale in [uid for uid, until in list(_recent_writes.items()) if until <= now]:
+            _recent_writes.pop(stale, None)
+    _recent_writes[user_id] = time.monotonic() + READ_YOUR_WRITES_SECONDS
+
+def recently_wrote(user_id):
+    return _recent_writes.get(user_id, 0) > time.monotonic()
+
+def _ensure_listener():
+    """Start the LISTEN thread for other workers' writes once per process"""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+    threading.Thread(target=_listen_for_writes, name='read-your-writes-listener', daemon=True).start()
+
+def _listen_for_writes():
+    """Mark users written by other workers; reconnect with backoff if the connection drops"""
+    backoff = 1
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**_connect_kwargs())
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(f'LISTEN {WRITES_CHANNEL}')
+            backoff = 1
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    note_write(int(conn.notifies.pop(0).payload))
+        except Exception as e:
+            logger.warning('Read-your-writes listener failed: %s', e)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+        finally:
+            if conn is not None:
+                conn.close()
+
+def route_reads(user_id):
+    """Send this request's queries to a replica when it is a read and user_id wrote nothing recently.
+
+    Call before the request's first query; until then get_db_connection()
+    uses the primary. Falls back to the primary when no replica is healthy.
+    """
+    if not replicas or request.method not in ('GET', 'HEAD') or 'db' in g or g.get('db_pool') is not None:
+        return
+    _ensure_listener()
+    if recently_wrote(user_id):
+        _routing['sticky'] += 1
+        return
+    start = next(_next_replica)
+    for offset in range(len(replicas)):
+        replica = replicas[(start + offset) % len(replicas)]
+        if replica.available():
+            g.db_replica = replica
+            return
+    _routing['fallback'] += 1
+
+def use_shard(shard):
+    """Point get_db_connection() at a shard for the rest of this context.
+
+    A primary connection already checked out is kept for global tables and
+    handed out by get_global_connection().
+    """
+    if shard == 0 or g.get('db_pool') is get_shard_pool(shard):
+        return
+    if 'db' in g:
+        g.db_global = g.pop('db')
+    g.db_pool = get_shard_pool(shard)
+
+def on_primary():
+    """True when this context's connection is (or will be) a primary connection"""
+    return g.get('db_replica') is None and g.get('db_pool') in (None, get_pool())
+
+def current_pool():
+    """Pool that get_db_connection() checks out from, for connections held beyond the request"""
+    return g.get('db_pool') or get_pool()
+
+def replica_stats():
+    """Routing counters and per-replica health, or None when no replicas are configured"""
+    if not replicas:
+        return None
+    return dict(_routing, replicas=[replica.stats() for replica in replicas])
 
 def get_db_connection():
-    """Connect to the PostgreSQL database server"""
-    # Check if we're in an application context
+    """Get a pooled database connection for the current application context.
+
+    The connection is checked out once per context and returned to the pool
+    by close_db() on teardown, so callers must not close it themselves.
+    Requests routed with route_reads() get a replica connection.
+    """
     try:
         if 'db' not in g:
-            # Get connection parameters from environment variables or use defaults
-            host = os.environ.get('DB_HOST', 'localhost')
-            database = os.environ.get('DB_NAME', 'expense_tracker')
-            user = os.environ.get('DB_USER', 'postgres')
-            password = os.environ.get('DB_PASSWORD', 'admin123')
-            port = os.environ.get('DB_PORT', '5432')
-            
-            g.db = psycopg2.connect(
-                host=host,
-                database=database,
-                user=user,
-                password=password,
-                port=port,
-                cursor_factory=RealDictCursor
-            )
+            replica = g.get('db_replica')
+            if replica is not None:
+                try:
+                    g.db = replica.pool().getconn(timeout=REPLICA_CONNECT_TIMEOUT)
+                    g.db_pool = replica.pool()
+                    replica.reads += 1
+                    _routing['replica'] += 1
+                except (psycopg2.Error, PoolTimeout) as e:
+                    replica.mark_down(e)
+                    g.db_replica = None
+                    _routing['fallback'] += 1
+            if 'db' not in g:
+                g.db = current_pool().getconn()
         return g.db
     except RuntimeError:
         # If not in application context, create a direct connection
-        host = os.environ.get('DB_HOST', 'localhost')
-        database = os.environ.get('DB_NAME', 'expense_tracker')
-        user = os.environ.get('DB_USER', 'postgres')
-        password = os.environ.get('DB_PASSWORD', 'admin123')
-        port = os.environ.get('DB_PORT', '5432')
-        
-        return psycopg2.connect(
-            host=host,
-            database=database,
-            user=user,
-            password=password,
-            port=port,
-            cursor_factory=RealDictCursor
-        )
+        return psycopg2.connect(**_connect_kwargs())
+
+def get_global_connection():
+    """Primary connection for global tables (categories, user directory) in this context.
+
+    The same as get_db_connection() unless the context was routed to a
+    replica or another shard.
+    """
+    if 'db_global' in g:
+        return g.db_global
+    if on_primary():
+        return get_db_connection()
+    g.db_global = get_pool().getconn()
+    return g.db_global
 
 def close_db(e=None):
-    """Close the database connection at the end of the request"""
+    """Return the database connection to the pool at the end of the request"""
     db = g.pop('db', None)
+    pool = g.pop('db_pool', None) or get_pool()
+    g.pop('db_replica', None)
     if db is not None:
-        db.close()
+        close = False
+        if g.pop('db_pinned', False):
+            # Session-level locks outlive the transaction; drop them before reuse
+            try:
+                db.rollback()
+                db.cursor().execute('SELECT pg_advisory_unlock_all()')
+                db.rollback()
+            except psycopg2.Error:
+                close = True
+        pool.putconn(db, close=close)
+    db_global = g.pop('db_global', None)
+    if db_global is not None:
+        get_pool().putconn(db_global)
+
+def wrote_user(user_id):
+    """Mark user_id as written by this request when it is not the authenticated user (registration)"""
+    g.wrote_user_id = user_id
 
-def init_db():
-    """Initialize the database schema"""
-    conn = get_db_connection()
+def _remember_writes(response):
+    """After a successful write, pin the user's reads to the primary on every worker"""
+    user_id = g.get('wrote_user_id')
+    if user_id is None and g.get('current_user') is not None:
+        user_id = g.current_user['id']
+    if not replicas or user_id is None or request.method in ('GET', 'HEAD', 'OPTIONS') \
+            or response.status_code >= 400:
+        return response
+    note_write(user_id)
+    conn = get_global_connection()
     cur = conn.cursor()
-    
-    # Create users table
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id SERIAL PRIMARY KEY,
-        email VARCHAR(255) UNIQUE NOT NULL,
-        password_hash VARCHAR(255) NOT NULL,
-        display_name VARCHAR(255),
-        photo_url TEXT,
-        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create categories table
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS categories (
-        id SERIAL PRIMARY KEY,
-        name VARCHAR(100) NOT NULL,
-        color VARCHAR(50) NOT NULL,
-        UNIQUE(name)
-    )
-    ''')
-    
-    # Create expenses table
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS expenses (
-        id SERIAL PRIMARY KEY,
-        user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-        title VARCHAR(255) NOT NULL,
-        amount DECIMAL(10, 2) NOT NULL,
-        date TIMESTAMP NOT NULL,
-        category_id INTEGER REFERENCES categories(id) ON DELETE SET NULL,
-        notes TEXT,
-        receipt_url TEXT,
-        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Insert default categories
-    default_categories = [
-        ('Food', '#FF5733'),
-        ('Transportation', '#33A8FF'),
-        ('Housing', '#33FF57'),
-        ('Entertainment', '#F033FF'),
-        ('Utilities', '#FFFF33'),
-        ('Healthcare', '#FF3333'),
-        ('Shopping', '#33FFF0'),
-        ('Education', '#8033FF'),
-        ('Travel', '#FF8033'),
-        ('Others', '#AAAAAA')
-    ]
-    
-    for name, color in default_categories:
-        try:
-            cur.execute(
-                'INSERT INTO categories (name, color) VALUES (%s, %s) ON CONFLICT (name) DO NOTHING',
-                (name, color)
-            )
-        except Exception as e:
-            print(f"Error inserting category {name}: {e}")
-            
-    conn.commit()
-    cur.close()
-    conn.close()
-
-@click.command('init-db')
-@with_appcontext
-def init_db_command():
-    """Clear the existing data and create new tables."""
-    init_db()
-    click.echo('Initialized the database.')
+    try:
+        cur.execute('SELECT pg_notify(%s, %s)', (WRITES_CHANNEL, str(user_id)))
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        current_app.logger.warning('Could not publish write for user %s: %s', user_id, e)
+    finally:
+        cur.close()
+    return response
 
 def init_app(app):
     """Register database functions with the Flask app."""
     app.teardown_appcontext(close_db)
-    app.cli.add_command(init_db_command)
+    app.after_request(_remember_writes)
@@ -1,13 +1,36 @@
 
-from flask import Blueprint, request, jsonify, g
+from flask import Blueprint, Response, request, jsonify, g
 from db import get_db_connection
+import rollups
+import archive
+import fastjson
+import ingest
+from imports import RowError, category_lookup, validate_row
+from versions import conditional, bump_user_version
+from catalog import catalog
 from auth import token_required
+from filters import (FilterError, parse_expense_filters, expense_window, build_expense_where,
+                     date_clause, search_clause, search_rank)
 from datetime import datetime
+from decimal import Decimal
+import base64
 import uuid
 import os
 
 bp = Blueprint('expenses', __name__, url_prefix='/api/expenses')
 
+# Larger pageSize values are clamped to this
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+
+# Columns returned for an expense; internal columns such as search_vector stay out
+EXPENSE_COLUMNS = """e.id, e.user_id, e.title, e.amount, e.date, e.category_id,
+    e.notes, e.receipt_url, e.created_at, e.updated_at"""
+# Listings read archive.source(), which also tells archived rows apart
+LISTED_COLUMNS = EXPENSE_COLUMNS + ', e.archived'
+# List orderings over the listed output columns; BY_RELEVANCE needs expenses_query(rank=...)
+NEWEST_FIRST = 'date DESC, id DESC'
+BY_RELEVANCE = 'rank DESC, date DESC, id DESC'
+
 def format_expense(expense_data, include_category=True):
     """Format expense data to match frontend expectations"""
     if not expense_data:
@@ -22,123 +45,225 @@ def format_expense(expense_data, include_category=True):
             
     return expense
 
+def encode_cursor(expense):
+    """Build an opaque keyset cursor pointing just past the given expense row"""
+    raw = f"{expense['date'].isoformat()}|{expense['id']}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Return the (date, id) pair encoded in a cursor, or None if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        date_part, id_part = raw.rsplit('|', 1)
+        return datetime.fromisoformat(date_part), int(id_part)
+    except (ValueError, UnicodeError):
+        return None
+
+def summarize_categories(totals):
+    """Build the summary total and per-category breakdown from {category_id: (amount, count)}"""
+    # Total includes uncategorized expenses
+    total_amount = sum((amount for amount, _ in totals.values()), Decimal(0))
+    
+    # Every category in the catalog, largest first, with names and colors from memory
+    categories = []
+    for category in catalog.all():
+        amount, count = totals.get(category['id'], (Decimal(0), 0))
+        categories.append({
+            'id': category['id'],
+            'name': category['name'],
+            'color': category['color'],
+            'amount': float(amount),
+            'count': count,
+            'percentage': float(amount / total_amount * 100) if total_amount > 0 else 0
+        })
+    categories.sort(key=lambda row: row['amount'], reverse=True)
+    
+    return total_amount, categories
+
+def page_args(args):
+    """Return (page, pageSize) from the query string, with pageSize capped at MAX_PAGE_SIZE"""
+    page = args.get('page', 1, type=int)
+    page_size = args.get('pageSize', 10, type=int)
+    if page < 1 or page_size < 1:
+        raise FilterError('page and pageSize must be positive integers')
+    return page, min(page_size, MAX_PAGE_SIZE)
+
+def expenses_query(user_id, filters, rank=None):
+    """Base query for a user's filtered expenses, without ordering; returns (query, params).
+
+    Windows reaching back past the archive cutoff also read archived expenses,
+    flagged with `archived`. Pass the (sql, params) pair from search_rank() as
+    `rank` to also select it as `rank` for BY_RELEVANCE.
+    """
+    source, source_params = archive.source(user_id, filters['start'], filters['end'])
+    where, params = build_expense_where(filters)
+    rank_column, rank_params = (f', {rank[0]} AS rank', list(rank[1])) if rank else ('', [])
+    query = f"""
+    SELECT {LISTED_COLUMNS}{rank_column}
+    FROM {source}
+    WHERE e.user_id = %s
+    """ + where
+    return query, rank_params + source_params + [user_id] + params
+
+def expenses_json_query(query, params, limit, order=NEWEST_FIRST, keyset=False):
+    """Wrap a page query sorted by `order` so Postgres renders it; returns (query, params).
+
+    The single result row has `expenses`, the first `limit` rows as a JSON
+    array in the shape format_expense and catalog.attach produce. Rows are
+    numbered by the same sort keys, so the category join cannot reorder them.
+    With keyset=True it also has `fetched` and the date and id of the last
+    rendered row for cursors.
+    """
+    keyset_columns = """,
+           COUNT(*) AS fetched,
+           MAX(p.date) FILTER (WHERE p.position = %s) AS last_date,
+           MAX(p.id) FILTER (WHERE p.position = %s) AS last_id""" if keyset else ''
+    return f"""
+    SELECT COALESCE(json_agg(json_build_object(
+               'id', p.id, 'user_id', p.user_id, 'title', p.title, 'amount', p.amount::text,
+               'date', p.date, 'category_id', p.category_id, 'notes', p.notes,
+               'receipt_url', p.receipt_url, 'created_at', p.created_at, 'updated_at', p.updated_at,
+               'archived', p.archived, 'category_name', c.name, 'category_color', c.color
+           ) ORDER BY p.position) FILTER (WHERE p.position <= %s), '[]')::text AS expenses{keyset_columns}
+    FROM (SELECT page.*, row_number() OVER (ORDER BY {order}) AS position FROM ({query}) page) p
+    LEFT JOIN categories c ON c.id = p.category_id
+    """, [limit] + ([limit, limit] if keyset else []) + list(params)
+
+def expenses_body(expenses_json, pagination):
+    """List response body; the database-rendered expense array is passed through untouched"""
+    return (b'{"expenses":' + expenses_json.encode('utf-8') + b',"pagination":'
+            + fastjson.dumps(pagination) + b'}\n')
+
+def next_cursor(page, page_size):
+    """Keyset pagination fields for a page rendered by expenses_json_query with one extra row"""
+    has_more = page['fetched'] > page_size
+    return {
+        'pageSize': page_size,
+        'hasMore': has_more,
+        'nextCursor': encode_cursor({'date': page['last_date'], 'id': page['last_id']}) if has_more else None
+    }
+
 @bp.route('', methods=['GET'])
 @token_required
+@conditional(window=expense_window)
 def get_expenses():
     user_id = g.current_user['id']
     
     # Parse filter parameters
-    time_filter = request.args.get('timeFilter', 'current-month')
-    start_date = request.args.get('startDate')
-    end_date = request.args.get('endDate')
-    categories = request.args.getlist('categories')
-    min_amount = request.args.get('minAmount', type=float)
-    max_amount = request.args.get('maxAmount', type=float)
-    search_query = request.args.get('searchQuery')
+    try:
+        filters = parse_expense_filters(request.args)
+    except FilterError as e:
+        return jsonify({'message': str(e)}), 400
     
     # Pagination parameters
-    page = request.args.get('page', 1, type=int)
-    page_size = request.args.get('pageSize', 10, type=int)
+    try:
+        page, page_size = page_args(request.args)
+    except FilterError as e:
+        return jsonify({'message': str(e)}), 400
     offset = (page - 1) * page_size
     
     conn = get_db_connection()
     cur = conn.cursor()
     
-    # Base query
-    query = """
-    SELECT e.*, c.name as category_name, c.color as category_color
-    FROM expenses e
-    LEFT JOIN categories c ON e.category_id = c.id
-    WHERE e.user_id = %s
-    """
-    params = [user_id]
-    
-    # Apply time filter
-    if time_filter == 'current-month':
-        query += " AND DATE_TRUNC('month', e.date) = DATE_TRUNC('month', CURRENT_DATE)"
-    elif time_filter == 'last-month':
-        query += " AND DATE_TRUNC('month', e.date) = DATE_TRUNC('month', CURRENT_DATE - INTERVAL '1 month')"
-    elif time_filter == 'this-year':
-        query += " AND DATE_TRUNC('year', e.date) = DATE_TRUNC('year', CURRENT_DATE)"
-    elif time_filter == 'custom' and start_date:
-        query += " AND e.date >= %s"
-        params.append(start_date)
-        if end_date:
-            query += " AND e.date <= %s"
-            params.append(end_date)
-    
-    # Apply category filter
-    if categories and len(categories) > 0:
-        categories_list = categories if isinstance(categories, list) else [categories]
-        placeholders = ', '.join(['%s'] * len(categories_list))
-        query += f" AND e.category_id IN (SELECT id FROM categories WHERE name IN ({placeholders}))"
-        params.extend(categories_list)
-    
-    # Apply amount filters
-    if min_amount is not None:
-        query += " AND e.amount >= %s"
-        params.append(min_amount)
-    if max_amount is not None:
-        query += " AND e.amount <= %s"
-        params.append(max_amount)
-    
-    # Apply search query
-    if search_query:
-        query += " AND (e.title ILIKE %s OR e.notes ILIKE %s)"
-        search_pattern = f"%{search_query}%"
-        params.append(search_pattern)
-        params.append(search_pattern)
+    # Base query with time, category, amount and search filters applied
+    query, params = expenses_query(user_id, filters)
+    
+    # Keyset pagination: opt in with ?pagination=cursor or by passing a cursor
+    cursor = request.args.get('cursor')
+    if cursor is not None or request.args.get('pagination') == 'cursor':
+        return _get_expenses_page_by_cursor(cur, query, params, cursor, page_size)
     
     # Get total count
     count_query = f"SELECT COUNT(*) FROM ({query}) AS filtered_expenses"
     cur.execute(count_query, params)
     total_count = cur.fetchone()['count']
     
-    # Apply sorting and pagination
-    query += " ORDER BY e.date DESC LIMIT %s OFFSET %s"
-    params.append(page_size)
-    params.append(offset)
+    # Apply sorting and pagination; sort=relevance ranks full-text matches first
+    _, _, tsquery = search_clause(filters)
+    order = NEWEST_FIRST
+    if tsquery and request.args.get('sort') == 'relevance':
+        query, params = expenses_query(user_id, filters, rank=search_rank(tsquery))
+        order = BY_RELEVANCE
+    query += f" ORDER BY {order} LIMIT %s OFFSET %s"
+    params = params + [page_size, offset]
     
-    # Execute query
-    cur.execute(query, params)
-    expenses = [format_expense(expense) for expense in cur.fetchall()]
+    # Postgres renders the page as JSON
+    cur.execute(*expenses_json_query(query, params, page_size, order))
+    page_json = cur.fetchone()['expenses']
     
     cur.close()
-    conn.close()
     
-    return jsonify({
-        'expenses': expenses,
-        'pagination': {
-            'total': total_count,
-            'page': page,
-            'pageSize': page_size,
-            'pages': (total_count + page_size - 1) // page_size
-        }
-    })
+    return Response(expenses_body(page_json, {
+        'total': total_count,
+        'page': page,
+        'pageSize': page_size,
+        'pages': (total_count + page_size - 1) // page_size
+    }), mimetype='application/json')
+
+def _get_expenses_page_by_cursor(cur, query, params, cursor, page_size):
+    """Return one page of the filtered expenses seeking past the (date, id) cursor.
+
+    Each page is a bounded index range scan, so page N costs the same as
+    page 1. The total is only counted when the client asks for it.
+    """
+    include_total = request.args.get('includeTotal', 'false').lower() == 'true'
+    params = list(params)
+    
+    total_count = None
+    if include_total:
+        cur.execute(f"SELECT COUNT(*) FROM ({query}) AS filtered_expenses", params)
+        total_count = cur.fetchone()['count']
+    
+    if cursor:
+        position = decode_cursor(cursor)
+        if position is None:
+            cur.close()
+            return jsonify({'message': 'Invalid cursor'}), 400
+        # The redundant date bound lets a partitioned expenses table prune partitions
+        query += " AND e.date <= %s AND (e.date, e.id) < (%s, %s)"
+        params.append(position[0])
+        params.extend(position)
+    
+    # Fetch one extra row to find out whether another page exists
+    query += f" ORDER BY {NEWEST_FIRST} LIMIT %s"
+    params.append(page_size + 1)
+    
+    cur.execute(*expenses_json_query(query, params, page_size, keyset=True))
+    rendered = cur.fetchone()
+    cur.close()
+    
+    pagination = next_cursor(rendered, page_size)
+    if total_count is not None:
+        pagination['total'] = total_count
+    
+    return Response(expenses_body(rendered['expenses'], pagination), mimetype='application/json')
 
 @bp.route('/<int:expense_id>', methods=['GET'])
 @token_required
+@conditional
 def get_expense(expense_id):
     user_id = g.current_user['id']
     
     conn = get_db_connection()
     cur = conn.cursor()
     
-    cur.execute("""
-        SELECT e.*, c.name as category_name, c.color as category_color
+    cur.execute(f"""
+        SELECT {EXPENSE_COLUMNS}
         FROM expenses e
-        LEFT JOIN categories c ON e.category_id = c.id
         WHERE e.id = %s AND e.user_id = %s
     """, (expense_id, user_id))
     
     expense = cur.fetchone()
-    cur.close()
-    conn.close()
     
     if not expense:
+        archived = archive.archived_ids(cur, user_id, [expense_id])
+        cur.close()
+        if archived:
+            return jsonify({'message': archive.ARCHIVED_MESSAGE}), 409
         return jsonify({'message': 'Expense not found'}), 404
+    cur.close()
     
-    return jsonify(format_expense(expense))
+    return jsonify(format_expense(catalog.attach(expense)))
 
 @bp.route('', methods=['POST'])
 @token_required
@@ -151,6 +276,10 @@ def create_expense():
         if field not in data:
             return jsonify({'message': f'Missing required field: {field}'}), 400
     
+    # Bank feeds ask for queued creates; the row is written by the ingestion writer
+    if ingest.wants_async(request):
+        return _enqueue_expense(user_id, data)
+    
     conn = get_db_connection()
     cur = conn.cursor()
     
@@ -171,22 +300,41 @@ def create_expense():
         ))
         
         new_expense = cur.fetchone()
+        rollups.record(cur, added=[new_expense])
+        bump_user_version(cur, user_id)
+        
+        conn.commit()
         
-        # Get category details
-        cur.execute("SELECT name, color FROM categories WHERE id = %s", (data['categoryId'],))
-        category = cur.fetchone()
+        # Get category details from the in-memory catalog
+        category = catalog.get(new_expense['category_id'])
         if category:
             new_expense['category_name'] = category['name']
             new_expense['category_color'] = category['color']
-            
-        conn.commit()
+        
         return jsonify(format_expense(new_expense)), 201
     except Exception as e:
         conn.rollback()
         return jsonify({'message': f'Database error: {str(e)}'}), 500
     finally:
         cur.close()
-        conn.close()
+
+def _enqueue_expense(user_id, data):
+    """Validate a create, queue it durably and acknowledge with 202"""
+    key = request.headers.get('Idempotency-Key') or uuid.uuid4().hex
+    if len(key) > 255:
+        return jsonify({'message': 'Idempotency-Key is longer than 255 characters'}), 400
+    
+    try:
+        row = validate_row(data, user_id, category_lookup())
+    except RowError as e:
+        return jsonify({'message': str(e)}), 400
+    
+    try:
+        ingest.queue.enqueue(ingest.to_record(row, key))
+    except ingest.IngestQueueFull:
+        return jsonify({'message': 'Ingestion queue is full, please retry'}), 503
+    
+    return jsonify({'status': 'queued', 'idempotencyKey': key}), 202
 
 @bp.route('/<int:expense_id>', methods=['PUT'])
 @token_required
@@ -197,11 +345,18 @@ def update_expense(expense_id):
     conn = get_db_connection()
     cur = conn.cursor()
     
-    # Check if expense exists and belongs to user
-    cur.execute("SELECT id FROM expenses WHERE id = %s AND user_id = %s", (expense_id, user_id))
-    if not cur.fetchone():
+    # Check if expense exists and belongs to user; lock it so the rollup delta is exact
+    cur.execute(
+        "SELECT id, user_id, amount, date, category_id FROM expenses WHERE id = %s AND user_id = %s FOR UPDATE",
+        (expense_id, user_id)
+    )
+    previous_expense = cur.fetchone()
+    if not previous_expense:
+        archived = archive.archived_ids(cur, user_id, [expense_id])
         cur.close()
-        conn.close()
+        conn.rollback()
+        if archived:
+            return jsonify({'message': archive.ARCHIVED_MESSAGE}), 409
         return jsonify({'message': 'Expense not found or access denied'}), 404
     
     # Updateable fields
@@ -220,7 +375,7 @@ def update_expense(expense_id):
     
     if not fields:
         cur.close()
-        conn.close()
+        conn.rollback()
         return jsonify({'message': 'No valid fields to update'}), 400
     
     try:
@@ -241,23 +396,24 @@ def update_expense(expense_id):
         )
         
         updated_expense = cur.fetchone()
+        rollups.record(cur, added=[updated_expense], removed=[previous_expense])
+        bump_user_version(cur, user_id)
+        
+        conn.commit()
         
-        # Get category details
+        # Get category details from the in-memory catalog
         if updated_expense and updated_expense['category_id']:
-            cur.execute("SELECT name, color FROM categories WHERE id = %s", (updated_expense['category_id'],))
-            category = cur.fetchone()
+            category = catalog.get(updated_expense['category_id'])
             if category:
                 updated_expense['category_name'] = category['name']
                 updated_expense['category_color'] = category['color']
-                
-        conn.commit()
+        
         return jsonify(format_expense(updated_expense))
     except Exception as e:
         conn.rollback()
         return jsonify({'message': f'Database error: {str(e)}'}), 500
     finally:
         cur.close()
-        conn.close()
 
 @bp.route('/<int:expense_id>', methods=['DELETE'])
 @token_required
@@ -268,13 +424,19 @@ def delete_expense(expense_id):
     cur = conn.cursor()
     
     try:
-        # Check if expense exists and belongs to user
-        cur.execute("SELECT id FROM expenses WHERE id = %s AND user_id = %s", (expense_id, user_id))
-        if not cur.fetchone():
+        # Delete the expense; no row back means it does not exist or belongs to someone else
+        cur.execute(
+            "DELETE FROM expenses WHERE id = %s AND user_id = %s RETURNING user_id, amount, date, category_id",
+            (expense_id, user_id)
+        )
+        deleted_expense = cur.fetchone()
+        if not deleted_expense:
+            if archive.archived_ids(cur, user_id, [expense_id]):
+                return jsonify({'message': archive.ARCHIVED_MESSAGE}), 409
             return jsonify({'message': 'Expense not found or access denied'}), 404
         
-        # Delete the expense
-        cur.execute("DELETE FROM expenses WHERE id = %s AND user_id = %s", (expense_id, user_id))
+        rollups.record(cur, removed=[deleted_expense])
+        bump_user_version(cur, user_id)
         conn.commit()
         
         return jsonify({'message': 'Expense deleted successfully'}), 200
@@ -283,90 +445,59 @@ def delete_expense(expense_id):
         return jsonify({'message': f'Database error: {str(e)}'}), 500
     finally:
         cur.close()
-        conn.close()
 
 @bp.route('/summary', methods=['GET'])
 @token_required
+@conditional(window=expense_window)
 def get_expense_summary():
     user_id = g.current_user['id']
     
     # Parse filter parameters
-    time_filter = request.args.get('timeFilter', 'current-month')
-    start_date = request.args.get('startDate')
-    end_date = request.args.get('endDate')
+    try:
+        filters = parse_expense_filters(request.args)
+    except FilterError as e:
+        return jsonify({'message': str(e)}), 400
     
     conn = get_db_connection()
     cur = conn.cursor()
     
-    # Date filter clause
-    date_filter = ""
-    params = [user_id]
-    
-    if time_filter == 'current-month':
-        date_filter = "AND DATE_TRUNC('month', e.date) = DATE_TRUNC('month', CURRENT_DATE)"
-    elif time_filter == 'last-month':
-        date_filter = "AND DATE_TRUNC('month', e.date) = DATE_TRUNC('month', CURRENT_DATE - INTERVAL '1 month')"
-    elif time_filter == 'this-year':
-        date_filter = "AND DATE_TRUNC('year', e.date) = DATE_TRUNC('year', CURRENT_DATE)"
-    elif time_filter == 'custom' and start_date:
-        date_filter = "AND e.date >= %s"
-        params.append(start_date)
-        if end_date:
-            date_filter += " AND e.date <= %s"
-            params.append(end_date)
-    
-    # Get total expenses
-    cur.execute(
-        f"SELECT COALESCE(SUM(amount), 0) as total FROM expenses e WHERE user_id = %s {date_filter}",
-        params
-    )
-    total_amount = cur.fetchone()['total']
+    # Date filter clause; older windows also read the archive
+    date_filter, date_params = date_clause(filters['start'], filters['end'])
+    source, source_params = archive.source(user_id, filters['start'], filters['end'])
+    params = source_params + [user_id] + date_params
     
-    # Get expenses by category
-    cur.execute(
-        f"""
-        SELECT 
-            c.id,
-            c.name,
-            c.color,
-            COALESCE(SUM(e.amount), 0) as amount,
-            COUNT(e.id) as count
-        FROM categories c
-        LEFT JOIN expenses e ON c.id = e.category_id AND e.user_id = %s {date_filter}
-        GROUP BY c.id, c.name, c.color
-        ORDER BY amount DESC
-        """,
-        params
-    )
+    if rollups.is_day_aligned(filters['start'], filters['end']):
+        # Answer from the per-day rollups; cost depends on days in range, not rows
+        totals = rollups.category_totals(cur, user_id, filters['start'], filters['end'])
+    else:
+        cur.execute(
+            f"""
+            SELECT e.category_id, SUM(e.amount) as amount, COUNT(*) as count
+            FROM {source}
+            WHERE e.user_id = %s {date_filter}
+            GROUP BY e.category_id
+            """,
+            params
+        )
+        totals = {row['category_id']: (row['amount'], row['count']) for row in cur.fetchall()}
     
-    categories = []
-    for row in cur.fetchall():
-        categories.append({
-            'id': row['id'],
-            'name': row['name'],
-            'color': row['color'],
-            'amount': float(row['amount']),
-            'count': row['count'],
-            'percentage': float(row['amount'] / total_amount * 100) if total_amount > 0 else 0
-        })
+    total_amount, categories = summarize_categories(totals)
     
     # Get recent expenses
     cur.execute(
         f"""
-        SELECT e.*, c.name as category_name, c.color as category_color
-        FROM expenses e
-        LEFT JOIN categories c ON e.category_id = c.id
+        SELECT {LISTED_COLUMNS}
+        FROM {source}
         WHERE e.user_id = %s {date_filter}
-        ORDER BY e.date DESC
+        ORDER BY e.date DESC, e.id DESC
         LIMIT 5
         """,
         params
     )
     
-    recent_expenses = [format_expense(expense) for expense in cur.fetchall()]
+    recent_expenses = [format_expense(catalog.attach(expense)) for expense in cur.fetchall()]
     
     cur.close()
-    conn.close()
     
     return jsonify({
         'total': float(total_amount),
@@ -0,0 +1,89 @@
+from flask import Blueprint, request, jsonify, g, Response
+from db import current_pool
+from auth import token_required
+from filters import FilterError, parse_expense_filters
+from expenses import expenses_query, format_expense
+from catalog import catalog
+import fastjson
+import csv
+import io
+import os
+import uuid
+
+bp = Blueprint('exports', __name__, url_prefix='/api/expenses')
+
+# Rows fetched per round trip from the server-side cursor, and per response chunk
+ITERSIZE = int(os.environ.get('EXPORT_ITERSIZE', 2000))
+
+CSV_FIELDS = ['id', 'date', 'title', 'amount', 'category_id', 'category_name',
+              'notes', 'receipt_url', 'created_at', 'updated_at']
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+
+def stream_expenses(query, params, fmt, pool):
+    """Yield the export body in chunks, reading rows through a named cursor.
+
+    The connection is checked out here rather than per request because the
+    body is produced after the view returns; it goes back to the pool when
+    the generator finishes or the client disconnects. `pool` is the user's
+    shard pool, taken from the request before the view returns.
+    """
+    conn = pool.getconn()
+    try:
+        cur = conn.cursor(name=f'export_{uuid.uuid4().hex}')
+        cur.itersize = ITERSIZE
+        cur.execute(query, params)
+
+        buffer = io.StringIO()
+        writer = None
+        if fmt == 'csv':
+            writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+
+        pending = 0
+        for row in cur:
+            expense = format_expense(catalog.attach(row))
+            if writer is not None:
+                writer.writerow(expense)
+            else:
+                buffer.write(fastjson.dumps(expense).decode('utf-8'))
+                buffer.write('\n')
+            pending += 1
+            if pending >= ITERSIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+                pending = 0
+
+        if buffer.tell():
+            yield buffer.getvalue()
+        cur.close()
+    finally:
+        pool.putconn(conn)
+
+@bp.route('/export', methods=['GET'])
+@token_required
+def export_expenses():
+    user_id = g.current_user['id']
+
+    fmt = request.args.get('format', 'csv')
+    if fmt not in FORMATS:
+        return jsonify({'message': 'format must be csv or ndjson'}), 400
+
+    try:
+        filters = parse_expense_filters(request.args)
+    except FilterError as e:
+        return jsonify({'message': str(e)}), 400
+
+    query, params = expenses_query(user_id, filters)
+    query += " ORDER BY e.date DESC, e.id DESC"
+
+    mimetype, extension = FORMATS[fmt]
+    return Response(
+        stream_expenses(query, params, fmt, current_pool()),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=expenses.{extension}'}
+    )
@@ -0,0 +1,52 @@
+import dataclasses
+import json
+import uuid
+from datetime import date
+from decimal import Decimal
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
+
+# orjson is optional; without it responses are encoded by the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _default(value):
+    """Same conversions as Flask's default JSON provider"""
+    if isinstance(value, date):
+        return http_date(value)
+    if isinstance(value, (Decimal, uuid.UUID)):
+        return str(value)
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def dumps(obj):
+    """Compact JSON bytes with sorted keys, like flask.jsonify outside debug mode"""
+    if orjson is not None:
+        # Dates go through _default so they keep Flask's HTTP-date format
+        return orjson.dumps(obj, default=_default,
+                            option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes responses with orjson when it is installed.
+
+    Pretty-printed output (debug mode) and calls with explicit json.dumps
+    options keep the standard library encoder.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        pretty = self.compact is False or (self.compact is None and self._app.debug)
+        if orjson is None or pretty:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj) + b'\n', mimetype=self.mimetype)
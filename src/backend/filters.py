@@ -0,0 +1,147 @@
+import re
+from datetime import date, datetime, timedelta
+from catalog import catalog
+
+# Text search configuration used by expenses.search_vector (see migrations.py)
+SEARCH_CONFIG = 'simple'
+
+class FilterError(ValueError):
+    """Raised when a filter parameter cannot be parsed"""
+
+def _parse_bound(value, name):
+    """Parse a YYYY-MM-DD or ISO 8601 value; returns (datetime, is_date_only)"""
+    try:
+        if len(value) == 10:
+            return datetime.combine(date.fromisoformat(value), datetime.min.time()), True
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None), False
+    except ValueError:
+        raise FilterError(f'Invalid {name}: {value}')
+
+def _month_start(day):
+    return datetime(day.year, day.month, 1)
+
+def _add_months(moment, months):
+    month = moment.month - 1 + months
+    return moment.replace(year=moment.year + month // 12, month=month % 12 + 1)
+
+def date_range(time_filter, start_date=None, end_date=None, today=None):
+    """Return the half-open [start, end) datetime window for a time filter.
+
+    Either bound may be None when the filter leaves that side open. A
+    date-only endDate includes that whole day.
+    """
+    today = today or date.today()
+
+    if time_filter == 'current-month':
+        start = _month_start(today)
+        return start, _add_months(start, 1)
+    if time_filter == 'last-month':
+        end = _month_start(today)
+        return _add_months(end, -1), end
+    if time_filter == 'this-year':
+        return datetime(today.year, 1, 1), datetime(today.year + 1, 1, 1)
+    if time_filter == 'custom' and start_date:
+        start, _ = _parse_bound(start_date, 'startDate')
+        end = None
+        if end_date:
+            end, date_only = _parse_bound(end_date, 'endDate')
+            end += timedelta(days=1) if date_only else timedelta(microseconds=1)
+        return start, end
+    return None, None
+
+def parse_expense_filters(args):
+    """Normalize the expense filter query parameters shared by list endpoints"""
+    start, end = date_range(
+        args.get('timeFilter', 'current-month'),
+        args.get('startDate'),
+        args.get('endDate')
+    )
+    return {
+        'start': start,
+        'end': end,
+        'categories': [name for name in args.getlist('categories') if name],
+        'min_amount': args.get('minAmount', type=float),
+        'max_amount': args.get('maxAmount', type=float),
+        'search': args.get('searchQuery') or None,
+        'search_mode': args.get('searchMode', 'fulltext'),
+    }
+
+def expense_window(args):
+    """(start, end) that parse_expense_filters resolves args to, or None if they do not parse"""
+    try:
+        filters = parse_expense_filters(args)
+    except FilterError:
+        return None
+    return filters['start'], filters['end']
+
+def prefix_tsquery(text):
+    """Turn free text into a prefix-matching tsquery string, e.g. 'cof bea' -> 'cof:* & bea:*'.
+
+    Returns None when the text has no word characters to match on.
+    """
+    terms = re.findall(r'\w+', text.lower())
+    if not terms:
+        return None
+    return ' & '.join(f'{term}:*' for term in terms)
+
+def search_clause(filters, alias='e'):
+    """Compile the search filter; returns (sql, params, tsquery or None).
+
+    Full-text mode matches word prefixes against the GIN-indexed
+    search_vector. Substring mode keeps the original ILIKE semantics and is
+    used automatically when the query has nothing to full-text match.
+    """
+    text = filters['search']
+    if not text:
+        return '', [], None
+
+    tsquery = prefix_tsquery(text) if filters['search_mode'] != 'substring' else None
+    if tsquery:
+        return (f" AND {alias}.search_vector @@ to_tsquery('{SEARCH_CONFIG}', %s)",
+                [tsquery], tsquery)
+
+    pattern = f'%{text}%'
+    return (f' AND ({alias}.title ILIKE %s OR {alias}.notes ILIKE %s)',
+            [pattern, pattern], None)
+
+def search_rank(tsquery, alias='e'):
+    """Return (sql, params) for a relevance ORDER BY expression"""
+    return f"ts_rank({alias}.search_vector, to_tsquery('{SEARCH_CONFIG}', %s))", [tsquery]
+
+def date_clause(start, end, alias='e'):
+    """Compile a date window into sargable predicates; returns (sql, params)"""
+    sql = ''
+    params = []
+    if start is not None:
+        sql += f' AND {alias}.date >= %s'
+        params.append(start)
+    if end is not None:
+        sql += f' AND {alias}.date < %s'
+        params.append(end)
+    return sql, params
+
+def build_expense_where(filters, alias='e'):
+    """Compile parsed filters into ' AND ...' predicates with bound parameters.
+
+    The caller supplies the leading user_id predicate; everything here only
+    narrows it, so the (user_id, date) index stays usable.
+    """
+    sql, params = date_clause(filters['start'], filters['end'], alias)
+
+    if filters['categories']:
+        # Names are resolved from the in-memory catalog; unknown names match nothing
+        sql += f' AND {alias}.category_id = ANY(%s)'
+        params.append(catalog.ids_for_names(filters['categories']))
+
+    if filters['min_amount'] is not None:
+        sql += f' AND {alias}.amount >= %s'
+        params.append(filters['min_amount'])
+    if filters['max_amount'] is not None:
+        sql += f' AND {alias}.amount <= %s'
+        params.append(filters['max_amount'])
+
+    search_sql, search_params, _ = search_clause(filters, alias)
+    sql += search_sql
+    params.extend(search_params)
+
+    return sql, params
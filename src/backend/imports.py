@@ -0,0 +1,223 @@
+from flask import Blueprint, request, jsonify, g
+from db import get_db_connection
+from auth import token_required
+from versions import bump_user_version
+from catalog import catalog
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+import csv
+import io
+import json
+import os
+import rollups
+
+bp = Blueprint('imports', __name__, url_prefix='/api/expenses')
+
+# Rows loaded per COPY + commit; a failed chunk never affects the others
+CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 5000))
+# Per-row errors returned to the client; the failed count is always complete
+MAX_REPORTED_ERRORS = 1000
+# expenses.amount is DECIMAL(10, 2)
+MAX_AMOUNT = Decimal('99999999.99')
+
+COPY_COLUMNS = ('user_id', 'title', 'amount', 'date', 'category_id', 'notes', 'receipt_url')
+
+class RowError(ValueError):
+    """Raised when an uploaded row fails validation"""
+
+def _read_csv(stream):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    for row in reader:
+        yield row
+
+def _read_ndjson(stream):
+    for raw in io.TextIOWrapper(stream, encoding='utf-8'):
+        raw = raw.strip()
+        if not raw:
+            continue
+        try:
+            row = json.loads(raw)
+        except ValueError as e:
+            yield RowError(f'Invalid JSON: {e}')
+            continue
+        yield row if isinstance(row, dict) else RowError('Each line must be a JSON object')
+
+def _upload_reader():
+    """Pick a streaming row reader for the request body or uploaded file"""
+    upload = request.files.get('file')
+    if upload is not None:
+        stream, filename, mimetype = upload.stream, upload.filename or '', upload.mimetype
+    else:
+        stream, filename, mimetype = request.stream, '', request.mimetype
+
+    fmt = request.args.get('format')
+    if fmt is None:
+        if mimetype in ('application/x-ndjson', 'application/jsonl') or filename.endswith(('.ndjson', '.jsonl')):
+            fmt = 'ndjson'
+        elif mimetype == 'text/csv' or filename.endswith('.csv'):
+            fmt = 'csv'
+
+    if fmt == 'csv':
+        return _read_csv(stream)
+    if fmt == 'ndjson':
+        return _read_ndjson(stream)
+    return None
+
+def _resolve_category(row, categories):
+    """Resolve categoryId or category (name) against the preloaded catalog"""
+    category_id = row.get('categoryId') or row.get('category_id')
+    if category_id not in (None, ''):
+        try:
+            category_id = int(category_id)
+        except (TypeError, ValueError):
+            raise RowError(f'Invalid categoryId: {category_id}')
+        if category_id not in categories['ids']:
+            raise RowError(f'Unknown categoryId: {category_id}')
+        return category_id
+
+    name = row.get('category')
+    if name:
+        category_id = categories['names'].get(str(name).strip().lower())
+        if category_id is None:
+            raise RowError(f'Unknown category: {name}')
+        return category_id
+
+    raise RowError('Missing required field: categoryId')
+
+def category_lookup():
+    """Category ids and lower-cased names from the catalog, as validate_row expects"""
+    snapshot = catalog.all()
+    return {
+        'ids': {row['id'] for row in snapshot},
+        'names': {row['name'].lower(): row['id'] for row in snapshot}
+    }
+
+def _optional_text(row, *names):
+    """First non-empty value among the field names; NDJSON and JSON bodies may carry any type"""
+    for name in names:
+        value = row.get(name)
+        if value is None or value == '':
+            continue
+        if not isinstance(value, str):
+            raise RowError(f'{names[0]} must be a string')
+        return value
+    return None
+
+def validate_row(row, user_id, categories):
+    """Validate one uploaded row and return the tuple to load, in COPY_COLUMNS order"""
+    title = (_optional_text(row, 'title') or '').strip()
+    if not title:
+        raise RowError('Missing required field: title')
+    if len(title) > 255:
+        raise RowError('title is longer than 255 characters')
+
+    try:
+        amount = Decimal(str(row.get('amount', '')).strip()).quantize(Decimal('0.01'))
+    except (InvalidOperation, ValueError):
+        raise RowError(f"Invalid amount: {row.get('amount')}")
+    if not amount.is_finite() or abs(amount) > MAX_AMOUNT:
+        raise RowError(f"Invalid amount: {row.get('amount')}")
+
+    raw_date = str(row.get('date') or '').strip()
+    try:
+        date = datetime.fromisoformat(raw_date.replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        raise RowError(f'Invalid date: {raw_date}')
+
+    category_id = _resolve_category(row, categories)
+    notes = _optional_text(row, 'notes')
+    receipt_url = _optional_text(row, 'receiptUrl', 'receipt_url')
+
+    return (user_id, title, amount, date, category_id, notes, receipt_url)
+
+def _copy_value(value):
+    """Encode a value for COPY ... FROM STDIN text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+def load_chunk(conn, user_id, rows):
+    """Load validated rows with COPY, update rollups and commit as one transaction"""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    cur = conn.cursor()
+    try:
+        cur.copy_expert(f"COPY expenses ({', '.join(COPY_COLUMNS)}) FROM STDIN", buffer)
+        rollups.record(cur, added=[
+            {'user_id': row[0], 'amount': row[2], 'date': row[3], 'category_id': row[4]}
+            for row in rows
+        ])
+        bump_user_version(cur, user_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+@bp.route('/import', methods=['POST'])
+@token_required
+def import_expenses():
+    user_id = g.current_user['id']
+
+    reader = _upload_reader()
+    if reader is None:
+        return jsonify({'message': 'Upload CSV (text/csv) or NDJSON (application/x-ndjson)'}), 415
+
+    conn = get_db_connection()
+    # One catalog snapshot used to validate every row
+    categories = category_lookup()
+    conn.commit()
+
+    imported = 0
+    failed = 0
+    errors = []
+
+    def report(row_number, message):
+        nonlocal failed
+        failed += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({'row': row_number, 'message': message})
+
+    def flush(chunk):
+        nonlocal imported
+        try:
+            load_chunk(conn, user_id, [row for _, row in chunk])
+            imported += len(chunk)
+        except Exception as e:
+            for row_number, _ in chunk:
+                report(row_number, f'Database error: {str(e)}')
+
+    chunk = []
+    try:
+        for row_number, row in enumerate(reader, start=1):
+            try:
+                if isinstance(row, RowError):
+                    raise row
+                chunk.append((row_number, validate_row(row, user_id, categories)))
+            except RowError as e:
+                report(row_number, str(e))
+                continue
+
+            if len(chunk) >= CHUNK_SIZE:
+                flush(chunk)
+                chunk = []
+    except (UnicodeDecodeError, csv.Error) as e:
+        report(None, f'Could not read upload: {str(e)}')
+
+    if chunk:
+        flush(chunk)
+
+    return jsonify({
+        'imported': imported,
+        'failed': failed,
+        'errors': errors,
+        'errorsTruncated': failed > len(errors)
+    }), 200
@@ -0,0 +1,324 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+import psycopg2
+from psycopg2.extras import execute_values
+import rollups
+import shards
+from db import each_shard, get_shard_pool
+from versions import bump_user_version
+
+logger = logging.getLogger(__name__)
+
+# Queued creates are opt-in per request with "Prefer: respond-async"
+ENABLED = os.environ.get('INGEST_QUEUE_ENABLED', 'true').lower() == 'true'
+SPOOL_DIR = os.environ.get('INGEST_SPOOL_DIR', os.path.join(os.path.dirname(__file__), 'spool'))
+# Seconds between flushes, and rows per INSERT statement / transaction
+FLUSH_INTERVAL = float(os.environ.get('INGEST_FLUSH_INTERVAL', 0.2))
+BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 500))
+# Rows accepted but not yet written before new requests get 503
+MAX_PENDING = int(os.environ.get('INGEST_MAX_PENDING', 50000))
+# Idempotency keys are remembered this long
+KEY_TTL_HOURS = float(os.environ.get('INGEST_KEY_TTL_HOURS', 72))
+
+class IngestQueueFull(Exception):
+    """Raised when the ingestion backlog is at INGEST_MAX_PENDING"""
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class IngestQueue:
+    """Durable, write-coalescing queue for expense creates.
+
+    enqueue() appends the row to this worker's spool file and returns once it
+    is fsynced; concurrent callers share one fsync. A background thread swaps
+    to a new spool segment every FLUSH_INTERVAL, writes the previous segment
+    with multi-row INSERTs and deletes the file only after the rows commit.
+    Idempotency keys are recorded in the same transaction, so replaying a
+    segment after a crash, or a client retrying, never duplicates a row.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._pid = None
+        self._token = None
+        self._file = None
+        self._path = None
+        self._segment = 0
+        self._records = []
+        self._written = 0
+        self._fsynced = 0
+        self._syncing = False
+        self._segments = []      # (path, records) waiting to be written
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self.accepted = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.flushes = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def _start(self):
+        """Open this process's spool and writer thread; adopt spools of dead workers"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # PIDs are reused (a restarted container worker is often PID 1 again),
+            # so segment names also carry a token unique to this process start
+            self._token = secrets.token_hex(4)
+            self._segment = 0
+            os.makedirs(SPOOL_DIR, exist_ok=True)
+            self._records, self._segments = [], []
+            self._written = self._fsynced = 0
+            self._adopt_orphans()
+            self._open_segment()
+            threading.Thread(target=self._run, name='ingest-writer', daemon=True).start()
+
+    def _adopt_orphans(self):
+        # Nothing of this process start is on disk yet, so a segment carrying our
+        # own PID was left by an earlier process that had the same PID
+        for path in sorted(glob.glob(os.path.join(SPOOL_DIR, '*.ndjson'))):
+            owner = int(os.path.basename(path).split('-', 1)[0])
+            if owner != self._pid and _pid_alive(owner):
+                continue
+            adopted = self._segment_path()
+            try:
+                # Atomic: when two workers race for a file only one rename succeeds
+                os.rename(path, adopted)
+            except FileNotFoundError:
+                continue
+            with open(adopted) as f:
+                records = [json.loads(line) for line in f if line.endswith('\n')]
+            logger.info('Replaying %s queued expenses from %s', len(records), path)
+            self._segments.append((adopted, records))
+
+    def _segment_path(self):
+        self._segment += 1
+        return os.path.join(SPOOL_DIR, f'{self._pid}-{self._token}-{self._segment:08d}.ndjson')
+
+    def _open_segment(self):
+        self._path = self._segment_path()
+        # 'x': never append to a segment that already holds someone's rows
+        self._file = open(self._path, 'x')
+
+    def enqueue(self, record):
+        """Durably queue one validated row; returns after it is on disk"""
+        self._start()
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self.pending() >= MAX_PENDING:
+                raise IngestQueueFull('Ingestion queue is full')
+            self._file.write(line)
+            self._records.append(record)
+            self._written += 1
+            self.accepted += 1
+            position = self._written
+
+            # Group commit: one caller fsyncs on behalf of everyone waiting
+            while self._fsynced < position:
+                if self._syncing:
+                    self._synced.wait()
+                    continue
+                self._syncing = True
+                self._file.flush()
+                target, fd = self._written, self._file.fileno()
+                self._lock.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self._lock.acquire()
+                    self._syncing = False
+                self._fsynced = max(self._fsynced, target)
+                self._synced.notify_all()
+        if len(self._records) >= BATCH_SIZE:
+            self._wake.set()
+
+    def pending(self):
+        return len(self._records) + sum(len(records) for _, records in self._segments)
+
+    def _rotate(self):
+        """Seal the current segment and queue it for writing"""
+        with self._lock:
+            while self._syncing:
+                self._synced.wait()
+            if not self._records:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._fsynced = self._written
+            self._synced.notify_all()
+            self._segments.append((self._path, self._records))
+            self._records = []
+            self._open_segment()
+
+    def _run(self):
+        last_cleanup = 0
+        while True:
+            self._wake.wait(FLUSH_INTERVAL)
+            self._wake.clear()
+            try:
+                self.flush()
+                if time.monotonic() - last_cleanup > 3600:
+                    self._expire_keys()
+                    last_cleanup = time.monotonic()
+            except Exception:
+                self.failures += 1
+                logger.exception('Ingestion flush failed; will retry')
+                time.sleep(min(FLUSH_INTERVAL * 10, 5))
+
+    def flush(self):
+        """Write every sealed segment, oldest first, deleting each once committed"""
+        self._start()
+        with self._flush_lock:
+            self._rotate()
+            while self._segments:
+                path, records = self._segments[0]
+                by_shard = {}
+                for record in records:
+                    by_shard.setdefault(shards.shard_for(record['user_id']), []).append(record)
+                for shard, shard_records in sorted(by_shard.items()):
+                    with get_shard_pool(shard).connection() as conn:
+                        for start in range(0, len(shard_records), BATCH_SIZE):
+                            self._write_or_split(conn, shard_records[start:start + BATCH_SIZE])
+                os.remove(path)
+                with self._lock:
+                    self._segments.pop(0)
+                self.flushes += 1
+
+    def _write_or_split(self, conn, records):
+        """Write a batch; if a row violates a constraint, write the rest one by one"""
+        try:
+            self._write_batch(conn, records)
+        except (psycopg2.IntegrityError, psycopg2.DataError):
+            for record in records:
+                try:
+                    self._write_batch(conn, [record])
+                except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+                    self._reject(record, e)
+
+    def _reject(self, record, error):
+        """Set aside a row the database will never accept so it cannot block the queue"""
+        self.rejected += 1
+        logger.error('Dropping queued expense %s for user %s: %s', record['key'], record['user_id'], error)
+        with open(os.path.join(SPOOL_DIR, 'rejected.jsonl'), 'a') as f:
+            f.write(json.dumps(dict(record, error=str(error).strip())) + '\n')
+
+    def _write_batch(self, conn, records):
+        # A retry of the same key within one batch is written once
+        unique = {}
+        for record in records:
+            unique.setdefault((record['user_id'], record['key']), record)
+        rows = [
+            (r['user_id'], r['key'], r['title'], r['amount'], r['date'], r['category_id'],
+             r['notes'], r['receipt_url'])
+            for r in unique.values()
+        ]
+        cur = conn.cursor()
+        try:
+            if shards.enabled():
+                # Wait for moves in progress; users that left this shard are retried later
+                users = sorted({r['user_id'] for r in unique.values()})
+                cur.execute('SELECT pg_advisory_xact_lock_shared(%s, user_id) FROM unnest(%s::int[]) AS user_id',
+                            (shards.MOVE_LOCK_CLASS, users))
+                cur.execute('SELECT id FROM users WHERE id = ANY(%s)', (users,))
+                moved = set(users) - {row['id'] for row in cur.fetchall()}
+                if moved:
+                    for user_id in moved:
+                        shards.forget(user_id)
+                    raise shards.UserMoved(f'users {sorted(moved)} moved during ingestion')
+            added = execute_values(cur, """
+                WITH input (user_id, key, title, amount, date, category_id, notes, receipt_url) AS (
+                    VALUES %s
+                ),
+                fresh AS (
+                    INSERT INTO expense_idempotency_keys (user_id, key)
+                    SELECT user_id, key FROM input
+                    ON CONFLICT DO NOTHING
+                    RETURNING user_id, key
+                )
+                INSERT INTO expenses (user_id, title, amount, date, category_id, notes, receipt_url)
+                SELECT i.user_id, i.title, i.amount, i.date, i.category_id, i.notes, i.receipt_url
+                FROM input i
+                JOIN fresh USING (user_id, key)
+                RETURNING user_id, amount, date, category_id
+            """, rows,
+                template='(%s::int, %s, %s, %s::numeric, %s::timestamp, %s::int, %s, %s)',
+                page_size=len(rows), fetch=True)
+            rollups.record(cur, added=added)
+            for user_id in sorted({row['user_id'] for row in added}):
+                bump_user_version(cur, user_id)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+        self.inserted += len(added)
+        self.duplicates += len(records) - len(added)
+
+    def _expire_keys(self):
+        for _, pool in each_shard():
+            with pool.connection() as conn:
+                cur = conn.cursor()
+                cur.execute("DELETE FROM expense_idempotency_keys WHERE created_at < NOW() - %s * INTERVAL '1 hour'",
+                            (KEY_TTL_HOURS,))
+                conn.commit()
+                cur.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': self.pending(),
+                'accepted': self.accepted,
+                'inserted': self.inserted,
+                'duplicates': self.duplicates,
+                'flushes': self.flushes,
+                'failures': self.failures,
+                'rejected': self.rejected,
+            }
+
+queue = IngestQueue()
+
+def wants_async(request):
+    """True when the client asked for a queued create"""
+    return ENABLED and 'respond-async' in request.headers.get('Prefer', '')
+
+def to_record(row, key):
+    """Spool representation of a validated row from imports.validate_row"""
+    user_id, title, amount, date, category_id, notes, receipt_url = row
+    return {
+        'user_id': user_id,
+        'key': key,
+        'title': title,
+        'amount': str(amount),
+        'date': date.isoformat(),
+        'category_id': category_id,
+        'notes': notes,
+        'receipt_url': receipt_url,
+    }
+
+@atexit.register
+def _drain():
+    # Best effort; anything left in the spool is replayed by the next worker
+    if queue._pid == os.getpid():
+        try:
+            queue.flush()
+        except Exception:
+            pass
@@ -0,0 +1,173 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from flask import Response, g, has_request_context, request
+from psycopg2.extras import RealDictCursor
+
+# Seconds; covers sub-millisecond cached reads up to pathological queries
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROW_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 100000)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Histogram:
+    """Cumulative histogram per label set, rendered in Prometheus text format"""
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count))
+                            for labels, (counts, total, count) in self._series.items())
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _labels(self.labelnames, labels, [('le', _number(bound))])
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            le = _labels(self.labelnames, labels, [('le', '+Inf')])
+            lines.append(f'{self.name}_bucket{le} {count}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {count}')
+        return lines
+
+class Gauge:
+    """Values read from a callback at scrape time; the callback returns {labels: value}"""
+
+    def __init__(self, name, help, labelnames, collect):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        for labels, value in sorted((self.collect() or {}).items()):
+            lines.append(f'{self.name}{_labels(self.labelnames, labels)} {value}')
+        return lines
+
+REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', 'Time spent handling a request, by route.',
+    ('route', 'method', 'status'))
+AUTH_DURATION = Histogram(
+    'auth_duration_seconds', 'Time spent verifying the token and loading the user, by route.',
+    ('route',))
+QUERY_DURATION = Histogram(
+    'db_query_duration_seconds', 'Time spent in cursor.execute, by route and statement.',
+    ('route', 'statement'))
+QUERY_ROWS = Histogram(
+    'db_query_rows', 'Rows returned or affected per statement, by route and statement.',
+    ('route', 'statement'), buckets=ROW_BUCKETS)
+POOL_WAIT = Histogram(
+    'db_pool_checkout_wait_seconds', 'Time spent waiting to check out a pooled connection.')
+
+registry = [REQUEST_DURATION, AUTH_DURATION, QUERY_DURATION, QUERY_ROWS, POOL_WAIT]
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+def current_route():
+    """Label for the code path issuing a query: the Flask endpoint, if any"""
+    if has_request_context():
+        return request.endpoint or 'unmatched'
+    return 'background'
+
+_TARGET = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+([a-z_][a-z0-9_]*)', re.IGNORECASE)
+
+def statement_label(query):
+    """Low-cardinality name for a statement, e.g. 'SELECT COUNT expenses' or 'UPDATE users'"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    elif not isinstance(query, str):
+        query = str(query)
+    text = query.lstrip().lstrip('(')
+    verb = text.split(None, 1)[0].upper() if text else ''
+    if verb == 'WITH':
+        verb = 'CTE'
+    elif verb == 'SELECT' and re.match(r'SELECT\s+COUNT\(', text, re.IGNORECASE):
+        verb = 'SELECT COUNT'
+    target = _TARGET.search(query)
+    return f'{verb} {target.group(1).lower()}' if target else verb
+
+# Callables invoked as observer(query, vars, seconds) after every statement
+query_observers = []
+
+class InstrumentedCursor(RealDictCursor):
+    """RealDictCursor that records the duration and row count of every execute"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(query, vars, started)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self._record(sql, None, started)
+
+    def _record(self, query, vars, started):
+        elapsed = time.perf_counter() - started
+        labels = (current_route(), statement_label(query))
+        QUERY_DURATION.observe(elapsed, *labels)
+        QUERY_ROWS.observe(max(self.rowcount, 0), *labels)
+        for observer in query_observers:
+            observer(query, vars, elapsed)
+
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+def _record_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        REQUEST_DURATION.observe(time.perf_counter() - started, request.endpoint or 'unmatched',
+                                 request.method, str(response.status_code))
+    return response
+
+def metrics_endpoint():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    """Time every request and serve the registry at /api/metrics."""
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    app.add_url_rule('/api/metrics', 'metrics', metrics_endpoint, methods=['GET'])
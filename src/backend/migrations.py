@@ -0,0 +1,303 @@
+import os
+import click
+from flask.cli import with_appcontext
+from db import each_shard, get_pool, shard_count
+
+# Arbitrary key for pg_advisory_lock so concurrent workers never migrate twice
+MIGRATION_LOCK_ID = 724_611_201
+
+# Ordered list of (version, description, statements). Applied migrations are
+# recorded in schema_migrations; never edit one that has shipped, add a new one.
+MIGRATIONS = [
+    (1, 'Initial schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            email VARCHAR(255) UNIQUE NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            display_name VARCHAR(255),
+            photo_url TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS categories (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            color VARCHAR(50) NOT NULL,
+            UNIQUE(name)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS expenses (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            title VARCHAR(255) NOT NULL,
+            amount DECIMAL(10, 2) NOT NULL,
+            date TIMESTAMP NOT NULL,
+            category_id INTEGER REFERENCES categories(id) ON DELETE SET NULL,
+            notes TEXT,
+            receipt_url TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        INSERT INTO categories (name, color) VALUES
+            ('Food', '#FF5733'),
+            ('Transportation', '#33A8FF'),
+            ('Housing', '#33FF57'),
+            ('Entertainment', '#F033FF'),
+            ('Utilities', '#FFFF33'),
+            ('Healthcare', '#FF3333'),
+            ('Shopping', '#33FFF0'),
+            ('Education', '#8033FF'),
+            ('Travel', '#FF8033'),
+            ('Others', '#AAAAAA')
+        ON CONFLICT (name) DO NOTHING
+        ''',
+    ]),
+    (2, 'Indexes for expense list and summary queries', [
+        # Serves WHERE user_id = ? AND date range ORDER BY date DESC, id DESC
+        # (offset and keyset pages); the INCLUDE columns let the summary
+        # aggregates run as index-only scans.
+        '''
+        CREATE INDEX IF NOT EXISTS idx_expenses_user_date
+        ON expenses (user_id, date DESC, id DESC) INCLUDE (category_id, amount)
+        ''',
+        # Category delete checks and ON DELETE SET NULL
+        'CREATE INDEX IF NOT EXISTS idx_expenses_category ON expenses (category_id)',
+    ]),
+    (3, 'Full-text and trigram search on expense title and notes', [
+        '''
+        ALTER TABLE expenses ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            to_tsvector('simple', COALESCE(title, '') || ' ' || COALESCE(notes, ''))
+        ) STORED
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_expenses_search ON expenses USING GIN (search_vector)',
+        # Trigram indexes make the substring (ILIKE) fallback indexable. pg_trgm
+        # needs sufficient privileges, so its absence is not fatal.
+        '''
+        DO $$
+        BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        EXCEPTION WHEN OTHERS THEN
+            RAISE NOTICE 'pg_trgm unavailable (%), substring search stays unindexed', SQLERRM;
+        END
+        $$
+        ''',
+        '''
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+                CREATE INDEX IF NOT EXISTS idx_expenses_title_trgm
+                    ON expenses USING GIN (title gin_trgm_ops);
+                CREATE INDEX IF NOT EXISTS idx_expenses_notes_trgm
+                    ON expenses USING GIN (notes gin_trgm_ops);
+            END IF;
+        END
+        $$
+        ''',
+    ]),
+    (4, 'Per-day expense rollups for the summary endpoint', [
+        '''
+        CREATE TABLE IF NOT EXISTS expense_daily_rollups (
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            day DATE NOT NULL,
+            category_id INTEGER NOT NULL DEFAULT 0,
+            total DECIMAL(14, 2) NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, category_id)
+        )
+        ''',
+        '''
+        INSERT INTO expense_daily_rollups (user_id, day, category_id, total, count)
+        SELECT user_id, date::date, COALESCE(category_id, 0), SUM(amount), COUNT(*)
+        FROM expenses
+        WHERE user_id IS NOT NULL
+        GROUP BY 1, 2, 3
+        ON CONFLICT DO NOTHING
+        ''',
+    ]),
+    (5, 'Data versions for conditional GET', [
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS data_version BIGINT NOT NULL DEFAULT 0',
+        '''
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+        'INSERT INTO catalog_version (id) VALUES (TRUE) ON CONFLICT DO NOTHING',
+    ]),
+    (6, 'Slow query log', [
+        '''
+        CREATE TABLE IF NOT EXISTS slow_queries (
+            id BIGSERIAL PRIMARY KEY,
+            fingerprint VARCHAR(16) NOT NULL,
+            route VARCHAR(100) NOT NULL,
+            normalized_sql TEXT NOT NULL,
+            param_shape TEXT NOT NULL,
+            duration_ms DOUBLE PRECISION NOT NULL,
+            plan JSONB,
+            captured_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_slow_queries_captured ON slow_queries (captured_at)',
+        'CREATE INDEX IF NOT EXISTS idx_slow_queries_fingerprint ON slow_queries (fingerprint, captured_at DESC)',
+    ]),
+    (7, 'Compact archive for old expenses', [
+        # One row per user and month; each expense column is an array so the
+        # month compresses as a few TOASTed values. toast_tuple_target makes
+        # even small months move out of line and get compressed.
+        '''
+        CREATE TABLE IF NOT EXISTS expenses_archive (
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            month DATE NOT NULL,
+            ids INTEGER[] NOT NULL,
+            titles TEXT[] NOT NULL,
+            amounts DECIMAL(10, 2)[] NOT NULL,
+            dates TIMESTAMP[] NOT NULL,
+            category_ids INTEGER[] NOT NULL,
+            notes TEXT[] NOT NULL,
+            receipt_urls TEXT[] NOT NULL,
+            created_ats TIMESTAMP[] NOT NULL,
+            updated_ats TIMESTAMP[] NOT NULL,
+            PRIMARY KEY (user_id, month)
+        ) WITH (toast_tuple_target = 128)
+        ''',
+        # Category delete checks
+        'CREATE INDEX IF NOT EXISTS idx_expenses_archive_categories ON expenses_archive USING GIN (category_ids)',
+    ]),
+    (8, 'Idempotency keys for queued expense creates', [
+        '''
+        CREATE TABLE IF NOT EXISTS expense_idempotency_keys (
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            key VARCHAR(255) NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, key)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_expense_idempotency_keys_created ON expense_idempotency_keys (created_at)',
+    ]),
+    (9, 'Global user directory for sharding', [
+        '''
+        CREATE TABLE IF NOT EXISTS user_directory (
+            user_id INTEGER PRIMARY KEY,
+            email VARCHAR(255) UNIQUE NOT NULL,
+            shard INTEGER NOT NULL DEFAULT 0,
+            moved_at TIMESTAMP
+        )
+        ''',
+        # Every existing user lives in the primary database, shard 0
+        '''
+        INSERT INTO user_directory (user_id, email, shard)
+        SELECT id, email, 0 FROM users
+        ON CONFLICT DO NOTHING
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_user_directory_shard ON user_directory (shard)',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def current_version(cur):
+    """Return the highest applied migration version, or 0 on a fresh database"""
+    cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL AS present")
+    if not cur.fetchone()['present']:
+        return 0
+    cur.execute('SELECT COALESCE(MAX(version), 0) AS version FROM schema_migrations')
+    return cur.fetchone()['version']
+
+def migrate(conn, target=None, echo=print):
+    """Apply pending migrations up to target (default: latest), one transaction each"""
+    target = LATEST_VERSION if target is None else target
+    cur = conn.cursor()
+    applied = []
+
+    cur.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+    try:
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        conn.commit()
+
+        version = current_version(cur)
+        for number, description, statements in MIGRATIONS:
+            if number <= version or number > target:
+                continue
+            try:
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute(
+                    'INSERT INTO schema_migrations (version, description) VALUES (%s, %s)',
+                    (number, description)
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            echo(f'Applied migration {number}: {description}')
+            applied.append(number)
+    finally:
+        cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID,))
+        conn.commit()
+        cur.close()
+
+    return applied
+
+def check_schema(app):
+    """Cheap startup check that the database schema is up to date.
+
+    Pending migrations are applied when DB_AUTO_MIGRATE is enabled; otherwise
+    a warning points at the migrate command.
+    """
+    auto_migrate = os.environ.get('DB_AUTO_MIGRATE', 'false').lower() == 'true'
+
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        version = current_version(cur)
+        cur.close()
+        conn.rollback()
+
+        if version >= LATEST_VERSION:
+            return
+        if auto_migrate:
+            migrate(conn, echo=app.logger.info)
+        else:
+            app.logger.warning(
+                'Database schema is at version %s, latest is %s. Run "flask --app app migrate".',
+                version, LATEST_VERSION
+            )
+
+@click.command('migrate')
+@click.option('--target', type=int, default=None, help='Stop after this migration version.')
+@click.option('--status', is_flag=True, help='Show applied and pending migrations without applying them.')
+@with_appcontext
+def migrate_command(target, status):
+    """Apply pending database migrations."""
+    # Every shard has the full schema; only the primary's user_directory is used
+    for shard, pool in each_shard():
+        if shard_count() > 1:
+            click.echo(f'shard {shard}:')
+        with pool.connection() as conn:
+            if status:
+                cur = conn.cursor()
+                version = current_version(cur)
+                cur.close()
+                for number, description, _ in MIGRATIONS:
+                    state = 'applied' if number <= version else 'pending'
+                    click.echo(f'{number:>4}  {state:<8} {description}')
+                continue
+
+            applied = migrate(conn, target=target, echo=click.echo)
+            if not applied:
+                click.echo('Database schema is up to date.')
+
+def init_app(app):
+    """Register migration commands with the Flask app."""
+    app.cli.add_command(migrate_command)
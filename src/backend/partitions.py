@@ -0,0 +1,307 @@
+import click
+import os
+from datetime import date, datetime
+from flask.cli import with_appcontext
+from db import each_shard, shard_count
+from rollups import UNCATEGORIZED
+
+# expenses can be converted to a table partitioned by RANGE (date), one
+# partition per month or year plus a default partition for outliers. The
+# conversion is opt-in (flask partitions convert) because it rewrites the table.
+
+INTERVALS = ('month', 'year')
+# Future partitions kept ready so inserts never land in the default partition
+AHEAD = int(os.environ.get('EXPENSE_PARTITIONS_AHEAD', 3))
+MAINTENANCE_LOCK_ID = 724_611_202
+DEFAULT_PARTITION = 'expenses_default'
+
+def _period_start(day, interval):
+    return date(day.year, day.month if interval == 'month' else 1, 1)
+
+def _next_period(start, interval):
+    if interval == 'year':
+        return date(start.year + 1, 1, 1)
+    return date(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+def partition_name(start, interval):
+    return f'expenses_p{start:%Y}' if interval == 'year' else f'expenses_p{start:%Y_%m}'
+
+def get_interval(cur):
+    """Return the partitioning interval, or None while expenses is a plain table"""
+    cur.execute("SELECT to_regclass('expense_partitioning') IS NOT NULL AS present")
+    if not cur.fetchone()['present']:
+        return None
+    cur.execute('SELECT interval FROM expense_partitioning')
+    row = cur.fetchone()
+    return row['interval'] if row else None
+
+def list_partitions(cur):
+    """Return the partitions of expenses with their bounds, size and row estimate"""
+    cur.execute("""
+        SELECT c.relname AS name,
+               pg_get_expr(c.relpartbound, c.oid) AS bounds,
+               pg_total_relation_size(c.oid) AS bytes,
+               GREATEST(c.reltuples, 0)::bigint AS rows
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'expenses'::regclass
+        ORDER BY c.relname
+    """)
+    return cur.fetchall()
+
+def _insert_columns(cur, table):
+    """Columns of table that can be inserted into, i.e. all but generated ones"""
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND is_generated = 'NEVER'
+        ORDER BY ordinal_position
+    """, (table,))
+    return ', '.join(row['column_name'] for row in cur.fetchall())
+
+def _create_partition(cur, start, interval):
+    """Create the partition for the period starting at start unless it exists.
+
+    Rows already sitting in the default partition for that period are moved
+    into the new partition, which PostgreSQL would otherwise refuse to create.
+    """
+    name = partition_name(start, interval)
+    cur.execute('SELECT to_regclass(%s) IS NOT NULL AS present', (name,))
+    if cur.fetchone()['present']:
+        return None
+    end = _next_period(start, interval)
+
+    cur.execute(f'SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE date >= %s AND date < %s) AS stray',
+                (start, end))
+    if not cur.fetchone()['stray']:
+        cur.execute(f'CREATE TABLE {name} PARTITION OF expenses FOR VALUES FROM (%s) TO (%s)',
+                    (start, end))
+        return name
+
+    columns = _insert_columns(cur, 'expenses')
+    cur.execute(f'CREATE TABLE {name} (LIKE expenses INCLUDING DEFAULTS INCLUDING GENERATED)')
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION} WHERE date >= %s AND date < %s RETURNING *
+        )
+        INSERT INTO {name} ({columns}) SELECT {columns} FROM moved
+    """, (start, end))
+    cur.execute(f'ALTER TABLE expenses ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)',
+                (start, end))
+    return name
+
+def ensure_partitions(conn, ahead=AHEAD, today=None):
+    """Create any missing partitions from the current period through `ahead` periods out"""
+    cur = conn.cursor()
+    try:
+        interval = get_interval(cur)
+        if interval is None:
+            conn.rollback()
+            return []
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (MAINTENANCE_LOCK_ID,))
+        start = _period_start(today or date.today(), interval)
+        created = []
+        for _ in range(ahead + 1):
+            name = _create_partition(cur, start, interval)
+            if name:
+                created.append(name)
+            start = _next_period(start, interval)
+        conn.commit()
+        return created
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def convert(conn, interval, echo=print):
+    """Rebuild expenses as a partitioned table, copying every row.
+
+    Runs in one transaction under an ACCESS EXCLUSIVE lock, so expense reads
+    and writes wait until it finishes. Indexes are recreated from their
+    current definitions and the id sequence is kept.
+    """
+    if interval not in INTERVALS:
+        raise ValueError(f'interval must be one of {", ".join(INTERVALS)}')
+
+    cur = conn.cursor()
+    try:
+        if get_interval(cur) is not None:
+            raise click.ClickException('expenses is already partitioned')
+
+        cur.execute('LOCK TABLE expenses IN ACCESS EXCLUSIVE MODE')
+        cur.execute("""
+            SELECT indexdef FROM pg_indexes
+            WHERE schemaname = current_schema() AND tablename = 'expenses'
+              AND indexname <> 'expenses_pkey'
+        """)
+        index_definitions = [row['indexdef'] for row in cur.fetchall()]
+        columns = _insert_columns(cur, 'expenses')
+        cur.execute("SELECT MIN(date)::date AS first FROM expenses")
+        first = cur.fetchone()['first'] or date.today()
+
+        # Keep the id sequence alive when the old table is dropped
+        cur.execute('ALTER SEQUENCE expenses_id_seq OWNED BY NONE')
+        cur.execute('ALTER TABLE expenses RENAME TO expenses_unpartitioned')
+        cur.execute('ALTER INDEX expenses_pkey RENAME TO expenses_unpartitioned_pkey')
+        cur.execute("""
+            CREATE TABLE expenses (
+                LIKE expenses_unpartitioned INCLUDING DEFAULTS INCLUDING GENERATED,
+                PRIMARY KEY (id, date),
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+                FOREIGN KEY (category_id) REFERENCES categories(id) ON DELETE SET NULL
+            ) PARTITION BY RANGE (date)
+        """)
+        cur.execute(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF expenses DEFAULT')
+        cur.execute("""
+            CREATE TABLE expense_partitioning (
+                id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                interval VARCHAR(10) NOT NULL
+            )
+        """)
+        cur.execute('INSERT INTO expense_partitioning (interval) VALUES (%s)', (interval,))
+
+        start = _period_start(first, interval)
+        last = _period_start(date.today(), interval)
+        for _ in range(AHEAD):
+            last = _next_period(last, interval)
+        count = 0
+        while start <= last:
+            _create_partition(cur, start, interval)
+            start = _next_period(start, interval)
+            count += 1
+        echo(f'Created {count} {interval}ly partitions.')
+
+        cur.execute(f'INSERT INTO expenses ({columns}) SELECT {columns} FROM expenses_unpartitioned')
+        echo(f'Copied {cur.rowcount} expenses.')
+        cur.execute('DROP TABLE expenses_unpartitioned')
+        cur.execute('ALTER SEQUENCE expenses_id_seq OWNED BY expenses.id')
+        for definition in index_definitions:
+            cur.execute(definition)
+        cur.execute('ANALYZE expenses')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def _bounds(bounds):
+    # pg_get_expr renders "FOR VALUES FROM ('2024-01-01 00:00:00') TO ('2024-02-01 00:00:00')"
+    lower, upper = bounds.split("FROM ('", 1)[1].split("') TO ('")
+    return datetime.fromisoformat(lower), datetime.fromisoformat(upper.split("'")[0])
+
+def detach(conn, before, drop=False, echo=print):
+    """Detach (and optionally drop) every partition that ends on or before `before`.
+
+    Detaching is a catalog change rather than a DELETE, so it leaves no dead
+    tuples to vacuum. The rollups for the detached days are removed and the
+    affected users' data versions bumped so summaries stay consistent.
+    """
+    cur = conn.cursor()
+    detached = []
+    try:
+        for partition in list_partitions(cur):
+            if partition['name'] == DEFAULT_PARTITION:
+                continue
+            _, upper = _bounds(partition['bounds'])
+            if upper > before:
+                continue
+            name = partition['name']
+            cur.execute(f"""
+                UPDATE users SET data_version = data_version + 1
+                WHERE id IN (SELECT DISTINCT user_id FROM {name})
+            """)
+            cur.execute(f'ALTER TABLE expenses DETACH PARTITION {name}')
+            # Subtract the partition's own rows; archived expenses share these days
+            cur.execute(f"""
+                UPDATE expense_daily_rollups r
+                SET total = r.total - d.total, count = r.count - d.count
+                FROM (
+                    SELECT user_id, date::date AS day, COALESCE(category_id, {UNCATEGORIZED}) AS category_id,
+                           SUM(amount) AS total, COUNT(*) AS count
+                    FROM {name}
+                    GROUP BY 1, 2, 3
+                ) d
+                WHERE r.user_id = d.user_id AND r.day = d.day AND r.category_id = d.category_id
+            """)
+            if drop:
+                cur.execute(f'DROP TABLE {name}')
+            conn.commit()
+            detached.append(name)
+            echo(f"{'Dropped' if drop else 'Detached'} {name}.")
+        return detached
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def maintain(app):
+    """Create upcoming partitions at worker start; a no-op for an unpartitioned table"""
+    for shard, pool in each_shard():
+        with pool.connection() as conn:
+            created = ensure_partitions(conn)
+        if created:
+            app.logger.info('Created expense partitions on shard %s: %s', shard, ', '.join(created))
+
+def _shards():
+    """each_shard() for the CLI, announcing each shard when there is more than one"""
+    for shard, pool in each_shard():
+        if shard_count() > 1:
+            click.echo(f'shard {shard}:')
+        yield shard, pool
+
+@click.group('partitions')
+def partitions_cli():
+    """Manage date-range partitions of the expenses table."""
+
+@partitions_cli.command('convert')
+@click.option('--interval', type=click.Choice(INTERVALS), default='month', show_default=True)
+@with_appcontext
+def convert_command(interval):
+    """Convert expenses into a partitioned table on every shard (locks expenses while copying)."""
+    for shard, pool in _shards():
+        with pool.connection() as conn:
+            convert(conn, interval, echo=click.echo)
+    click.echo('expenses is now partitioned.')
+
+@partitions_cli.command('ensure')
+@click.option('--ahead', type=int, default=AHEAD, show_default=True, help='Future periods to create.')
+@with_appcontext
+def ensure_command(ahead):
+    """Create partitions for the current and upcoming periods."""
+    for shard, pool in _shards():
+        with pool.connection() as conn:
+            created = ensure_partitions(conn, ahead)
+        click.echo(f"Created: {', '.join(created)}" if created else 'All partitions exist.')
+
+@partitions_cli.command('list')
+@with_appcontext
+def list_command():
+    """Show partitions with their bounds, size and estimated rows."""
+    for shard, pool in _shards():
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            if get_interval(cur) is None:
+                raise click.ClickException('expenses is not partitioned')
+            for row in list_partitions(cur):
+                click.echo(f"{row['name']:<20} {row['rows']:>12} rows {row['bytes'] / 2**20:>10.1f} MiB  {row['bounds']}")
+            cur.close()
+            conn.rollback()
+
+@partitions_cli.command('detach')
+@click.option('--before', type=click.DateTime(['%Y-%m-%d']), required=True,
+              help='Detach partitions that end on or before this date.')
+@click.option('--drop', is_flag=True, help='Drop the detached partitions.')
+@with_appcontext
+def detach_command(before, drop):
+    """Detach old partitions from expenses."""
+    for shard, pool in _shards():
+        with pool.connection() as conn:
+            detached = detach(conn, before, drop=drop, echo=click.echo)
+        if not detached:
+            click.echo('Nothing to detach.')
+
+def init_app(app):
+    """Register partition commands with the Flask app."""
+    app.cli.add_command(partitions_cli)
@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+
+# bcrypt cost factor for new hashes; existing hashes are upgraded on login
+ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+# Hashes computed in parallel. bcrypt releases the GIL, so threads use real cores
+WORKERS = int(os.environ.get('HASH_WORKERS', 2))
+# Hashes allowed to wait for a worker before new ones are turned away
+QUEUE_SIZE = int(os.environ.get('HASH_QUEUE_SIZE', 16))
+# Seconds a request may wait for a queue slot before it is rejected
+ADMISSION_TIMEOUT = float(os.environ.get('HASH_ADMISSION_TIMEOUT', 0))
+
+class HashPoolBusy(Exception):
+    """Raised when the hashing queue is full"""
+
+class HashPool:
+    """A bounded thread pool for bcrypt with admission control.
+
+    At most ``workers`` hashes run at once and at most ``queue_size`` more
+    wait for a worker; beyond that callers get HashPoolBusy instead of
+    tying up their request thread.
+    """
+
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE, admission_timeout=ADMISSION_TIMEOUT):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.admission_timeout = admission_timeout
+        self._executor = None
+        self._executor_pid = None
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self.completed = 0
+        self.rejected = 0
+        # Recent per-hash timings in milliseconds
+        self._waits = deque(maxlen=1000)
+        self._durations = deque(maxlen=1000)
+
+    def _get_executor(self):
+        # Worker threads do not survive fork(); start a fresh executor per process
+        if self._executor is None or self._executor_pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._executor_pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='bcrypt')
+                    self._executor_pid = os.getpid()
+        return self._executor
+
+    def run(self, fn, *args):
+        """Run fn(*args) on a hashing worker and return its result"""
+        if self.admission_timeout > 0:
+            admitted = self._slots.acquire(timeout=self.admission_timeout)
+        else:
+            admitted = self._slots.acquire(blocking=False)
+        if not admitted:
+            with self._lock:
+                self.rejected += 1
+            raise HashPoolBusy('Password hashing is saturated')
+
+        submitted = time.perf_counter()
+        with self._lock:
+            self._pending += 1
+
+        def task():
+            started = time.perf_counter()
+            with self._lock:
+                self._pending -= 1
+                self._running += 1
+            try:
+                return fn(*args)
+            finally:
+                finished = time.perf_counter()
+                with self._lock:
+                    self._running -= 1
+                    self.completed += 1
+                    self._waits.append((started - submitted) * 1000)
+                    self._durations.append((finished - started) * 1000)
+
+        try:
+            return self._get_executor().submit(task).result()
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            durations = sorted(self._durations)
+            return {
+                'workers': self.workers,
+                'queueSize': self.queue_size,
+                'queued': self._pending,
+                'running': self._running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'waitMs': _percentiles(waits),
+                'hashMs': _percentiles(durations),
+            }
+
+def _percentiles(ordered):
+    if not ordered:
+        return None
+    pick = lambda pct: round(ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))], 2)
+    return {'p50': pick(50), 'p95': pick(95), 'max': round(ordered[-1], 2)}
+
+pool = HashPool()
+
+def hash_password(password):
+    """Hash a password at the configured cost on the hashing pool"""
+    hashed = pool.run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(ROUNDS))
+    return hashed.decode('utf-8')
+
+def check_password(password, password_hash):
+    """Verify a password against a stored hash on the hashing pool"""
+    return pool.run(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
+
+def needs_rehash(password_hash):
+    """True when a stored hash was made with a different cost than ROUNDS"""
+    try:
+        # Modular crypt format: $2b$<cost>$<salt+hash>
+        return int(password_hash.split('$')[2]) != ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+def stats():
+    return pool.stats()
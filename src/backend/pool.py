@@ -0,0 +1,191 @@
+import threading
+import time
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+from contextlib import contextmanager
+
+
+class PoolTimeout(PoolError):
+    """Raised when no connection could be checked out within the timeout"""
+
+
+class ConnectionPool:
+    """Thread-safe pool of PostgreSQL connections.
+
+    Connections are created lazily up to ``maxconn``; ``minconn`` of them are
+    opened up front and kept around. A connection that has been idle for longer
+    than ``check_interval`` seconds is pinged with ``SELECT 1`` before it is
+    handed out, and dead connections are replaced transparently.
+
+    ``on_checkout``, if given, is called with the seconds each checkout waited.
+    """
+
+    def __init__(self, minconn, maxconn, timeout=5.0, check_interval=30.0, on_checkout=None,
+                 **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError('Invalid pool size: min=%s max=%s' % (minconn, maxconn))
+
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.on_checkout = on_checkout
+        self._connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = []          # list of (connection, last_used) tuples
+        self._in_use = set()
+        self._connecting = 0     # slots reserved while a new connection is opened
+        self._closed = False
+
+        # Counters exposed through stats()
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._created = 0
+        self._discarded = 0
+
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(**self._connect_kwargs)
+        self._created += 1
+        return conn
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use) + self._connecting
+
+    def _is_healthy(self, conn, last_used):
+        """Check a connection before handing it out"""
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, timeout=None):
+        """Check out a connection, waiting up to ``timeout`` seconds"""
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolError('Connection pool is closed')
+
+                # Reserve a slot; connecting and health checks happen outside the lock
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    self._connecting += 1
+                    break
+                if self._size() < self.maxconn:
+                    conn, last_used = None, None
+                    self._connecting += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        'Timed out after %.1fs waiting for a database connection' % timeout)
+                waited = True
+                self._cond.wait(remaining)
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif not self._is_healthy(conn, last_used):
+                self._discard(conn)
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._connecting -= 1
+                self._cond.notify()
+            raise
+
+        wait = time.monotonic() - started
+        with self._cond:
+            self._connecting -= 1
+            self._in_use.add(conn)
+            self._checkouts += 1
+            if waited:
+                self._waits += 1
+            self._wait_time += wait
+            self._max_wait = max(self._max_wait, wait)
+        if self.on_checkout is not None:
+            self.on_checkout(wait)
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Return a connection to the pool"""
+        if not close and not conn.closed:
+            try:
+                # Never hand out a connection with an open transaction
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+
+        with self._cond:
+            self._in_use.discard(conn)
+            if close or conn.closed or self._closed or len(self._idle) >= self.maxconn:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self, conn):
+        self._discarded += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager that checks out a connection and always returns it"""
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        """Close every idle connection and refuse further checkouts"""
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return a snapshot of pool statistics"""
+        with self._cond:
+            return {
+                'min': self.minconn,
+                'max': self.maxconn,
+                'size': self._size(),
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'avg_wait_ms': round(self._wait_time / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                'max_wait_ms': round(self._max_wait * 1000, 3),
+                'created': self._created,
+                'discarded': self._discarded,
+            }
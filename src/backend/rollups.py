@@ -0,0 +1,172 @@
+import click
+from collections import defaultdict
+from datetime import datetime, time
+from decimal import Decimal
+from psycopg2.extras import execute_values
+from flask.cli import with_appcontext
+from db import each_shard
+from archive import ALL_EXPENSES
+
+# expense_daily_rollups keeps one row per (user, day, category) with the sum
+# and count of that user's expenses. Uncategorized expenses use category 0.
+UNCATEGORIZED = 0
+
+def _bucket(row):
+    day = row['date']
+    if isinstance(day, datetime):
+        day = day.date()
+    return row['user_id'], day, row['category_id'] or UNCATEGORIZED
+
+def record(cur, added=(), removed=()):
+    """Apply the rollup deltas for inserted and deleted expense rows.
+
+    Rows are mappings with user_id, date, category_id and amount, typically
+    straight from a RETURNING clause. Must run in the same transaction as the
+    write so the rollups commit or roll back together with it.
+    """
+    deltas = defaultdict(lambda: [Decimal(0), 0])
+    for rows, sign in ((added, 1), (removed, -1)):
+        for row in rows:
+            delta = deltas[_bucket(row)]
+            delta[0] += sign * Decimal(row['amount'])
+            delta[1] += sign
+
+    # Sorted keys keep lock order consistent between concurrent writers
+    values = [key + tuple(delta) for key, delta in sorted(deltas.items()) if delta[1] or delta[0]]
+    if not values:
+        return
+
+    execute_values(cur, """
+        INSERT INTO expense_daily_rollups AS r (user_id, day, category_id, total, count)
+        VALUES %s
+        ON CONFLICT (user_id, day, category_id) DO UPDATE
+        SET total = r.total + EXCLUDED.total, count = r.count + EXCLUDED.count
+    """, values)
+
+def is_day_aligned(start, end):
+    """True when a [start, end) window falls exactly on day boundaries"""
+    return all(bound is None or bound.time() == time.min for bound in (start, end))
+
+def range_clause(start, end):
+    """Compile a day-aligned window into predicates on the rollup day column"""
+    sql = ''
+    params = []
+    if start is not None:
+        sql += ' AND r.day >= %s'
+        params.append(start.date())
+    if end is not None:
+        sql += ' AND r.day < %s'
+        params.append(end.date())
+    return sql, params
+
+def category_totals(cur, user_id, start, end):
+    """Return {category_id: (amount, count)} for a day-aligned window from the rollups.
+
+    Uncategorized expenses are reported under UNCATEGORIZED.
+    """
+    where, params = range_clause(start, end)
+    cur.execute(
+        f"""
+        SELECT r.category_id, SUM(r.total) AS amount, SUM(r.count) AS count
+        FROM expense_daily_rollups r
+        WHERE r.user_id = %s {where}
+        GROUP BY r.category_id
+        """,
+        [user_id] + params
+    )
+    return {row['category_id']: (row['amount'], row['count']) for row in cur.fetchall()}
+
+def rebuild(conn, user_id=None):
+    """Recompute rollups from hot and archived expenses, for one user or everyone"""
+    cur = conn.cursor()
+    user_filter = ' AND user_id = %s' if user_id is not None else ''
+    params = [user_id] if user_id is not None else []
+    try:
+        # Block concurrent writers' rollup updates until the rebuild commits
+        cur.execute('LOCK TABLE expense_daily_rollups IN SHARE ROW EXCLUSIVE MODE')
+        cur.execute(f'DELETE FROM expense_daily_rollups WHERE TRUE {user_filter}', params)
+        cur.execute(f"""
+            INSERT INTO expense_daily_rollups (user_id, day, category_id, total, count)
+            SELECT user_id, date::date, COALESCE(category_id, {UNCATEGORIZED}), SUM(amount), COUNT(*)
+            FROM {ALL_EXPENSES}
+            WHERE user_id IS NOT NULL {user_filter}
+            GROUP BY 1, 2, 3
+        """, params)
+        rows = cur.rowcount
+        conn.commit()
+        return rows
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def verify(conn, user_id=None, limit=50):
+    """Return rollup buckets that disagree with hot and archived expenses"""
+    cur = conn.cursor()
+    user_filter = ' AND user_id = %s' if user_id is not None else ''
+    params = ([user_id] * 2 if user_id is not None else []) + [limit]
+    cur.execute(f"""
+        WITH actual AS (
+            SELECT user_id, date::date AS day, COALESCE(category_id, {UNCATEGORIZED}) AS category_id,
+                   SUM(amount) AS total, COUNT(*) AS count
+            FROM {ALL_EXPENSES}
+            WHERE user_id IS NOT NULL {user_filter}
+            GROUP BY 1, 2, 3
+        ), stored AS (
+            SELECT user_id, day, category_id, total, count
+            FROM expense_daily_rollups
+            WHERE count <> 0 {user_filter}
+        )
+        SELECT COALESCE(a.user_id, s.user_id) AS user_id,
+               COALESCE(a.day, s.day) AS day,
+               COALESCE(a.category_id, s.category_id) AS category_id,
+               a.total AS actual_total, s.total AS stored_total,
+               a.count AS actual_count, s.count AS stored_count
+        FROM actual a
+        FULL OUTER JOIN stored s USING (user_id, day, category_id)
+        WHERE a.total IS DISTINCT FROM s.total OR a.count IS DISTINCT FROM s.count
+        LIMIT %s
+    """, params)
+    mismatches = cur.fetchall()
+    cur.close()
+    conn.rollback()
+    return mismatches
+
+@click.group('rollups')
+def rollups_cli():
+    """Maintain the per-day expense rollups."""
+
+@rollups_cli.command('rebuild')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user.')
+@with_appcontext
+def rebuild_command(user_id):
+    """Recompute rollups from the expenses table, on every shard."""
+    rows = 0
+    for _, pool in each_shard():
+        with pool.connection() as conn:
+            rows += rebuild(conn, user_id)
+    click.echo(f'Rebuilt {rows} rollup rows.')
+
+@rollups_cli.command('verify')
+@click.option('--user-id', type=int, default=None, help='Only verify this user.')
+@with_appcontext
+def verify_command(user_id):
+    """Compare rollups with the expenses table, on every shard."""
+    mismatches = []
+    for _, pool in each_shard():
+        with pool.connection() as conn:
+            mismatches.extend(verify(conn, user_id))
+    for row in mismatches:
+        click.echo(
+            f"user {row['user_id']} {row['day']} category {row['category_id']}: "
+            f"expected {row['actual_total']} ({row['actual_count']}), "
+            f"stored {row['stored_total']} ({row['stored_count']})"
+        )
+    if mismatches:
+        raise SystemExit(1)
+    click.echo('Rollups match the expenses table.')
+
+def init_app(app):
+    """Register rollup commands with the Flask app."""
+    app.cli.add_command(rollups_cli)
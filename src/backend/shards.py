@@ -0,0 +1,407 @@
+import bisect
+import hashlib
+import io
+import logging
+import os
+import time
+import click
+from flask import g, request
+from flask.cli import with_appcontext
+from psycopg2.extras import execute_values
+from cache import TTLCache
+from db import (close_db, each_shard, get_db_connection, get_global_connection, get_pool,
+                get_shard_pool, shard_count, use_shard)
+
+logger = logging.getLogger(__name__)
+
+# Users are spread over the primary plus the DB_SHARDS databases. A user's
+# rows (users, expenses, archive, rollups, idempotency keys) live on one
+# shard; categories are copied to every shard so foreign keys and joins stay
+# local. user_directory on the primary maps every user id and email to its
+# shard. New users are placed by a consistent-hash ring, so adding a shard
+# only moves ~1/N of existing users when rebalancing.
+
+# Points per shard on the hash ring
+VNODES = int(os.environ.get('SHARD_VNODES', 64))
+# Seconds a worker trusts its cached directory entries; moves wait this long
+# before deleting the source copy
+DIRECTORY_TTL = float(os.environ.get('SHARD_DIRECTORY_TTL', 5))
+# Expense ids on shard s are s modulo ID_STRIDE, so moved rows never collide
+ID_STRIDE = 1024
+# pg_advisory_lock(MOVE_LOCK_CLASS, user_id): shared by writes, exclusive during a move
+MOVE_LOCK_CLASS = 724_611_203
+
+# Tables holding a user's rows, parents first
+USER_TABLES = ['users', 'expenses', 'expenses_archive', 'expense_daily_rollups',
+               'expense_idempotency_keys']
+
+class UserMoved(Exception):
+    """A user's rows left the shard a write was routed to; retry with a fresh directory"""
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+class HashRing:
+    """Consistent-hash ring mapping user ids to shard numbers"""
+
+    def __init__(self, shards, vnodes=VNODES):
+        points = sorted((_hash(f'shard-{shard}-{i}'), shard) for shard in shards for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def lookup(self, user_id):
+        index = bisect.bisect(self._points, _hash(str(user_id))) % len(self._points)
+        return self._shards[index]
+
+ring = HashRing(range(shard_count()))
+_directory = TTLCache(maxsize=100000, ttl=DIRECTORY_TTL)
+
+def enabled():
+    return shard_count() > 1
+
+def home_shard(user_id):
+    """Shard the ring places user_id on"""
+    return ring.lookup(user_id) if enabled() else 0
+
+def shard_for(user_id):
+    """Shard currently holding user_id's rows, from the directory"""
+    if not enabled():
+        return 0
+    shard = _directory.get(user_id)
+    if shard is None:
+        with get_pool().connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT shard FROM user_directory WHERE user_id = %s', (user_id,))
+            row = cur.fetchone()
+            cur.close()
+            conn.rollback()
+        shard = row['shard'] if row else home_shard(user_id)
+        _directory.set(user_id, shard)
+    return shard
+
+def forget(user_id):
+    """Drop a cached directory entry, e.g. after finding the user gone from a shard"""
+    _directory.pop(user_id)
+
+def lock_user(cur, user_id):
+    """Take the shared move lock for user_id and report whether the user is still on this shard"""
+    # Two statements so the existence check sees the database after the lock is granted
+    cur.execute('SELECT pg_advisory_lock_shared(%s, %s); SELECT EXISTS (SELECT 1 FROM users WHERE id = %s) AS present',
+                (MOVE_LOCK_CLASS, user_id, user_id))
+    return cur.fetchone()['present']
+
+def route_user(user_id):
+    """Send this request's user-data queries to user_id's shard.
+
+    Writes also hold the shared move lock until the request ends, so a move
+    waits for them; a write that finds the user already moved away re-reads
+    the directory once.
+    """
+    if not enabled():
+        return
+    for _ in range(2):
+        use_shard(shard_for(user_id))
+        if request.method in ('GET', 'HEAD'):
+            return
+        cur = get_db_connection().cursor()
+        present = lock_user(cur, user_id)
+        cur.close()
+        g.db_pinned = True
+        if present:
+            return
+        close_db()
+        forget(user_id)
+
+def lookup_email(email):
+    """Return {'user_id', 'shard'} for an email from the global directory, or None"""
+    cur = get_global_connection().cursor()
+    cur.execute('SELECT user_id, shard FROM user_directory WHERE email = %s', (email,))
+    row = cur.fetchone()
+    cur.close()
+    return row
+
+def create_user(email, password_hash, display_name):
+    """Register a user in the directory and insert them on their home shard.
+
+    The shard row is committed before the directory row, so a failure in
+    between leaves at most an unreachable row for "flask shards cleanup".
+    """
+    conn = get_global_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT nextval('users_id_seq') AS id")
+        user_id = cur.fetchone()['id']
+        shard = home_shard(user_id)
+        cur.execute('INSERT INTO user_directory (user_id, email, shard) VALUES (%s, %s, %s)',
+                    (user_id, email, shard))
+        use_shard(shard)
+        shard_conn = get_db_connection()
+        shard_cur = shard_conn.cursor()
+        shard_cur.execute(
+            'INSERT INTO users (id, email, password_hash, display_name) VALUES (%s, %s, %s, %s) RETURNING id, email, display_name, photo_url, created_at',
+            (user_id, email, password_hash, display_name)
+        )
+        user = shard_cur.fetchone()
+        shard_cur.close()
+        if shard_conn is not conn:
+            shard_conn.commit()
+        conn.commit()
+        _directory.set(user_id, shard)
+        return user
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def replicate_categories():
+    """Copy the primary's categories and catalog version to every other shard.
+
+    Call after committing a category write. A shard that cannot be reached is
+    logged and skipped; "flask shards sync-categories" catches it up.
+    """
+    if not enabled():
+        return []
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT id, name, color FROM categories ORDER BY id')
+        rows = [(row['id'], row['name'], row['color']) for row in cur.fetchall()]
+        cur.execute('SELECT version FROM catalog_version')
+        version = cur.fetchone()['version']
+        cur.close()
+        conn.rollback()
+
+    failed = []
+    for shard, pool in each_shard():
+        if shard == 0:
+            continue
+        try:
+            with pool.connection() as conn:
+                cur = conn.cursor()
+                try:
+                    cur.execute('DELETE FROM categories WHERE NOT (id = ANY(%s))', ([row[0] for row in rows],))
+                    # Park names first so renames that swap names cannot trip UNIQUE(name)
+                    cur.execute("UPDATE categories SET name = '#' || id")
+                    if rows:
+                        execute_values(cur, """
+                            INSERT INTO categories (id, name, color) VALUES %s
+                            ON CONFLICT (id) DO UPDATE SET name = EXCLUDED.name, color = EXCLUDED.color
+                        """, rows)
+                    cur.execute('UPDATE catalog_version SET version = %s', (version,))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    cur.close()
+        except Exception:
+            logger.exception('Could not replicate categories to shard %s', shard)
+            failed.append(shard)
+    return failed
+
+def category_in_use_on_shards(category_id):
+    """True when an expense on any shard other than the primary uses category_id"""
+    for shard, pool in each_shard():
+        if shard == 0:
+            continue
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT EXISTS (SELECT 1 FROM expenses WHERE category_id = %s)
+                    OR EXISTS (SELECT 1 FROM expenses_archive WHERE category_ids @> ARRAY[%s]) AS used
+            """, (category_id, category_id))
+            used = cur.fetchone()['used']
+            cur.close()
+            conn.rollback()
+        if used:
+            return True
+    return False
+
+def _copy_columns(cur, table):
+    """Columns of table that can be copied, i.e. all but generated ones"""
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND is_generated = 'NEVER'
+        ORDER BY ordinal_position
+    """, (table,))
+    return ', '.join(row['column_name'] for row in cur.fetchall())
+
+def move_user(user_id, target, echo=print):
+    """Move every row of user_id to the target shard while the app keeps running.
+
+    Holds the exclusive move lock on the source shard, so the user's writes
+    wait (reads continue) while rows are copied with COPY, the directory is
+    switched and the source copy is deleted DIRECTORY_TTL seconds later.
+    Safe to re-run after an interruption.
+    """
+    forget(user_id)
+    source = shard_for(user_id)
+    if source == target:
+        return False
+
+    with get_shard_pool(source).connection() as src, get_shard_pool(target).connection() as dst:
+        src_cur, dst_cur = src.cursor(), dst.cursor()
+        src_cur.execute('SELECT pg_advisory_lock(%s, %s)', (MOVE_LOCK_CLASS, user_id))
+        src.commit()
+        try:
+            # Leftovers of an interrupted move; ON DELETE CASCADE clears the other tables
+            dst_cur.execute('DELETE FROM users WHERE id = %s', (user_id,))
+            for table in USER_TABLES:
+                columns = _copy_columns(src_cur, table)
+                key = 'id' if table == 'users' else 'user_id'
+                buffer = io.StringIO()
+                src_cur.copy_expert(
+                    src_cur.mogrify(f'COPY (SELECT {columns} FROM {table} WHERE {key} = %s) TO STDOUT',
+                                    (user_id,)).decode('utf-8'),
+                    buffer)
+                buffer.seek(0)
+                dst_cur.copy_expert(f'COPY {table} ({columns}) FROM STDIN', buffer)
+                echo(f'user {user_id}: copied {dst_cur.rowcount} {table} rows')
+            src.rollback()
+            dst.commit()
+
+            with get_pool().connection() as conn:
+                cur = conn.cursor()
+                cur.execute('UPDATE user_directory SET shard = %s, moved_at = NOW() WHERE user_id = %s',
+                            (target, user_id))
+                conn.commit()
+                cur.close()
+            _directory.set(user_id, target)
+
+            # Workers may still route reads to the source until their entry expires
+            time.sleep(DIRECTORY_TTL)
+            src_cur.execute('DELETE FROM users WHERE id = %s', (user_id,))
+            src.commit()
+        except Exception:
+            src.rollback()
+            dst.rollback()
+            raise
+        finally:
+            src_cur.execute('SELECT pg_advisory_unlock(%s, %s)', (MOVE_LOCK_CLASS, user_id))
+            src.commit()
+            src_cur.close()
+            dst_cur.close()
+    echo(f'user {user_id}: moved from shard {source} to shard {target}')
+    return True
+
+def misplaced_users(limit=None):
+    """Directory entries whose shard differs from the ring placement, as (user_id, shard, home)"""
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT user_id, shard FROM user_directory ORDER BY user_id')
+        rows = cur.fetchall()
+        cur.close()
+        conn.rollback()
+    moves = [(row['user_id'], row['shard'], home_shard(row['user_id'])) for row in rows
+             if home_shard(row['user_id']) != row['shard']]
+    return moves[:limit] if limit else moves
+
+def configure_sequences(echo=print):
+    """Give each shard's expense id sequence a distinct residue modulo ID_STRIDE"""
+    highest = 0
+    for _, pool in each_shard():
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT COALESCE(MAX(id), 0) AS id FROM expenses')
+            highest = max(highest, cur.fetchone()['id'])
+            cur.close()
+            conn.rollback()
+    base = (highest // ID_STRIDE + 1) * ID_STRIDE
+    for shard, pool in each_shard():
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'ALTER SEQUENCE expenses_id_seq INCREMENT BY {ID_STRIDE} RESTART WITH {base + shard}')
+            conn.commit()
+            cur.close()
+        echo(f'shard {shard}: expense ids continue at {base + shard} in steps of {ID_STRIDE}')
+
+@click.group('shards')
+def shards_cli():
+    """Manage user shards."""
+
+@shards_cli.command('list')
+@with_appcontext
+def list_command():
+    """Show every shard with its user count and the users waiting to be rebalanced."""
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT shard, COUNT(*) AS users FROM user_directory GROUP BY shard')
+        counts = {row['shard']: row['users'] for row in cur.fetchall()}
+        cur.close()
+        conn.rollback()
+    pending = {}
+    for _, shard, home in misplaced_users():
+        pending[shard] = pending.get(shard, 0) + 1
+    for shard in range(shard_count()):
+        click.echo(f'shard {shard}: {counts.get(shard, 0)} users, {pending.get(shard, 0)} to move')
+
+@shards_cli.command('init')
+@with_appcontext
+def init_command():
+    """Prepare shards after adding one: expense id strides and a copy of the categories."""
+    configure_sequences(echo=click.echo)
+    failed = replicate_categories()
+    if failed:
+        raise click.ClickException(f"Could not copy categories to shards {', '.join(map(str, failed))}")
+    click.echo('Categories copied to every shard.')
+
+@shards_cli.command('sync-categories')
+@with_appcontext
+def sync_categories_command():
+    """Copy the primary's categories to every other shard."""
+    failed = replicate_categories()
+    if failed:
+        raise click.ClickException(f"Could not copy categories to shards {', '.join(map(str, failed))}")
+    click.echo('Categories copied to every shard.')
+
+@shards_cli.command('move')
+@click.argument('user_id', type=int)
+@click.argument('shard', type=int)
+@with_appcontext
+def move_command(user_id, shard):
+    """Move one user's rows to another shard."""
+    if not 0 <= shard < shard_count():
+        raise click.ClickException(f'shard must be between 0 and {shard_count() - 1}')
+    if not move_user(user_id, shard, echo=click.echo):
+        click.echo(f'user {user_id} is already on shard {shard}')
+
+@shards_cli.command('rebalance')
+@click.option('--limit', type=int, default=None, help='Move at most this many users.')
+@click.option('--dry-run', is_flag=True, help='Only list the users that would move.')
+@with_appcontext
+def rebalance_command(limit, dry_run):
+    """Move users whose shard differs from their place on the hash ring, one at a time."""
+    moves = misplaced_users(limit)
+    for user_id, shard, home in moves:
+        if dry_run:
+            click.echo(f'user {user_id}: shard {shard} -> {home}')
+        else:
+            move_user(user_id, home, echo=click.echo)
+    click.echo(f"{len(moves)} users {'to move' if dry_run else 'moved'}.")
+
+@shards_cli.command('cleanup')
+@click.option('--older-than', type=float, default=1, show_default=True,
+              help='Only delete rows of users created more than this many hours ago.')
+@with_appcontext
+def cleanup_command(older_than):
+    """Delete users left on a shard the directory does not point at (interrupted moves or sign-ups)."""
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT user_id, shard FROM user_directory')
+        directory = {row['user_id']: row['shard'] for row in cur.fetchall()}
+        cur.close()
+        conn.rollback()
+    for shard, pool in each_shard():
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id FROM users WHERE created_at < NOW() - %s * INTERVAL '1 hour'", (older_than,))
+            stray = [row['id'] for row in cur.fetchall() if directory.get(row['id']) != shard]
+            if stray:
+                cur.execute('DELETE FROM users WHERE id = ANY(%s)', (stray,))
+                conn.commit()
+            cur.close()
+        click.echo(f'shard {shard}: removed {len(stray)} stray users')
+
+def init_app(app):
+    """Register shard commands with the Flask app."""
+    app.cli.add_command(shards_cli)
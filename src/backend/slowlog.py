@@ -0,0 +1,264 @@
+import click
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from datetime import date, datetime
+from decimal import Decimal
+import psycopg2
+from flask import has_request_context, request
+from flask.cli import with_appcontext
+import metrics
+from db import current_pool, get_pool
+
+logger = logging.getLogger(__name__)
+
+# Statements slower than this are candidates for the log; 0 disables it
+THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_MS', 250))
+# Fraction of slow statements that are captured
+SAMPLE_RATE = float(os.environ.get('SLOW_QUERY_SAMPLE_RATE', 1.0))
+# Captures per worker per minute, and minimum seconds between captures of one shape
+MAX_PER_MINUTE = int(os.environ.get('SLOW_QUERY_MAX_PER_MINUTE', 10))
+SHAPE_COOLDOWN = float(os.environ.get('SLOW_QUERY_SHAPE_COOLDOWN', 300))
+# Blueprints whose statements are watched
+BLUEPRINTS = set(os.environ.get('SLOW_QUERY_BLUEPRINTS', 'expenses,categories,auth').split(','))
+# statement_timeout for the out-of-band EXPLAIN ANALYZE
+EXPLAIN_TIMEOUT_MS = int(os.environ.get('SLOW_QUERY_EXPLAIN_TIMEOUT_MS', 10000))
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+# Statements that take locks, consume sequences, notify or modify data when re-run
+_SIDE_EFFECTS = re.compile(
+    r'\bFOR\s+(?:NO\s+KEY\s+)?(?:UPDATE|SHARE|KEY\s+SHARE)\b|\bpg_advisory\w*|\bnextval\b|\bsetval\b'
+    r'|\bpg_notify\b|\b(?:INSERT|UPDATE|DELETE|MERGE)\b',
+    re.IGNORECASE)
+
+def normalize(query):
+    """Collapse whitespace and replace literals and placeholders with '?'"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = ' '.join(query.split())
+    query = query.replace('%s', '?')
+    return _LITERAL.sub('?', query)
+
+def param_shape(vars):
+    """Describe parameter types without their values, e.g. 'int, datetime, list[int]'"""
+    if vars is None:
+        return ''
+    values = vars.values() if isinstance(vars, dict) else vars
+
+    def shape(value):
+        if isinstance(value, (list, tuple)):
+            inner = sorted({type(item).__name__ for item in value})
+            return f"list[{'|'.join(inner)}]" if inner else 'list'
+        return 'null' if value is None else type(value).__name__
+    return ', '.join(shape(value) for value in values)
+
+def can_analyze(normalized):
+    """True for a single read-only SELECT that is safe to execute again under EXPLAIN ANALYZE"""
+    statement = normalized.strip().rstrip(';')
+    if ';' in statement:
+        return False
+    verb = statement.lstrip('(').split(None, 1)[0].upper() if statement else ''
+    return verb in ('SELECT', 'WITH') and not _SIDE_EFFECTS.search(statement)
+
+def fingerprint(normalized, shape):
+    return hashlib.sha1(f'{normalized}|{shape}'.encode('utf-8')).hexdigest()[:16]
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return repr(value)
+
+class SlowQueryLog:
+    """Samples slow statements and captures their plans on a background thread.
+
+    The request thread only does the cheap part (normalize, rate-limit,
+    enqueue); EXPLAIN ANALYZE re-runs the statement on its own pooled
+    connection, so it never adds latency to the request that was slow.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=100)
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self._last_capture = {}
+        self._worker_pid = None
+        self.captured = 0
+        self.dropped = 0
+
+    def _admit(self, key):
+        """Sampling, per-minute budget and per-shape cooldown"""
+        if random.random() >= SAMPLE_RATE:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if now - self._window_start >= 60:
+                self._window_start, self._window_count = now, 0
+            if self._window_count >= MAX_PER_MINUTE:
+                return False
+            if now - self._last_capture.get(key, -SHAPE_COOLDOWN) < SHAPE_COOLDOWN:
+                return False
+            self._window_count += 1
+            self._last_capture[key] = now
+            if len(self._last_capture) > 10000:
+                self._last_capture.clear()
+        return True
+
+    def observe(self, query, vars, seconds):
+        """Query observer registered with metrics.InstrumentedCursor"""
+        if not THRESHOLD_MS or seconds * 1000 < THRESHOLD_MS or not has_request_context():
+            return
+        if request.blueprint not in BLUEPRINTS or not isinstance(query, (str, bytes)):
+            return
+
+        normalized = normalize(query)
+        shape = param_shape(vars)
+        key = fingerprint(normalized, shape)
+        if not self._admit(key):
+            return
+
+        route = request.endpoint
+        logger.warning('Slow query %s on %s took %.1f ms: %s [%s]',
+                       key, route, seconds * 1000, normalized[:500], shape)
+        self._ensure_worker()
+        try:
+            # Plans come from the database that ran the statement (shard or replica)
+            self._queue.put_nowait((key, route, normalized, shape, seconds * 1000, query, vars,
+                                    current_pool()))
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_worker(self):
+        if self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker_pid != os.getpid():
+                self._worker_pid = os.getpid()
+                threading.Thread(target=self._run, name='slow-query-log', daemon=True).start()
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            try:
+                self._capture(*entry)
+                self.captured += 1
+            except Exception:
+                logger.exception('Could not capture slow query plan')
+
+    def _capture(self, key, route, normalized, shape, duration_ms, query, vars, pool):
+        if isinstance(query, bytes):
+            # Already interpolated (e.g. by execute_values)
+            query, vars = query.decode('utf-8'), None
+        # Only plain reads are re-executed; everything else gets an estimated plan
+        options = 'ANALYZE, BUFFERS, FORMAT JSON' if can_analyze(normalized) else 'FORMAT JSON'
+
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            plan = None
+            try:
+                cur.execute('SET LOCAL statement_timeout = %s', (EXPLAIN_TIMEOUT_MS,))
+                cur.execute(f'EXPLAIN ({options}) {query}', vars)
+                plan = cur.fetchone()['QUERY PLAN'][0]
+            except psycopg2.Error as e:
+                plan = {'error': str(e).strip()}
+            finally:
+                conn.rollback()
+                # Session-level locks survive the rollback; never return one to the pool
+                cur.execute('SELECT pg_advisory_unlock_all()')
+                conn.rollback()
+                cur.close()
+
+        # The log itself lives on the primary
+        with get_pool().connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                INSERT INTO slow_queries (fingerprint, route, normalized_sql, param_shape, duration_ms, plan)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                """,
+                (key, route or '', normalized, shape, duration_ms,
+                 json.dumps(plan, default=_json_default))
+            )
+            conn.commit()
+            cur.close()
+
+slow_log = SlowQueryLog()
+
+@click.group('slow-queries')
+def slow_queries_cli():
+    """Inspect the slow query log."""
+
+@slow_queries_cli.command('report')
+@click.option('--hours', type=float, default=24, help='Look back this many hours.')
+@click.option('--limit', type=int, default=20, help='Number of query shapes to show.')
+@with_appcontext
+def report_command(hours, limit):
+    """Summarize the worst query shapes by total captured time."""
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT fingerprint, MIN(route) AS route, MIN(normalized_sql) AS normalized_sql,
+                   MIN(param_shape) AS param_shape, COUNT(*) AS captures,
+                   ROUND(AVG(duration_ms)::numeric, 1) AS avg_ms,
+                   ROUND(MAX(duration_ms)::numeric, 1) AS max_ms,
+                   ROUND(SUM(duration_ms)::numeric, 1) AS total_ms,
+                   MAX(captured_at) AS last_seen
+            FROM slow_queries
+            WHERE captured_at >= NOW() - %s * INTERVAL '1 hour'
+            GROUP BY fingerprint
+            ORDER BY total_ms DESC
+            LIMIT %s
+        """, (hours, limit))
+        rows = cur.fetchall()
+        cur.close()
+        conn.rollback()
+
+    if not rows:
+        click.echo('No slow queries captured.')
+        return
+    for row in rows:
+        click.echo(
+            f"{row['fingerprint']}  {row['captures']}x  avg {row['avg_ms']} ms  "
+            f"max {row['max_ms']} ms  {row['route']}  last {row['last_seen']:%Y-%m-%d %H:%M}"
+        )
+        click.echo(f"    {row['normalized_sql'][:300]}")
+        click.echo(f"    params: {row['param_shape'] or '-'}")
+
+@slow_queries_cli.command('show')
+@click.argument('fingerprint')
+@with_appcontext
+def show_command(fingerprint):
+    """Print the most recent captured plan for a query shape."""
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT normalized_sql, param_shape, duration_ms, plan, captured_at
+            FROM slow_queries
+            WHERE fingerprint = %s
+            ORDER BY captured_at DESC
+            LIMIT 1
+        """, (fingerprint,))
+        row = cur.fetchone()
+        cur.close()
+        conn.rollback()
+
+    if row is None:
+        raise click.ClickException(f'No captures for {fingerprint}')
+    click.echo(f"{row['captured_at']}  {row['duration_ms']:.1f} ms")
+    click.echo(row['normalized_sql'])
+    click.echo(f"params: {row['param_shape'] or '-'}")
+    click.echo(json.dumps(row['plan'], indent=2))
+
+def init_app(app):
+    """Watch statements from the configured blueprints and register the CLI."""
+    if slow_log.observe not in metrics.query_observers:
+        metrics.query_observers.append(slow_log.observe)
+    app.cli.add_command(slow_queries_cli)
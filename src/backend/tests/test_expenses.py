@@ -0,0 +1,15 @@
+import pytest
+from werkzeug.datastructures import MultiDict
+from expenses import MAX_PAGE_SIZE, page_args
+from filters import FilterError
+
+def test_page_args_defaults():
+    assert page_args(MultiDict()) == (1, 10)
+
+def test_page_args_caps_page_size():
+    assert page_args(MultiDict({'page': '3', 'pageSize': str(MAX_PAGE_SIZE + 1)})) == (3, MAX_PAGE_SIZE)
+
+@pytest.mark.parametrize('args', [{'pageSize': '0'}, {'pageSize': '-5'}, {'page': '0'}])
+def test_page_args_rejects_non_positive(args):
+    with pytest.raises(FilterError):
+        page_args(MultiDict(args))
@@ -0,0 +1,27 @@
+from decimal import Decimal
+import pytest
+from imports import RowError, validate_row
+
+CATEGORIES = {'ids': {1}, 'names': {'food': 1}}
+
+def row(**fields):
+    return dict({'title': 'Lunch', 'amount': '12.50', 'date': '2024-03-01', 'categoryId': 1}, **fields)
+
+def test_valid_row():
+    user_id, title, amount, _, category_id, notes, receipt_url = validate_row(
+        row(category='Food', categoryId=None, notes='', receiptUrl='https://example.com/r.png'),
+        7, CATEGORIES)
+    assert (user_id, title, amount, category_id) == (7, 'Lunch', Decimal('12.50'), 1)
+    assert notes is None
+    assert receipt_url == 'https://example.com/r.png'
+
+@pytest.mark.parametrize('field, value', [
+    ('title', 123),
+    ('title', ['Lunch']),
+    ('notes', {'text': 'x'}),
+    ('receiptUrl', 42),
+    ('receipt_url', True),
+])
+def test_non_string_text_fields_are_row_errors(field, value):
+    with pytest.raises(RowError, match='must be a string'):
+        validate_row(row(**{field: value}), 7, CATEGORIES)
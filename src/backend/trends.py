@@ -0,0 +1,132 @@
+from flask import Blueprint, request, jsonify, g
+from db import get_db_connection
+from auth import token_required
+from versions import conditional
+from filters import FilterError, date_range
+from datetime import date, datetime, timedelta
+import rollups
+import archive
+
+bp = Blueprint('trends', __name__, url_prefix='/api/expenses')
+
+INTERVALS = {
+    'day': '1 day',
+    'week': '1 week',
+    'month': '1 month',
+}
+# Rough bucket widths in days, only used to reject oversized requests early
+INTERVAL_DAYS = {'day': 1, 'week': 7, 'month': 28}
+MAX_BUCKETS = 2000
+
+def trends_range(args, today=None):
+    """Resolve the [start, end) window; defaults to this year and an end of tomorrow midnight"""
+    today = today or date.today()
+    start, end = date_range(
+        args.get('timeFilter', 'custom' if args.get('startDate') else 'this-year'),
+        args.get('startDate'),
+        args.get('endDate'),
+        today
+    )
+    if start is not None and end is None:
+        end = datetime.combine(today + timedelta(days=1), datetime.min.time())
+    return start, end
+
+def trends_window(args):
+    """ETag window for conditional: the resolved range, or None when it does not parse"""
+    try:
+        return trends_range(args)
+    except FilterError:
+        return None
+
+@bp.route('/trends', methods=['GET'])
+@token_required
+@conditional(window=trends_window)
+def get_trends():
+    """Spend per category per day/week/month over a range, gap-filled with zero buckets.
+
+    Day-aligned ranges are aggregated from the per-day rollups. Responses are
+    cached per user, resolved range and data version by the conditional decorator.
+    """
+    user_id = g.current_user['id']
+
+    interval = request.args.get('interval', 'day')
+    if interval not in INTERVALS:
+        return jsonify({'message': 'interval must be one of day, week, month'}), 400
+
+    try:
+        start, end = trends_range(request.args)
+    except FilterError as e:
+        return jsonify({'message': str(e)}), 400
+    if start is None:
+        return jsonify({'message': 'A start date is required'}), 400
+    if end <= start:
+        return jsonify({'message': 'endDate must be after startDate'}), 400
+    if (end - start).days / INTERVAL_DAYS[interval] > MAX_BUCKETS:
+        return jsonify({'message': f'Range too large for interval {interval}'}), 400
+
+    if rollups.is_day_aligned(start, end):
+        source = """
+            SELECT r.day::timestamp AS date, r.category_id, r.total AS amount, r.count
+            FROM expense_daily_rollups r
+            WHERE r.user_id = %s AND r.day >= %s AND r.day < %s AND r.count <> 0
+        """
+        source_params = [user_id, start.date(), end.date()]
+    else:
+        expenses, expenses_params = archive.source(user_id, start, end)
+        source = f"""
+            SELECT e.date, COALESCE(e.category_id, 0) AS category_id, e.amount, 1 AS count
+            FROM {expenses}
+            WHERE e.user_id = %s AND e.date >= %s AND e.date < %s
+        """
+        source_params = expenses_params + [user_id, start, end]
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(
+        f"""
+        WITH buckets AS (
+            SELECT generate_series(
+                date_trunc(%s, %s::timestamp),
+                %s::timestamp - INTERVAL '1 microsecond',
+                %s::interval
+            ) AS bucket
+        ),
+        sums AS (
+            SELECT date_trunc(%s, s.date) AS bucket, s.category_id,
+                   SUM(s.amount) AS amount, SUM(s.count) AS count
+            FROM ({source}) s
+            GROUP BY 1, 2
+        )
+        SELECT b.bucket, sums.category_id, sums.amount, sums.count
+        FROM buckets b
+        LEFT JOIN sums ON sums.bucket = b.bucket
+        ORDER BY b.bucket, sums.category_id
+        """,
+        [interval, start, end, INTERVALS[interval], interval] + source_params
+    )
+    rows = cur.fetchall()
+    cur.close()
+
+    series = []
+    for row in rows:
+        if not series or series[-1]['bucket'] != row['bucket'].date().isoformat():
+            series.append({
+                'bucket': row['bucket'].date().isoformat(),
+                'total': 0.0,
+                'count': 0,
+                'byCategory': {}
+            })
+        point = series[-1]
+        if row['category_id'] is not None:
+            amount = float(row['amount'])
+            point['total'] += amount
+            point['count'] += int(row['count'])
+            # Uncategorized spend is reported under category 0
+            point['byCategory'][str(row['category_id'])] = amount
+
+    return jsonify({
+        'interval': interval,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'series': series
+    })
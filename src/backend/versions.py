@@ -0,0 +1,90 @@
+import hashlib
+import os
+from datetime import date
+from functools import wraps
+from flask import request, g, make_response
+from db import get_db_connection
+from cache import TTLCache
+
+# Rendered GET responses keyed by ETag. The ETag already encodes the data
+# versions, so entries never need explicit invalidation; LRU eviction and the
+# TTL only bound memory.
+response_cache = TTLCache(
+    maxsize=int(os.environ.get('RESPONSE_CACHE_SIZE', 2000)),
+    ttl=float(os.environ.get('RESPONSE_CACHE_TTL', 300))
+)
+
+def bump_user_version(cur, user_id):
+    """Mark a user's expense data as changed; call inside the write transaction"""
+    cur.execute('UPDATE users SET data_version = data_version + 1 WHERE id = %s', (user_id,))
+
+def bump_catalog_version(cur):
+    """Mark the global category catalog as changed; call inside the write transaction"""
+    cur.execute('UPDATE catalog_version SET version = version + 1')
+
+# Reads both versions without touching the expense tables
+VERSIONS_QUERY = """
+    SELECT u.data_version, cv.version AS catalog_version
+    FROM users u CROSS JOIN catalog_version cv
+    WHERE u.id = %s
+"""
+
+def current_versions(user_id):
+    """Return (user data version, catalog version) for a user"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(VERSIONS_QUERY, (user_id,))
+    row = cur.fetchone()
+    cur.close()
+    if row is None:
+        return 0, 0
+    return row['data_version'], row['catalog_version']
+
+def make_etag(user_id, data_version, catalog_version, path, args, window=None):
+    """Derive a strong ETag from the data versions, the request path and query pairs
+    and the date window the request resolves to.
+
+    Relative time filters (current-month, this-year, ...) depend on the current
+    date, so without a resolved window today's date is part of the tag.
+    """
+    query = '&'.join(f'{k}={v}' for k, v in sorted(args))
+    bounds = ','.join(str(bound) for bound in (window if window is not None else (date.today(),)))
+    raw = f'{user_id}:{data_version}:{catalog_version}:{path}?{query}@{bounds}'
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def conditional(f=None, *, window=None):
+    """Serve GET routes with ETags, 304s and a shared rendered-response cache.
+
+    Must be applied below token_required so g.current_user is set. window is an
+    optional function of the query args returning the (start, end) the route
+    will read, e.g. filters.expense_window; use as @conditional(window=...).
+    """
+    if f is None:
+        return lambda f: conditional(f, window=window)
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        user_id = g.current_user['id']
+        etag = make_etag(user_id, *current_versions(user_id),
+                         request.path, request.args.items(multi=True),
+                         window(request.args) if window else None)
+
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+        else:
+            cached = response_cache.get(etag)
+            if cached is not None:
+                body, mimetype = cached
+                response = make_response(body, 200)
+                response.mimetype = mimetype
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                response_cache.set(etag, (response.get_data(), response.mimetype))
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Authorization')
+        return response
+    return decorated
@@ -20,45 +20,25 @@ export default function Dashboard() {
   const [timeFilter, setTimeFilter] = useState<TimeFilter>("current-month");
   const [summaryTitle, setSummaryTitle] = useState(`Summary • ${getCurrentMonthName()}`);
 
-  // Fetch categories
-  const { data: categories = [] } = useQuery({
-    queryKey: ['categories'],
-    queryFn: async () => {
-      const response = await fetch(`${API_URL}/categories`, {
-        headers: getAuthHeader()
-      });
-      if (!response.ok) {
-        throw new Error('Failed to fetch categories');
-      }
-      const data = await response.json();
-      return data.categories.map((cat: any) => ({
-        id: cat.id.toString(),
-        name: cat.name,
-        color: cat.color
-      }));
-    }
-  });
-
-  // Fetch expense summary
+  // Fetch categories, summary and expenses for the time period in one request
   const {
-    data: summaryData,
-    isLoading: summaryLoading,
-    isError: summaryError
+    data: dashboardData,
+    isLoading,
+    isError
   } = useQuery({
-    queryKey: ['expenseSummary', { timeFilter }],
+    queryKey: ['dashboard', { timeFilter }],
     queryFn: async () => {
-      const response = await fetch(`${API_URL}/expenses/summary?timeFilter=${timeFilter}`, {
+      const response = await fetch(`${API_URL}/dashboard?timeFilter=${timeFilter}`, {
         headers: getAuthHeader()
       });
       
       if (!response.ok) {
-        throw new Error('Failed to fetch expense summary');
+        throw new Error('Failed to fetch dashboard');
       }
       
       const data = await response.json();
       
-      // Format recent expenses
-      const formattedRecentExpenses = data.recentExpenses.map((exp: any) => ({
+      const formatExpense = (exp: any) => ({
         id: exp.id.toString(),
         userId: exp.user_id.toString(),
         title: exp.title,
@@ -74,12 +54,18 @@ export default function Dashboard() {
         receiptUrl: exp.receipt_url,
         createdAt: new Date(exp.created_at),
         updatedAt: new Date(exp.updated_at)
-      }));
+      });
       
       return {
+        categories: data.categories.map((cat: any) => ({
+          id: cat.id.toString(),
+          name: cat.name,
+          color: cat.color
+        })),
         total: data.total,
         byCategory: data.byCategory,
-        recentExpenses: formattedRecentExpenses
+        recentExpenses: data.recentExpenses.map(formatExpense),
+        expenses: data.expenses.map(formatExpense)
       };
     },
     enabled: !!localStorage.getItem('auth_token'),
@@ -89,47 +75,9 @@ export default function Dashboard() {
     refetchOnWindowFocus: false
   });
 
-  // Fetch all expenses for specific time period
-  const {
-    data: expensesData,
-    isLoading: expensesLoading
-  } = useQuery({
-    queryKey: ['expenses', { timeFilter }],
-    queryFn: async () => {
-      const response = await fetch(`${API_URL}/expenses?timeFilter=${timeFilter}`, {
-        headers: getAuthHeader()
-      });
-      
-      if (!response.ok) {
-        throw new Error('Failed to fetch expenses');
-      }
-      
-      const data = await response.json();
-      
-      return data.expenses.map((exp: any) => ({
-        id: exp.id.toString(),
-        userId: exp.user_id.toString(),
-        title: exp.title,
-        amount: parseFloat(exp.amount),
-        date: new Date(exp.date),
-        categoryId: exp.category_id?.toString(),
-        category: exp.category_id ? {
-          id: exp.category_id.toString(),
-          name: exp.category_name || "Unknown",
-          color: exp.category_color || "#AAAAAA"
-        } : undefined,
-        notes: exp.notes,
-        receiptUrl: exp.receipt_url,
-        createdAt: new Date(exp.created_at),
-        updatedAt: new Date(exp.updated_at)
-      }));
-    },
-    enabled: !!localStorage.getItem('auth_token'),
-    staleTime: 0, // Always consider data stale
-    gcTime: 5 * 60 * 1000, // Keep in cache for 5 minutes
-    refetchOnMount: true,
-    refetchOnWindowFocus: false
-  });
+  const categories = dashboardData?.categories || [];
+  const summaryData = dashboardData;
+  const expensesData = dashboardData?.expenses;
 
   // Handle time filter change
   const handleTimeFilterChange = (filter: TimeFilter) => {
@@ -150,9 +98,6 @@ export default function Dashboard() {
     }
   };
 
-  const isLoading = summaryLoading || expensesLoading;
-  const isError = summaryError;
-
   return (
     <AppLayout>
       <div className="max-w-7xl mx-auto">
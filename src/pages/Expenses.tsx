@@ -138,6 +138,7 @@ export default function Expenses() {
       // Invalidate both expense queries to ensure data consistency
       queryClient.invalidateQueries({ queryKey: ['expenses'] });
       queryClient.invalidateQueries({ queryKey: ['expenseSummary'] });
+      queryClient.invalidateQueries({ queryKey: ['dashboard'] });
       toast.success("Expense added successfully");
       setIsExpenseFormOpen(false);
     },
@@ -169,6 +170,7 @@ export default function Expenses() {
       // Invalidate both expense queries to ensure data consistency
       queryClient.invalidateQueries({ queryKey: ['expenses'] });
       queryClient.invalidateQueries({ queryKey: ['expenseSummary'] });
+      queryClient.invalidateQueries({ queryKey: ['dashboard'] });
       toast.success("Expense updated successfully");
       setIsExpenseFormOpen(false);
       setIsEditMode(false);
@@ -198,6 +200,7 @@ export default function Expenses() {
       // Invalidate both expense queries to ensure data consistency
       queryClient.invalidateQueries({ queryKey: ['expenses'] });
       queryClient.invalidateQueries({ queryKey: ['expenseSummary'] });
+      queryClient.invalidateQueries({ queryKey: ['dashboard'] });
       toast.success("Expense deleted successfully");
       setIsExpenseDialogOpen(false);
       setSelectedExpense(null);